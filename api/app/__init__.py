@@ -1,9 +1,10 @@
 import io
 import logging
-import os
+import select
+import socket
 import threading
+import time
 
-from confugue import Configuration
 import flask
 from flask_cors import CORS
 from flask_limiter import Limiter
@@ -16,7 +17,9 @@ import werkzeug.exceptions
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 from groove2groove.io import NoteSequencePipeline
+from groove2groove.note_array import NoteArray
 from groove2groove.models import roll2seq_style_transfer
+from app.model_manager import ModelManager
 
 
 app = flask.Flask(__name__,
@@ -33,8 +36,10 @@ CORS(app, **app.config.get('CORS', {}))
 
 logging.getLogger('tensorflow').handlers.clear()
 
-models = {}
-model_graphs = {}
+models = ModelManager(model_root=app.config['MODEL_ROOT'],
+                      model_configs=app.config['MODELS'],
+                      memory_budget=app.config.get('MODEL_MEMORY_BUDGET', None),
+                      model_overhead=app.config.get('MODEL_MEMORY_OVERHEAD', 64 * 2**20))
 tf_lock = threading.Lock()
 
 
@@ -47,21 +52,28 @@ if app.config.get('SERVE_STATIC_FILES', False):
 
 @app.before_first_request
 def init_models():
-    for model_name, model_cfg in app.config['MODELS'].items():
-        logdir = os.path.join(app.config['MODEL_ROOT'], model_cfg.get('logdir', model_name))
-        with open(os.path.join(logdir, 'model.yaml'), 'rb') as f:
-            config = Configuration.from_yaml(f)
+    # Other models are loaded on first use
+    with tf_lock:
+        for model_name in app.config.get('PRELOAD_MODELS', []):
+            models.get(model_name)
 
-        model_graphs[model_name] = tf.Graph()
-        with model_graphs[model_name].as_default():
-            models[model_name] = config.configure(roll2seq_style_transfer.Experiment,
-                                                  logdir=logdir, train_mode=False)
-            models[model_name].trainer.load_variables(**model_cfg.get('load_variables', {}))
+
+@app.route('/api/v1/model_stats/', methods=['GET'])
+def model_stats():
+    return flask.jsonify(models.get_stats())
 
 
 @app.route('/api/v1/style_transfer/<model_name>/', methods=['POST'])
 @limiter.limit(app.config.get('MODEL_RATE_LIMIT', None))
 def run_model(model_name):
+    deadline = None
+    if 'REQUEST_DEADLINE' in app.config:
+        deadline = time.monotonic() + app.config['REQUEST_DEADLINE']
+    client_socket = get_client_socket()
+
+    if model_name not in models:
+        return error_response('MODEL_NOT_FOUND', status_code=404)
+
     files = flask.request.files
     content_seq = NoteSequence.FromString(files['content_input'].read())
     style_seq = NoteSequence.FromString(files['style_input'].read())
@@ -91,13 +103,27 @@ def run_model(model_name):
 
     pipeline = NoteSequencePipeline(source_seq=content_seq, style_seq=style_seq,
                                     bars_per_segment=8, warp=True)
+
+    def cancel_fn():
+        return is_past(deadline) or is_disconnected(client_socket)
+
+    # Wait for the model, but not beyond the deadline
+    if not tf_lock.acquire(timeout=-1 if deadline is None else max(0, deadline - time.monotonic())):
+        return error_response('MODEL_TIMEOUT', status_code=500)
     try:
-        with tf_lock, model_graphs[model_name].as_default():
-            outputs = models[model_name].run(
+        experiment, graph = models.get(model_name)
+        with graph.as_default():
+            outputs = experiment.run(
                     pipeline, sample=sample, softmax_temperature=softmax_temperature,
-                    normalize_velocity=True, options=run_options)
+                    normalize_velocity=True, options=run_options, cancel_fn=cancel_fn)
     except tf.errors.DeadlineExceededError:
         return error_response('MODEL_TIMEOUT', status_code=500)
+    except roll2seq_style_transfer.RunCancelledError:
+        if is_past(deadline):
+            return error_response('MODEL_TIMEOUT', status_code=500)
+        return error_response('REQUEST_CANCELLED', status_code=500)
+    finally:
+        tf_lock.release()
     output_seq = pipeline.postprocess(outputs)
     return flask.send_file(io.BytesIO(output_seq.SerializeToString()),
                            mimetype='application/protobuf')
@@ -143,6 +169,40 @@ def sanitize_ns(ns):
         collection.extend(filtered)
 
 
+def get_client_socket():
+    """Return the socket of the current request if the WSGI server exposes it, else `None`."""
+    environ = flask.request.environ
+    return environ.get('gunicorn.socket', environ.get('werkzeug.socket'))
+
+
+def is_disconnected(client_socket):
+    """Check (without blocking) whether the client has closed the connection."""
+    if client_socket is None:
+        return False
+    try:
+        # Unlike select.select, poll also works with file descriptors >= FD_SETSIZE
+        poller = select.poll()
+        poller.register(client_socket, select.POLLIN)
+        if not poller.poll(0):
+            return False
+    except (OSError, ValueError):
+        # We cannot tell, so assume the client is still there
+        return False
+
+    # The request body has already been read, so the socket only becomes readable if the
+    # client sends more data or closes the connection (in which case recv returns b'').
+    try:
+        return client_socket.recv(1, socket.MSG_PEEK) == b''
+    except (BlockingIOError, InterruptedError):
+        return False
+    except OSError:
+        return True
+
+
+def is_past(deadline):
+    return deadline is not None and time.monotonic() > deadline
+
+
 def ns_stats(ns):
     stats = {'beats': 0}
 
@@ -152,7 +212,8 @@ def ns_stats(ns):
     for i in range(len(tempos) - 1):
        stats['beats'] += (tempos[i + 1].time - tempos[i].time) * tempos[i].qpm / 60
 
-    stats['programs'] = len(set((note.program, note.is_drum) for note in ns.notes))
-    stats['notes'] = len(ns.notes)
+    notes = NoteArray.from_sequence(ns)
+    stats['programs'] = len(np.unique(notes.notes[['program', 'is_drum']]))
+    stats['notes'] = len(notes)
 
     return stats
@@ -0,0 +1,149 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+from confugue import Configuration
+import tensorflow as tf
+
+from groove2groove.models import roll2seq_style_transfer
+
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ModelManager:
+    """Loads models on first use and evicts the least recently used ones to stay within budget.
+
+    Args:
+        model_root: The directory containing the model directories.
+        model_configs: A dictionary mapping model names to their configuration (the `MODELS`
+            config option).
+        memory_budget: The maximum total memory (in bytes) to be used by loaded models, or `None`
+            for no limit. The model being requested is never evicted, so the budget may be
+            exceeded if a single model does not fit in it.
+        model_overhead: The memory (in bytes) assumed to be used by each model in addition to its
+            variables (for the graph, the session and the buffers used when running it).
+
+    The memory used by a model is only an estimate, computed from the sizes of its variables plus
+    `model_overhead`. Measuring the memory of the process instead would not be reliable: the
+    first model loaded also pays for initializing TensorFlow, and memory freed by evicting a model
+    is rarely returned to the operating system.
+    """
+
+    def __init__(self, model_root, model_configs, memory_budget=None,
+                 model_overhead=64 * 2**20):
+        self._model_root = model_root
+        self._model_configs = model_configs
+        self._memory_budget = memory_budget
+        self._model_overhead = model_overhead
+
+        self._lock = threading.RLock()
+        self._loaded = collections.OrderedDict()  # model name -> _LoadedModel, in LRU order
+        self._stats = {name: _ModelStats() for name in model_configs}
+
+    def __contains__(self, model_name):
+        return model_name in self._model_configs
+
+    def get(self, model_name):
+        """Return a tuple `(experiment, graph)` for the given model, loading it if needed.
+
+        The caller should hold the lock used to serialize access to the models (`tf_lock`) for as
+        long as it uses the returned objects, since another `get` call may evict them.
+        """
+        with self._lock:
+            if model_name not in self._loaded:
+                self._loaded[model_name] = self._load(model_name)
+                self._evict(keep=model_name)
+            self._loaded.move_to_end(model_name)
+            self._stats[model_name].last_used = time.time()
+            model = self._loaded[model_name]
+            return model.experiment, model.graph
+
+    def get_stats(self):
+        """Return a JSON-serializable dictionary of load and eviction statistics."""
+        with self._lock:
+            return {
+                'memory_budget': self._memory_budget,
+                'memory_used': sum(m.memory for m in self._loaded.values()),
+                'load_count': sum(s.load_count for s in self._stats.values()),
+                'load_time': sum(s.load_time for s in self._stats.values()),
+                'eviction_count': sum(s.eviction_count for s in self._stats.values()),
+                'eviction_time': sum(s.eviction_time for s in self._stats.values()),
+                'models': {
+                    name: {
+                        'loaded': name in self._loaded,
+                        'memory': self._loaded[name].memory if name in self._loaded else None,
+                        **vars(stats)
+                    }
+                    for name, stats in self._stats.items()
+                }
+            }
+
+    def _load(self, model_name):
+        model_cfg = self._model_configs[model_name]
+        logdir = os.path.join(self._model_root, model_cfg.get('logdir', model_name))
+        with open(os.path.join(logdir, 'model.yaml'), 'rb') as f:
+            config = Configuration.from_yaml(f)
+
+        start_time = time.perf_counter()
+        graph = tf.Graph()
+        with graph.as_default():
+            experiment = config.configure(roll2seq_style_transfer.Experiment,
+                                          logdir=logdir, train_mode=False,
+                                          decoder_modes=model_cfg.get('decoder_modes', ()))
+            experiment.trainer.load_variables(**model_cfg.get('load_variables', {}))
+            variables_size = sum(v.shape.num_elements() * v.dtype.size
+                                 for v in tf.global_variables())
+        load_time = time.perf_counter() - start_time
+
+        memory = variables_size + self._model_overhead
+
+        stats = self._stats[model_name]
+        stats.load_count += 1
+        stats.load_time += load_time
+        _LOGGER.info(f"Loaded model '{model_name}' in {load_time:.2f} s "
+                     f'({memory / 2**20:.1f} MiB)')
+
+        return _LoadedModel(experiment=experiment, graph=graph, memory=memory)
+
+    def _evict(self, keep):
+        if self._memory_budget is None:
+            return
+
+        while sum(m.memory for m in self._loaded.values()) > self._memory_budget:
+            victim = next((name for name in self._loaded if name != keep), None)
+            if victim is None:
+                _LOGGER.warning(f"Model '{keep}' alone exceeds the memory budget")
+                return
+
+            start_time = time.perf_counter()
+            model = self._loaded.pop(victim)
+            model.experiment.trainer.session.close()
+            del model
+            eviction_time = time.perf_counter() - start_time
+
+            stats = self._stats[victim]
+            stats.eviction_count += 1
+            stats.eviction_time += eviction_time
+            _LOGGER.info(f"Evicted model '{victim}' in {eviction_time:.2f} s")
+
+
+class _LoadedModel:
+
+    def __init__(self, experiment, graph, memory):
+        self.experiment = experiment
+        self.graph = graph
+        self.memory = memory
+
+
+class _ModelStats:
+
+    def __init__(self):
+        self.load_count = 0
+        self.load_time = 0.
+        self.eviction_count = 0
+        self.eviction_time = 0.
+        self.last_used = None
+
@@ -0,0 +1,239 @@
+"""A beat-relative encoding with note durations instead of note-off events.
+
+Compared to `BeatRelativeEncoding`, this encoding produces shorter sequences:
+
+- Each note is a single `NoteOn` (or `DrumOn`) event, whose duration is given by the last
+  `SetDuration` event. The durations are quantized like the times, and a `SetDuration` event is
+  only emitted when the duration changes. Simultaneous notes are ordered by velocity and duration
+  to avoid redundant `SetVelocity` and `SetDuration` events.
+- A run of empty beats is skipped using a single `SkipBeats` event (instead of one `SetTimeNext`
+  event per beat).
+
+Durations longer than `max_duration_beats` are truncated and durations shorter than one time
+step are extended to one step.
+"""
+import logging
+import warnings
+
+import numpy as np
+from museflow.vocabulary import Vocabulary
+from note_seq.constants import STANDARD_PPQ
+from note_seq.protobuf import music_pb2
+
+from groove2groove.encodings import (get_ids, get_normalized_notes, pad_token_batch, to_id_array,
+                                     trim_padding)
+from groove2groove.note_array import NOTE_DTYPE, NoteArray
+
+_LOGGER = logging.getLogger(__name__)
+
+_SET_TIME, _SET_TIME_NEXT, _SKIP_BEATS, _SET_VELOCITY, _SET_DURATION, _NOTE_ON, _DRUM_ON = (
+    range(1, 8))
+_EVENT_TYPES = {'SetTime': _SET_TIME, 'SetTimeNext': _SET_TIME_NEXT, 'SkipBeats': _SKIP_BEATS,
+                'SetVelocity': _SET_VELOCITY, 'SetDuration': _SET_DURATION,
+                'NoteOn': _NOTE_ON, 'DrumOn': _DRUM_ON}
+
+
+class BeatDurationEncoding:
+
+    def __init__(self, units_per_beat=12, velocity_unit=4, use_velocity=True, default_velocity=127,
+                 max_duration_beats=8, max_skip_beats=8, use_drum_events=False,
+                 warn_on_errors=False):
+        self._units_per_beat = units_per_beat
+        self._velocity_unit = velocity_unit
+        self._use_velocity = use_velocity
+        self._default_velocity = default_velocity
+        self._max_duration_units = max_duration_beats * units_per_beat
+        self._max_skip_beats = max_skip_beats
+        self._use_drum_events = use_drum_events
+        self._warn_on_errors = warn_on_errors
+
+        wordlist = (['<pad>', '<s>', '</s>'] +
+                    [('NoteOn', i) for i in range(128)] +
+                    ([('DrumOn', i) for i in range(128)] if use_drum_events else []) +
+                    [('SetTime', i) for i in range(units_per_beat)] +
+                    [('SetTimeNext', i) for i in range(units_per_beat)] +
+                    [('SkipBeats', i + 1) for i in range(max_skip_beats)] +
+                    [('SetDuration', i + 1) for i in range(self._max_duration_units)])
+
+        max_velocity_units = (128 + velocity_unit - 1) // velocity_unit
+        if use_velocity:
+            wordlist.extend([('SetVelocity', i + 1) for i in range(max_velocity_units)])
+
+        self.vocabulary = Vocabulary(wordlist)
+
+        # Tables of token IDs, indexed by value (values starting at 1 have a dummy entry at 0)
+        self._note_on_ids = get_ids(self.vocabulary, 'NoteOn', range(128))
+        self._drum_on_ids = get_ids(self.vocabulary, 'DrumOn' if use_drum_events else 'NoteOn',
+                                    range(128))
+        self._set_time_ids = get_ids(self.vocabulary, 'SetTime', range(units_per_beat))
+        self._set_time_next_ids = get_ids(self.vocabulary, 'SetTimeNext', range(units_per_beat))
+        self._skip_beats_ids = np.concatenate([
+            [-1], get_ids(self.vocabulary, 'SkipBeats', range(1, max_skip_beats + 1))])
+        self._set_duration_ids = np.concatenate([
+            [-1], get_ids(self.vocabulary, 'SetDuration', range(1, self._max_duration_units + 1))])
+        if use_velocity:
+            self._set_velocity_ids = np.concatenate([
+                [-1], get_ids(self.vocabulary, 'SetVelocity', range(1, max_velocity_units + 1))])
+
+        # Tables of event types and values, indexed by token ID (special tokens have type 0)
+        self._event_types = np.zeros(len(self.vocabulary), dtype=np.int64)
+        self._event_values = np.zeros(len(self.vocabulary), dtype=np.int64)
+        for i, token in enumerate(self.vocabulary):
+            if isinstance(token, tuple):
+                self._event_types[i], self._event_values[i] = _EVENT_TYPES[token[0]], token[1]
+
+    def encode(self, sequence, as_ids=True, add_start=False, add_end=False):
+        ids = self._encode_ids(sequence, add_start=add_start, add_end=add_end)
+        if as_ids:
+            return ids.tolist()
+        return self.vocabulary.from_ids(ids.tolist())
+
+    def encode_batch(self, sequences, add_start=False, add_end=False):
+        """Encode a list of sequences into a padded `int32` matrix.
+
+        Sequences which are `None` are encoded as empty sequences (without start or end tokens).
+
+        Returns:
+            A tuple `(batch, lengths)`, see `groove2groove.encodings`.
+        """
+        return pad_token_batch(
+            [self._encode_ids(sequence, add_start=add_start, add_end=add_end)
+             if sequence is not None else [] for sequence in sequences],
+            pad_id=self.vocabulary.pad_id)
+
+    def _encode_ids(self, sequence, add_start, add_end):
+        ids = self._encode_notes(get_normalized_notes(sequence))
+        if add_start:
+            ids = np.concatenate([[self.vocabulary.start_id], ids])
+        if add_end:
+            ids = np.concatenate([ids, [self.vocabulary.end_id]])
+        return ids
+
+    def _encode_notes(self, notes):
+        step = 1 / self._units_per_beat
+        onsets = (notes.start_time / step + 0.5).astype(np.int64)
+        offsets = (notes.end_time / step + 0.5).astype(np.int64)
+        durations = np.clip(offsets - onsets, 1, self._max_duration_units)
+
+        velocities = notes.velocity.astype(np.int64)
+        invalid = (velocities > 127) | (velocities < 1)
+        for velocity in velocities[invalid]:
+            warnings.warn(f'Invalid velocity value: {velocity}')
+        velocities[invalid] = self._default_velocity
+        velocities = velocities // self._velocity_unit + 1
+        if not self._use_velocity:
+            velocities[:] = 0
+
+        is_drum_event = notes.is_drum & self._use_drum_events
+        pitches = notes.pitch.astype(np.int64)
+        order = np.lexsort((np.arange(len(notes)), pitches, is_drum_event, durations, velocities,
+                            onsets))
+        onsets, durations, velocities, pitches, is_drum_event = (
+            onsets[order], durations[order], velocities[order], pitches[order],
+            is_drum_event[order])
+
+        # Time shifts, emitted whenever the time increases (starting from zero)
+        time_changed = onsets > np.maximum.accumulate(np.concatenate([[0], onsets]))[:-1]
+        beats, steps_in_beat = np.divmod(onsets[time_changed], self._units_per_beat)
+        beat_deltas = np.diff(beats, prepend=0)
+        time_ids = np.where(beat_deltas == 0,
+                            self._set_time_ids[steps_in_beat],
+                            self._set_time_next_ids[steps_in_beat])
+
+        # Runs of empty beats, skipped using as few SkipBeats events as possible
+        num_skipped_beats = np.maximum(beat_deltas - 1, 0)
+        num_skip_events = -(-num_skipped_beats // self._max_skip_beats)
+        skip_note_indices = np.repeat(np.flatnonzero(time_changed), num_skip_events)
+        skip_positions = (np.arange(len(skip_note_indices))
+                          - np.repeat(np.cumsum(num_skip_events) - num_skip_events,
+                                      num_skip_events))
+        skip_values = np.minimum(np.repeat(num_skipped_beats, num_skip_events)
+                                 - skip_positions * self._max_skip_beats,
+                                 self._max_skip_beats)
+
+        velocity_changed = np.diff(velocities, prepend=-1) != 0
+        if not self._use_velocity:
+            velocity_changed[:] = False
+        duration_changed = np.diff(durations, prepend=-1) != 0
+
+        # Put the tokens of each note together, in this order: skipped beats, time shift,
+        # velocity, duration and the note itself
+        note_ids = np.where(is_drum_event, self._drum_on_ids[pitches], self._note_on_ids[pitches])
+        parts = [
+            (skip_note_indices, skip_positions, self._skip_beats_ids[skip_values]),
+            (np.flatnonzero(time_changed), None, time_ids),
+            (np.flatnonzero(velocity_changed), None,
+             self._set_velocity_ids[velocities[velocity_changed]] if self._use_velocity else []),
+            (np.flatnonzero(duration_changed), None,
+             self._set_duration_ids[durations[duration_changed]]),
+            (np.arange(len(note_ids)), None, note_ids),
+        ]
+        note_indices = np.concatenate([indices for indices, _, _ in parts])
+        part_indices = np.concatenate([np.full(len(indices), i)
+                                       for i, (indices, _, _) in enumerate(parts)])
+        positions = np.concatenate([positions if positions is not None else np.zeros(len(indices))
+                                    for indices, positions, _ in parts])
+        ids = np.concatenate([np.asarray(ids, dtype=np.int64) for _, _, ids in parts])
+        return ids[np.lexsort((positions, part_indices, note_indices))]
+
+    def decode(self, tokens):
+        return self._decode_ids(to_id_array(self.vocabulary, tokens))
+
+    def decode_batch(self, batch):
+        """Decode a batch of token ID sequences, e.g. the output of `Model.run`.
+
+        Args:
+            batch: A 2D array of token IDs padded with `vocabulary.pad_id`, or a list of 1D arrays.
+
+        Returns:
+            A list of `NoteSequence`s.
+        """
+        return [self._decode_ids(trim_padding(to_id_array(self.vocabulary, tokens),
+                                              self.vocabulary.pad_id))
+                for tokens in batch]
+
+    def _decode_ids(self, ids):
+        types, values = self._event_types[ids], self._event_values[ids]
+
+        # The time only moves forward; a time shift to an earlier time is an error
+        is_time = (types == _SET_TIME) | (types == _SET_TIME_NEXT) | (types == _SKIP_BEATS)
+        beat_deltas = np.where(types == _SET_TIME_NEXT, 1,
+                               np.where(types == _SKIP_BEATS, values, 0))
+        steps = np.where(types == _SKIP_BEATS, 0, values)
+        new_times = np.cumsum(beat_deltas) + steps / self._units_per_beat
+        times = np.maximum.accumulate(np.where(is_time, new_times, 0.))
+        error_count = np.sum(is_time & (new_times <= np.concatenate([[0.], times[:-1]])))
+        if error_count:
+            self._log_errors('Encountered {} errors'.format(error_count))
+
+        velocities = self._get_last_values(types, values, _SET_VELOCITY)
+        velocities = np.where(velocities >= 0, (velocities - 1) * self._velocity_unit,
+                              self._default_velocity)
+        durations = self._get_last_values(types, values, _SET_DURATION)
+        durations = np.where(durations >= 0, durations, self._units_per_beat)
+
+        onsets = np.flatnonzero((types == _NOTE_ON) | (types == _DRUM_ON))
+        notes = np.zeros(len(onsets), dtype=NOTE_DTYPE)
+        notes['pitch'] = values[onsets]
+        notes['velocity'] = velocities[onsets]
+        notes['start_time'] = times[onsets]
+        notes['end_time'] = times[onsets] + durations[onsets] / self._units_per_beat
+        notes['is_drum'] = types[onsets] == _DRUM_ON
+
+        total_time = max(float(times[-1]) if len(times) else 0.,
+                         float(notes['end_time'].max()) if len(notes) else 0.)
+        sequence = music_pb2.NoteSequence(ticks_per_quarter=STANDARD_PPQ, total_time=total_time)
+        return NoteArray(notes).to_sequence(sequence)
+
+    @staticmethod
+    def _get_last_values(types, values, event_type):
+        """For each token, return the value of the last event of the given type (or -1)."""
+        last_positions = np.maximum.accumulate(
+            np.where(types == event_type, np.arange(len(types)), -1))
+        return np.where(last_positions >= 0, values[last_positions], -1)
+
+    def _log_errors(self, message):
+        if self._warn_on_errors:
+            warnings.warn(message, RuntimeWarning)
+        else:
+            _LOGGER.debug(message)
@@ -1,17 +1,24 @@
-import heapq
 import logging
 import warnings
-from collections import defaultdict
 
 import numpy as np
-from museflow import note_sequence_utils
-from museflow.encodings.performance_encoding import _compress_note_offs
 from museflow.vocabulary import Vocabulary
 from note_seq.constants import STANDARD_PPQ
 from note_seq.protobuf import music_pb2
 
+from groove2groove.encodings import (get_ids, get_normalized_notes, pad_token_batch, to_id_array,
+                                     trim_padding)
+from groove2groove.note_array import NOTE_DTYPE, NoteArray
+
 _LOGGER = logging.getLogger(__name__)
 
+# Event types used by the decoder (note events come last)
+_SET_TIME, _SET_TIME_NEXT, _SET_VELOCITY, _NOTE_ON, _DRUM_ON, _NOTE_OFF, _DRUM_OFF, _ALL_OFF = (
+    range(1, 9))
+_EVENT_TYPES = {'SetTime': _SET_TIME, 'SetTimeNext': _SET_TIME_NEXT,
+                'SetVelocity': _SET_VELOCITY, 'NoteOn': _NOTE_ON, 'DrumOn': _DRUM_ON,
+                'NoteOff': _NOTE_OFF, 'DrumOff': _DRUM_OFF}
+
 
 class BeatRelativeEncoding:
 
@@ -44,201 +51,250 @@ class BeatRelativeEncoding:
 
         self.vocabulary = Vocabulary(wordlist)
 
-    def encode(self, sequence, as_ids=True, add_start=False, add_end=False):
-        sequence = note_sequence_utils.normalize_tempo(sequence)
-
-        queue = _NoteEventQueue(sequence, quantization_step=1 / self._units_per_beat)
-        events = [self.vocabulary.start_token] if add_start else []
-
-        last_beat = 0
-        last_t = 0
-        velocity_quantized = None
-        for t, note, is_onset in queue:
-            if t > last_t:
-                beat = t // self._units_per_beat
-                step_in_beat = t % self._units_per_beat
-
-                while beat - last_beat > 1:
-                    # Skip to the beginning of the next beat
-                    events.append(('SetTimeNext', 0))
-                    last_beat += 1
-
-                if beat == last_beat:
-                    events.append(('SetTime', step_in_beat))
-                else:  # beat == last_beat + 1
-                    events.append(('SetTimeNext', step_in_beat))
-                    last_beat += 1
-                assert beat == last_beat
-
-                last_t = t
-
-            if is_onset:
-                note_velocity = note.velocity
-                if note_velocity > 127 or note_velocity < 1:
-                    warnings.warn(f'Invalid velocity value: {note_velocity}')
-                    note_velocity = self._default_velocity
-                note_velocity_quantized = note_velocity // self._velocity_unit + 1
-                if velocity_quantized != note_velocity_quantized:
-                    velocity_quantized = note_velocity_quantized
-                    if self._use_velocity:
-                        events.append(('SetVelocity', velocity_quantized))
-
-                if note.is_drum and self._use_drum_events:
-                    events.append(('DrumOn', note.pitch))
-                else:
-                    events.append(('NoteOn', note.pitch))
-            else:
-                if note.is_drum and self._use_drum_events:
-                    events.append(('DrumOff', note.pitch))
+        # Tables of token IDs, indexed by value
+        self._note_on_ids = get_ids(self.vocabulary, 'NoteOn', range(128))
+        self._note_off_ids = get_ids(self.vocabulary, 'NoteOff', range(128))
+        self._drum_on_ids = get_ids(self.vocabulary, 'DrumOn' if use_drum_events else 'NoteOn',
+                                    range(128))
+        self._drum_off_ids = get_ids(self.vocabulary, 'DrumOff' if use_drum_events else 'NoteOff',
+                                     range(128))
+        self._set_time_ids = get_ids(self.vocabulary, 'SetTime', range(units_per_beat))
+        self._set_time_next_ids = get_ids(self.vocabulary, 'SetTimeNext', range(units_per_beat))
+        self._all_off_id = (self.vocabulary.to_id(('NoteOff', '*')) if use_all_off_event
+                            else None)
+        if use_velocity:
+            self._set_velocity_ids = np.concatenate([
+                [-1], get_ids(self.vocabulary, 'SetVelocity', range(1, max_velocity_units + 1))])
+
+        # Tables of event types and values, indexed by token ID (special tokens have type 0)
+        self._event_types = np.zeros(len(self.vocabulary), dtype=np.int64)
+        self._event_values = np.zeros(len(self.vocabulary), dtype=np.int64)
+        for i, token in enumerate(self.vocabulary):
+            if isinstance(token, tuple):
+                event, value = token
+                if value == '*':
+                    self._event_types[i] = _ALL_OFF
                 else:
-                    events.append(('NoteOff', note.pitch))
+                    self._event_types[i], self._event_values[i] = _EVENT_TYPES[event], value
 
-        if self._use_all_off_event:
-            events = _compress_note_offs(events)
+    def encode(self, sequence, as_ids=True, add_start=False, add_end=False):
+        ids = self._encode_ids(sequence, add_start=add_start, add_end=add_end)
+        if as_ids:
+            return ids.tolist()
+        return self.vocabulary.from_ids(ids.tolist())
+
+    def encode_batch(self, sequences, add_start=False, add_end=False):
+        """Encode a list of sequences into a padded `int32` matrix.
 
+        Sequences which are `None` are encoded as empty sequences (without start or end tokens).
+
+        Returns:
+            A tuple `(batch, lengths)`, see `groove2groove.encodings`.
+        """
+        return pad_token_batch(
+            [self._encode_ids(sequence, add_start=add_start, add_end=add_end)
+             if sequence is not None else [] for sequence in sequences],
+            pad_id=self.vocabulary.pad_id)
+
+    def _encode_ids(self, sequence, add_start, add_end):
+        ids = self._encode_notes(get_normalized_notes(sequence))
+        if add_start:
+            ids = np.concatenate([[self.vocabulary.start_id], ids])
         if add_end:
-            events.append(self.vocabulary.end_token)
+            ids = np.concatenate([ids, [self.vocabulary.end_id]])
+        return ids
 
-        if as_ids:
-            return self.vocabulary.to_ids(events)
-        return events
+    def _encode_notes(self, notes):
+        """Encode a `NoteArray` as an array of token IDs.
+
+        Note onsets and offsets are quantized and ordered by time and pitch. Offsets come before
+        onsets that occur at the same time, except that a note which is shorter than a time step
+        is turned off right after it is turned on.
+        """
+        num_notes = len(notes)
+        step = 1 / self._units_per_beat
+        # Round to nearest int like int(x + 0.5) does, i.e. truncating towards zero
+        onsets = (notes.start_time / step + 0.5).astype(np.int64)
+        offsets = (notes.end_time / step + 0.5).astype(np.int64)
+        is_short = offsets <= onsets
+        pitches = notes.pitch.astype(np.int64)
+        is_drum = notes.is_drum
+
+        # Order all events (onsets followed by offsets)
+        note_ids = np.tile(np.arange(num_notes), 2)
+        is_onset = np.repeat([True, False], num_notes)
+        times = np.concatenate([onsets, np.where(is_short, onsets, offsets)])
+        order = np.lexsort((
+            ~is_onset,                                      # own onset, then a short offset
+            note_ids,
+            np.tile(is_drum, 2),
+            np.tile(pitches, 2),
+            is_onset | np.tile(is_short, 2),                # offsets, then onsets
+            times,
+        ))
+        note_ids, is_onset, times = note_ids[order], is_onset[order], times[order]
+        pitches, is_drum = pitches[note_ids], is_drum[note_ids]
+        is_drum_event = is_drum & self._use_drum_events
+
+        # Time shifts, emitted whenever the time increases (starting from zero)
+        time_changed = times > np.maximum.accumulate(np.concatenate([[0], times]))[:-1]
+        new_times = times[time_changed]
+        beats, steps_in_beat = np.divmod(new_times, self._units_per_beat)
+        beat_deltas = np.diff(beats, prepend=0)
+        num_skipped_beats = np.maximum(beat_deltas - 1, 0)
+        time_ids = np.where(beat_deltas == 0,
+                            self._set_time_ids[steps_in_beat],
+                            self._set_time_next_ids[steps_in_beat])
+
+        # Velocity changes, emitted before onsets
+        velocities = notes.velocity[note_ids[is_onset]].astype(np.int64)
+        invalid = (velocities > 127) | (velocities < 1)
+        for velocity in velocities[invalid]:
+            warnings.warn(f'Invalid velocity value: {velocity}')
+        velocities[invalid] = self._default_velocity
+        velocities = velocities // self._velocity_unit + 1
+        velocity_changed = np.zeros(len(times), dtype=bool)
+        if self._use_velocity:
+            velocity_changed[is_onset] = np.diff(velocities, prepend=-1) != 0
+
+        note_event_ids = np.where(
+            is_onset,
+            np.where(is_drum_event, self._drum_on_ids[pitches], self._note_on_ids[pitches]),
+            np.where(is_drum_event, self._drum_off_ids[pitches], self._note_off_ids[pitches]))
+        has_note_token = np.ones(len(times), dtype=bool)
+        if self._use_all_off_event:
+            self._compress_note_offs(note_event_ids, has_note_token, is_onset, is_drum_event,
+                                     time_changed)
+
+        # Lay out the tokens of each event: skipped beats, time shift, velocity and note token
+        num_time_tokens = np.zeros(len(times), dtype=np.int64)
+        num_time_tokens[time_changed] = num_skipped_beats + 1
+        num_tokens = num_time_tokens + velocity_changed + has_note_token
+        event_starts = np.cumsum(num_tokens) - num_tokens
+
+        ids = np.empty(np.sum(num_tokens), dtype=np.int64)
+        skip_starts = np.repeat(event_starts[time_changed], num_skipped_beats)
+        skip_offsets = (np.arange(len(skip_starts))
+                        - np.repeat(np.cumsum(num_skipped_beats) - num_skipped_beats,
+                                    num_skipped_beats))
+        ids[skip_starts + skip_offsets] = self._set_time_next_ids[0]
+        ids[event_starts[time_changed] + num_skipped_beats] = time_ids
+        ids[(event_starts + num_time_tokens)[velocity_changed]] = (
+            self._set_velocity_ids[velocities[velocity_changed[is_onset]]]
+            if self._use_velocity else [])
+        ids[(event_starts + num_tokens - 1)[has_note_token]] = note_event_ids[has_note_token]
+        return ids
+
+    def _compress_note_offs(self, note_event_ids, has_note_token, is_onset, is_drum_event,
+                            time_changed):
+        """Replace runs of `NoteOff` events turning off all notes with one `('NoteOff', '*')`.
+
+        This has the same effect as `museflow.encodings.performance_encoding._compress_note_offs`
+        and modifies the arrays in place.
+        """
+        is_note_on = is_onset & ~is_drum_event
+        is_note_off = ~is_onset & ~is_drum_event
+        num_notes_on = np.cumsum(is_note_on.astype(np.int64) - is_note_off)
+
+        # A run of note-offs is interrupted by any other token, including time shifts
+        continues_run = is_note_off & ~time_changed & np.concatenate([[False], is_note_off[:-1]])
+        run_starts = np.flatnonzero(is_note_off & ~continues_run)
+        if len(run_starts) == 0:
+            return
+        run_ends = np.flatnonzero(is_note_off & ~np.concatenate([continues_run[1:], [False]]))
+        compressed = num_notes_on[run_ends] == 0
+
+        run_ids = np.cumsum(is_note_off & ~continues_run) - 1
+        has_note_token[continues_run & compressed[np.maximum(run_ids, 0)]] = False
+        note_event_ids[run_starts[compressed]] = self._all_off_id
 
     def decode(self, tokens):
-        sequence = music_pb2.NoteSequence()
-        sequence.ticks_per_quarter = STANDARD_PPQ
+        return self._decode_ids(to_id_array(self.vocabulary, tokens))
 
-        notes_on = defaultdict(list)
-        error_count = 0
+    def decode_batch(self, batch):
+        """Decode a batch of token ID sequences, e.g. the output of `Model.run`.
 
-        t = 0.
-        current_beat = 0
-        velocity = self._default_velocity
-        for token in tokens:
-            if isinstance(token, (int, np.integer)):
-                token = self.vocabulary.from_id(token)
-            if token not in self.vocabulary:
-                raise RuntimeError(f'Invalid token: {token}')
-            if not isinstance(token, tuple):
-                continue
-            event, value = token
-
-            if event in ['SetTime', 'SetTimeNext']:
-                if event == 'SetTimeNext':
-                    current_beat += 1
-                new_t = current_beat + value / self._units_per_beat
-                if new_t > t:
-                    t = new_t
-                else:
-                    error_count += 1
-                continue
-
-            if event == 'SetVelocity':
-                velocity = (value - 1) * self._velocity_unit
-            elif event in ['NoteOn', 'DrumOn']:
-                note = sequence.notes.add()
-                note.start_time = t
-                note.pitch = value
-                note.velocity = velocity
-                note.is_drum = (event == 'DrumOn')
-                notes_on[note.pitch].append(note)
-            elif event in ['NoteOff', 'DrumOff']:
-                if value == '*':
-                    assert self._use_all_off_event
+        Args:
+            batch: A 2D array of token IDs padded with `vocabulary.pad_id`, or a list of 1D arrays.
 
-                    if not any(notes_on.values()):
-                        error_count += 1
+        Returns:
+            A list of `NoteSequence`s.
+        """
+        # Padding is ignored by the decoder, so cut it off before decoding
+        return [self._decode_ids(trim_padding(to_id_array(self.vocabulary, tokens),
+                                              self.vocabulary.pad_id))
+                for tokens in batch]
 
-                    for note_list in notes_on.values():
-                        for note in note_list:
-                            note.end_time = t
-                        note_list.clear()
-                else:
-                    try:
-                        note = notes_on[value].pop()
-                        note.end_time = t
-                    except IndexError:
-                        error_count += 1
-        sequence.total_time = t
+    def _decode_ids(self, ids):
+        types, values = self._event_types[ids], self._event_values[ids]
+        error_count = 0
+
+        # The time only moves forward; a time shift to an earlier time is an error
+        is_time = (types == _SET_TIME) | (types == _SET_TIME_NEXT)
+        new_times = np.cumsum(types == _SET_TIME_NEXT) + values / self._units_per_beat
+        times = np.maximum.accumulate(np.where(is_time, new_times, 0.))
+        error_count += np.sum(is_time & (new_times <= np.concatenate([[0.], times[:-1]])))
+        total_time = float(times[-1]) if len(times) else 0.
+
+        is_velocity = types == _SET_VELOCITY
+        last_velocity = np.maximum.accumulate(np.where(is_velocity, np.arange(len(ids)), -1))
+        velocities = np.where(last_velocity >= 0,
+                              (values[last_velocity] - 1) * self._velocity_unit,
+                              self._default_velocity)
+
+        # Match note-offs to note-ons with the same pitch (the most recent one first)
+        onsets = np.flatnonzero((types == _NOTE_ON) | (types == _DRUM_ON))
+        offsets = [-1] * len(onsets)
+        notes_on = {}
+        num_notes, num_notes_on = 0, 0
+        note_events = np.flatnonzero(types >= _NOTE_ON)
+        for i, event_type, pitch in zip(note_events.tolist(), types[note_events].tolist(),
+                                        values[note_events].tolist()):
+            if event_type in (_NOTE_ON, _DRUM_ON):
+                notes_on.setdefault(pitch, []).append(num_notes)
+                num_notes += 1
+                num_notes_on += 1
+            elif event_type == _ALL_OFF:
+                if num_notes_on == 0:
+                    error_count += 1
+                for note_list in notes_on.values():
+                    for note in note_list:
+                        offsets[note] = i
+                notes_on.clear()
+                num_notes_on = 0
+            elif notes_on.get(pitch):
+                offsets[notes_on[pitch].pop()] = i
+                num_notes_on -= 1
+            else:
+                error_count += 1
 
         if error_count:
             self._log_errors('Encountered {} errors'.format(error_count))
 
+        notes = np.zeros(len(onsets), dtype=NOTE_DTYPE)
+        notes['pitch'] = values[onsets]
+        notes['velocity'] = velocities[onsets]
+        notes['start_time'] = times[onsets]
+        notes['is_drum'] = types[onsets] == _DRUM_ON
+        offsets = np.array(offsets, dtype=np.int64)
+        notes['end_time'] = times[offsets]
+
         # Handle hanging notes
-        num_hanging = sum(len(lst) for lst in notes_on.values())
-        if any(notes_on.values()):
+        is_hanging = offsets < 0
+        num_hanging = np.sum(is_hanging)
+        if num_hanging:
             if self._errors == 'remove':
                 self._log_errors(f'Removing {num_hanging} hanging note(s)')
-                notes_filtered = list(sequence.notes)
-                for hanging_notes in notes_on.values():
-                    notes_filtered = [n for n in notes_filtered if n not in hanging_notes]
-                del sequence.notes[:]
-                sequence.notes.extend(notes_filtered)
+                notes = notes[~is_hanging]
             else:  # 'fix'
                 self._log_errors(f'Ending {num_hanging} hanging note(s)')
-                for hanging_notes in notes_on.values():
-                    for note in hanging_notes:
-                        note.end_time = sequence.total_time
+                notes['end_time'][is_hanging] = total_time
 
-        return sequence
+        sequence = music_pb2.NoteSequence(ticks_per_quarter=STANDARD_PPQ, total_time=total_time)
+        return NoteArray(notes).to_sequence(sequence)
 
     def _log_errors(self, message):
         if self._warn_on_errors:
             warnings.warn(message, RuntimeWarning)
         else:
             _LOGGER.debug(message)
-
-
-class _NoteEventQueue:
-    """
-    A priority queue of note onsets and offsets.
-
-    The queue is ordered according to time and pitch.
-    Offsets come before onsets that occur at the same time, unless they correspond
-    to the same note.
-    """
-
-    def __init__(self, sequence, quantization_step=None):
-        """Initialize the queue.
-
-        Args:
-            sequence: A `NoteSequence`.
-            quantization_step: The quantization step in seconds. If `None`, no
-                quantization will be performed.
-        """
-        self._quantization_step = quantization_step
-
-        # Build a heap of note onsets and offsets. For now, we only add the onsets;
-        # an offset is added once the corresponding onset is popped. This is an easy
-        # way to make sure that we never pop the offset first.
-        # Below, the ID of the Note object is used to stop the heap algorithm from
-        # comparing the Note itself, which would raise an exception.
-        self._heap = [(self._quantize(note.start_time), True, note.pitch, note.is_drum,
-                       id(note), note)
-                      for note in sequence.notes]
-        heapq.heapify(self._heap)
-
-    def pop(self):
-        """Return the next event from the queue.
-
-        Returns:
-            A tuple of the form `(time, note, is_onset)` where `time` is the time of the
-            event (expressed as the number of quantization steps if applicable) and `note`
-            is the corresponding `Note` object.
-        """
-        time, is_onset, _, _, _, note = heapq.heappop(self._heap)
-        if is_onset:
-            # Add the offset to the queue
-            heapq.heappush(self._heap,
-                           (self._quantize(note.end_time), False, note.pitch, note.is_drum,
-                            id(note), note))
-
-        return time, note, is_onset
-
-    def __iter__(self):
-        while self._heap:
-            yield self.pop()
-
-    def _quantize(self, value):
-        if self._quantization_step:
-            return int(value / self._quantization_step + 0.5)  # Round to nearest int
-        return value
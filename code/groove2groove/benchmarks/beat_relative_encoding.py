@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""Compare `BeatRelativeEncoding` to the original, event-by-event implementation.
+
+Random sequences (with tempo changes, unquantized times, very short notes and invalid velocities)
+are encoded, one by one and in a batch, with every combination of the encoding options. The
+encoded sequences are decoded again, and so are random token sequences (which exercise the error
+handling of the decoder). The results are checked to be identical and the run times are printed.
+
+The check alone can be run with `--check-only` (or by calling `check_equivalence`), e.g. as a
+regression test; the script exits with a non-zero status if any of the results differ.
+"""
+import argparse
+import functools
+import heapq
+import itertools
+import logging
+import sys
+import timeit
+import warnings
+from collections import defaultdict
+
+import numpy as np
+from museflow import note_sequence_utils
+from museflow.encodings.performance_encoding import _compress_note_offs
+from note_seq.constants import STANDARD_PPQ
+from note_seq.protobuf import music_pb2
+
+from groove2groove.beat_relative_encoding import BeatRelativeEncoding
+from groove2groove.benchmarks.synthetic import make_sequence
+
+OPTIONS = ['use_velocity', 'use_all_off_event', 'use_drum_events']
+
+
+def encode_reference(encoding, sequence, add_start=False, add_end=False):
+    """Encode a sequence the way `BeatRelativeEncoding.encode` used to, for comparison."""
+    sequence = note_sequence_utils.normalize_tempo(sequence)
+
+    queue = _NoteEventQueue(sequence, quantization_step=1 / encoding._units_per_beat)
+    events = [encoding.vocabulary.start_token] if add_start else []
+
+    last_beat = 0
+    last_t = 0
+    velocity_quantized = None
+    for t, note, is_onset in queue:
+        if t > last_t:
+            beat = t // encoding._units_per_beat
+            step_in_beat = t % encoding._units_per_beat
+
+            while beat - last_beat > 1:
+                events.append(('SetTimeNext', 0))
+                last_beat += 1
+
+            if beat == last_beat:
+                events.append(('SetTime', step_in_beat))
+            else:
+                events.append(('SetTimeNext', step_in_beat))
+                last_beat += 1
+            last_t = t
+
+        if is_onset:
+            note_velocity = note.velocity
+            if note_velocity > 127 or note_velocity < 1:
+                note_velocity = encoding._default_velocity
+            note_velocity_quantized = note_velocity // encoding._velocity_unit + 1
+            if velocity_quantized != note_velocity_quantized:
+                velocity_quantized = note_velocity_quantized
+                if encoding._use_velocity:
+                    events.append(('SetVelocity', velocity_quantized))
+
+            if note.is_drum and encoding._use_drum_events:
+                events.append(('DrumOn', note.pitch))
+            else:
+                events.append(('NoteOn', note.pitch))
+        else:
+            if note.is_drum and encoding._use_drum_events:
+                events.append(('DrumOff', note.pitch))
+            else:
+                events.append(('NoteOff', note.pitch))
+
+    if encoding._use_all_off_event:
+        events = _compress_note_offs(events)
+
+    if add_end:
+        events.append(encoding.vocabulary.end_token)
+
+    return encoding.vocabulary.to_ids(events)
+
+
+def decode_reference(encoding, tokens):
+    """Decode tokens the way `BeatRelativeEncoding.decode` used to, for comparison.
+
+    The old version removed hanging notes by comparing `Note` messages by value, which also removed
+    finished notes equal to a hanging one; here, notes are compared by identity instead.
+    """
+    sequence = music_pb2.NoteSequence()
+    sequence.ticks_per_quarter = STANDARD_PPQ
+
+    notes_on = defaultdict(list)
+    t = 0.
+    current_beat = 0
+    velocity = encoding._default_velocity
+    for token in tokens:
+        token = encoding.vocabulary.from_id(token)
+        if token not in encoding.vocabulary:
+            raise RuntimeError(f'Invalid token: {token}')
+        if not isinstance(token, tuple):
+            continue
+        event, value = token
+
+        if event in ['SetTime', 'SetTimeNext']:
+            if event == 'SetTimeNext':
+                current_beat += 1
+            t = max(t, current_beat + value / encoding._units_per_beat)
+        elif event == 'SetVelocity':
+            velocity = (value - 1) * encoding._velocity_unit
+        elif event in ['NoteOn', 'DrumOn']:
+            note = sequence.notes.add(start_time=t, pitch=value, velocity=velocity,
+                                      is_drum=(event == 'DrumOn'))
+            notes_on[note.pitch].append(note)
+        elif value == '*':
+            for note_list in notes_on.values():
+                for note in note_list:
+                    note.end_time = t
+                note_list.clear()
+        elif notes_on[value]:
+            notes_on[value].pop().end_time = t
+    sequence.total_time = t
+
+    hanging_ids = set(id(note) for note_list in notes_on.values() for note in note_list)
+    if encoding._errors == 'remove':
+        notes_filtered = [n for n in sequence.notes if id(n) not in hanging_ids]
+        del sequence.notes[:]
+        sequence.notes.extend(notes_filtered)
+    else:
+        for note in sequence.notes:
+            if id(note) in hanging_ids:
+                note.end_time = sequence.total_time
+    return sequence
+
+
+def make_random_tokens(rng, encoding, length):
+    """Create a random sequence of token IDs, padded with a random number of padding tokens."""
+    ids = rng.randint(len(encoding.vocabulary), size=length)
+    return np.concatenate([ids, np.zeros(rng.randint(10), dtype=ids.dtype)])
+
+
+class _NoteEventQueue:
+    """A priority queue of note onsets and offsets, ordered by time and pitch.
+
+    Offsets come before onsets that occur at the same time, unless they correspond to the same
+    note. Simultaneous onsets of the same pitch used to be ordered by the address of the `Note`
+    object, which is arbitrary; here, they are ordered by their position in the sequence instead.
+    """
+
+    def __init__(self, sequence, quantization_step):
+        self._quantization_step = quantization_step
+        # An offset is only added once the corresponding onset is popped.
+        self._heap = [(self._quantize(note.start_time), True, note.pitch, note.is_drum, i, note)
+                      for i, note in enumerate(sequence.notes)]
+        heapq.heapify(self._heap)
+
+    def __iter__(self):
+        while self._heap:
+            time, is_onset, pitch, is_drum, i, note = heapq.heappop(self._heap)
+            if is_onset:
+                heapq.heappush(self._heap,
+                               (self._quantize(note.end_time), False, pitch, is_drum, i, note))
+            yield time, note, is_onset
+
+    def _quantize(self, value):
+        return int(value / self._quantization_step + 0.5)
+
+
+def make_test_sequence(rng, num_notes):
+    """Create a random sequence exercising the corner cases of the encoding."""
+    sequence = make_sequence(rng, num_notes=num_notes, qpm=rng.uniform(60, 180))
+    for time in np.sort(rng.uniform(0, sequence.total_time, size=rng.randint(3))):
+        sequence.tempos.add(time=time, qpm=rng.uniform(60, 180))
+    for note in sequence.notes:
+        if rng.rand() < 0.3:
+            note.start_time += rng.uniform(0, 0.05)
+            note.end_time = note.start_time + rng.choice([rng.uniform(0, 0.05),
+                                                          rng.uniform(0.05, 2)])
+        if rng.rand() < 0.01:
+            note.velocity = 0
+    return sequence
+
+
+def _run_all(fn, encoding, inputs):
+    return [fn(encoding, x) for x in inputs]
+
+
+def make_encodings(rng, units_per_beat=12, velocity_unit=16):
+    """Create an encoding for every combination of `OPTIONS` (with random error handling).
+
+    Returns:
+        A list of pairs `(options, encoding)`.
+    """
+    results = []
+    for values in itertools.product([False, True], repeat=len(OPTIONS)):
+        options = dict(zip(OPTIONS, values))
+        results.append((options, BeatRelativeEncoding(units_per_beat=units_per_beat,
+                                                      velocity_unit=velocity_unit,
+                                                      errors=rng.choice(['remove', 'fix']),
+                                                      **options)))
+    return results
+
+
+def check_equivalence(num_sequences=200, num_notes=400, units_per_beat=12, velocity_unit=16,
+                      seed=0):
+    """Check that `BeatRelativeEncoding` gives the same results as the reference implementation.
+
+    Random sequences (see `make_test_sequence`) are encoded one by one (with and without the
+    start and end tokens) and in a batch, and the results are decoded again together with random
+    token sequences, with each of the encodings from `make_encodings`.
+
+    Returns:
+        A list of descriptions of the mismatches, empty if all the results are identical.
+    """
+    logging.getLogger('absl').setLevel(logging.ERROR)  # Skipped notes in normalize_tempo
+    rng = np.random.RandomState(seed)
+    sequences = [make_test_sequence(rng, num_notes=rng.randint(num_notes + 1))
+                 for _ in range(num_sequences)]
+
+    mismatches = []
+    for options, encoding in make_encodings(rng, units_per_beat, velocity_unit):
+        def report(operation, num_different):
+            if num_different:
+                mismatches.append(f'{operation}: {num_different} of {num_sequences} sequences '
+                                  f'differ ({options})')
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            for add_start, add_end in [(False, False), (True, True)]:
+                report(f'encode(add_start={add_start}, add_end={add_end})', sum(
+                    encoding.encode(sequence, add_start=add_start, add_end=add_end) !=
+                    encode_reference(encoding, sequence, add_start, add_end)
+                    for sequence in sequences))
+
+            encoded = [encoding.encode(sequence, add_end=True) for sequence in sequences]
+            batch, lengths = encoding.encode_batch(sequences, add_end=True)
+            report('encode_batch', sum(list(ids[:length]) != expected
+                                       for ids, length, expected in zip(batch, lengths, encoded)))
+
+            random_tokens = [make_random_tokens(rng, encoding, rng.randint(num_notes * 4))
+                             for _ in sequences]
+            report('decode', _count_decode_mismatches(encoding, encoded))
+            report('decode (random tokens)', _count_decode_mismatches(encoding, random_tokens))
+    return mismatches
+
+
+def _count_decode_mismatches(encoding, token_lists):
+    padded = np.zeros((len(token_lists), max(len(t) for t in token_lists)), dtype=np.int32)
+    for row, tokens in zip(padded, token_lists):
+        row[:len(tokens)] = tokens
+    count = 0
+    for tokens, batch_result in zip(token_lists, encoding.decode_batch(padded)):
+        expected = decode_reference(encoding, tokens)
+        if encoding.decode(tokens) != expected or batch_result != expected:
+            count += 1
+    return count
+
+
+def _time(fns, encoding, inputs, repeat):
+    times = {}
+    for name, fn in fns:
+        times[name] = min(timeit.repeat(functools.partial(_run_all, fn, encoding, inputs),
+                                        number=1, repeat=repeat)) / len(inputs)
+    return (', '.join(f'{name} {t * 1e3:.3f} ms/sequence' for name, t in times.items()) +
+            f'; speedup {times["reference"] / times[fns[1][0]]:.2f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--num-sequences', type=int, default=200)
+    parser.add_argument('--num-notes', type=int, default=400)
+    parser.add_argument('--units-per-beat', type=int, default=12)
+    parser.add_argument('--velocity-unit', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check-only', action='store_true',
+                        help='only check the results, without measuring the run times')
+    args = parser.parse_args()
+
+    mismatches = check_equivalence(num_sequences=args.num_sequences, num_notes=args.num_notes,
+                                   units_per_beat=args.units_per_beat,
+                                   velocity_unit=args.velocity_unit, seed=args.seed)
+    for mismatch in mismatches:
+        print(f'MISMATCH: {mismatch}', file=sys.stderr)
+    if mismatches:
+        sys.exit(1)
+    print('All results are identical')
+    if args.check_only:
+        return
+
+    rng = np.random.RandomState(args.seed)
+    sequences = [make_test_sequence(rng, num_notes=rng.randint(args.num_notes + 1))
+                 for _ in range(args.num_sequences)]
+    for options, encoding in make_encodings(rng, args.units_per_beat, args.velocity_unit):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            encoded = [encoding.encode(sequence, add_end=True) for sequence in sequences]
+            print(', '.join(f'{k}={v:d}' for k, v in options.items()) + ':')
+            print('  encode: ' + _time([('reference', encode_reference),
+                                        ('encode', BeatRelativeEncoding.encode)],
+                                       encoding, sequences, args.repeat))
+            print('  decode: ' + _time([('reference', decode_reference),
+                                        ('decode', BeatRelativeEncoding.decode)],
+                                       encoding, encoded, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+"""Measure how the data loading pipeline scales with the size of the dataset.
+
+The `generate` command writes a synthetic dataset in the layout used for training:
+
+- `source.db` and `target.db`: LMDB databases of segments without and with drums,
+- `meta.json.gz`: the metadata in the format expected by `TrainLoader` (`song_name`,
+  `segment_id` and `style` for each key), and `meta_index/`, the equivalent `MetadataIndex`,
+- `key_pairs.tsv`: pairs of source and style keys for `EvalPipeline`.
+
+Each song is rendered in every style and split into the same number of segments. The keys are
+shuffled (as in the training databases) and the values are drawn from a pool of random sequences,
+so that large datasets can be written quickly.
+
+The `run` command generates datasets of the given sizes (or reuses them) and measures, for each of
+them, the startup time (until the first item is returned), the throughput and the resident memory
+of `TrainLoader` (with the JSON metadata and with the metadata index), `EvalPipeline` and, if a
+model configuration is given, `Experiment._load_data` on top of `TrainLoader`. Each measurement
+runs in a separate process, so that the memory usage is not affected by the previous ones. The
+results are written as JSON (see `groove2groove.benchmarks.report`).
+"""
+import argparse
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import coloredlogs
+import lmdb
+import numpy as np
+from note_seq.protobuf import music_pb2
+
+from groove2groove.benchmarks.report import make_report, write_report
+from groove2groove.benchmarks.synthetic import make_chord_sequence
+from groove2groove.compact_notes import to_compact
+from groove2groove.io import EvalPipeline, TrainLoader
+from groove2groove.metadata_index import MetadataIndex
+
+_LOGGER = logging.getLogger(__name__)
+
+TARGETS = ['train_loader', 'train_loader_index', 'eval_pipeline', 'load_data']
+
+_WRITE_CHUNK_SIZE = 10000
+
+
+def write_dataset(path, num_entries, num_styles=20, segments_per_song=8, num_templates=100,
+                  bars_per_segment=8, compact=True, seed=0):
+    """Write a synthetic dataset to a directory (see the `generate` command).
+
+    Args:
+        path: The output directory.
+        num_entries: The number of segments (database entries), rounded up to a whole number of
+            songs.
+        num_styles: The number of styles each song is rendered in.
+        segments_per_song: The number of segments per song.
+        num_templates: The number of distinct random sequences to use as values.
+        bars_per_segment: The length of the segments in bars of 4 beats.
+        compact: Whether to store the sequences in the compact format instead of as protobufs.
+        seed: The random seed.
+
+    Returns:
+        The number of entries written.
+    """
+    rng = np.random.RandomState(seed)
+    num_songs = -(-num_entries // (num_styles * segments_per_song))
+    num_entries = num_songs * num_styles * segments_per_song
+    os.makedirs(path, exist_ok=True)
+
+    targets, sources = [], []
+    for _ in range(num_templates):
+        sequence = make_chord_sequence(rng, num_beats=4 * bars_per_segment)
+        source = music_pb2.NoteSequence()
+        source.CopyFrom(sequence)
+        del source.notes[:]
+        source.notes.extend(note for note in sequence.notes if not note.is_drum)
+        targets.append(to_compact(sequence)[0] if compact else sequence.SerializeToString())
+        sources.append(to_compact(source)[0] if compact else source.SerializeToString())
+
+    # Entry i is segment i % segments_per_song of song i // (num_styles * segments_per_song) in
+    # style (i // segments_per_song) % num_styles; its key is a random permutation of i
+    key_numbers = rng.permutation(num_entries)
+    key_width = len(str(num_entries - 1))
+    templates = rng.randint(num_templates, size=num_entries)
+
+    def get_key(i):
+        return f'{key_numbers[i]:0{key_width}d}'
+
+    map_size = num_entries * (max(len(value) for value in targets) + 4096) + 2 ** 24
+    for name, values in [('source.db', sources), ('target.db', targets)]:
+        with lmdb.open(os.path.join(path, name), subdir=False, map_size=map_size) as db:
+            # Commit in chunks to avoid keeping all the dirty pages in memory
+            order = np.argsort(key_numbers)
+            for start in range(0, num_entries, _WRITE_CHUNK_SIZE):
+                with db.begin(write=True) as txn:
+                    for i in order[start:start + _WRITE_CHUNK_SIZE]:
+                        txn.put(get_key(i).encode(), values[templates[i]], append=True)
+
+    with gzip.open(os.path.join(path, 'meta.json.gz'), 'wt') as f:
+        f.write('{')
+        for i in range(num_entries):
+            song, style_and_segment = divmod(i, num_styles * segments_per_song)
+            style, segment = divmod(style_and_segment, segments_per_song)
+            entry = {'song_name': f'song{song}', 'segment_id': segment,
+                     'style': f'style{style}'}
+            f.write(f'{", " if i else ""}"{get_key(i)}": {json.dumps(entry)}')
+        f.write('}')
+    MetadataIndex.open(os.path.join(path, 'meta.json.gz')).save(os.path.join(path, 'meta_index'))
+
+    # Pair each source segment with the same segment in another style
+    with open(os.path.join(path, 'key_pairs.tsv'), 'w') as f:
+        for i in range(num_entries):
+            style = (i // segments_per_song) % num_styles
+            other_style = (style + rng.randint(1, num_styles)) % num_styles if num_styles > 1 else 0
+            j = i + (other_style - style) * segments_per_song
+            f.write(f'{get_key(i)}\t{get_key(j)}\n')
+
+    return num_entries
+
+
+def measure(target, path, max_items, config_path=None):
+    """Measure the startup time, throughput and memory usage of a loader on a dataset.
+
+    This is meant to run in a fresh process (see `run_measurement`).
+
+    Args:
+        target: One of `TARGETS`.
+        path: The dataset directory.
+        max_items: The number of items to read after the first one.
+        config_path: A model configuration file (only used for `'load_data'`).
+
+    Returns:
+        A dictionary with the results.
+    """
+    paths = dict(source_db_path=os.path.join(path, 'source.db'),
+                 target_db_path=os.path.join(path, 'target.db'))
+    experiment = None
+    if target == 'load_data':
+        # Imported here so that the other measurements do not pay for loading TensorFlow
+        import tensorflow as tf
+        from confugue import Configuration
+        from groove2groove.models.roll2seq_style_transfer import Experiment
+
+        with open(config_path, 'rb') as f:
+            config = Configuration.from_yaml(f)
+        config['train_data'] = dict(paths, metadata_path=os.path.join(path, 'meta_index'))
+        with tf.Graph().as_default():
+            experiment = config.configure(Experiment, logdir=tempfile.mkdtemp(),
+                                          train_mode=False)
+
+    baseline_rss = _get_rss()
+    start_time = time.perf_counter()
+    if target == 'eval_pipeline':
+        loader = EvalPipeline(source_db_path=paths['source_db_path'],
+                              style_db_path=paths['target_db_path'],
+                              key_pairs_path=os.path.join(path, 'key_pairs.tsv'))
+    elif target == 'load_data':
+        loader = experiment._load_data(experiment._make_loader('train'), training=True)()
+    else:
+        metadata_name = 'meta_index' if target == 'train_loader_index' else 'meta.json.gz'
+        loader = TrainLoader(metadata_path=os.path.join(path, metadata_name), random_seed=0,
+                             **paths)
+
+    iterator = iter(loader)
+    num_items = 0
+    for _ in iterator:
+        num_items += 1
+        break
+    startup_time = time.perf_counter() - start_time
+    startup_rss = _get_rss()
+
+    start_time = time.perf_counter()
+    for _ in iterator:
+        num_items += 1
+        if num_items > max_items:
+            break
+    run_time = time.perf_counter() - start_time
+
+    return {
+        'startup_seconds': startup_time,
+        'num_items': num_items,
+        'items_per_second': (num_items - 1) / run_time if run_time > 0 else None,
+        'baseline_rss_bytes': baseline_rss,
+        'startup_rss_bytes': startup_rss,
+        'final_rss_bytes': _get_rss(),
+        # Excludes the pages of the memory-mapped databases, which count towards the RSS
+        'final_anon_rss_bytes': _read_proc_status('RssAnon'),
+        'peak_rss_bytes': _get_peak_rss(),
+    }
+
+
+def run_measurement(*args, **kwargs):
+    """Call `measure` in a new process."""
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(measure, args, kwargs)
+
+
+def _get_rss():
+    """Return the current resident set size in bytes (or `None` if not available)."""
+    return _read_proc_status('VmRSS')
+
+
+def _get_peak_rss():
+    """Return the peak resident set size of this process in bytes.
+
+    `ru_maxrss` is only used as a fallback, since it is not reset when a new program is executed
+    and may therefore include the memory used by the parent process.
+    """
+    peak_rss = _read_proc_status('VmHWM')
+    if peak_rss is None:
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return peak_rss
+
+
+def _read_proc_status(field):
+    """Read a memory size field from `/proc/self/status` (Linux only) in bytes."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                name, value = line.split(':', 1)
+                if name == field:
+                    return int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(title='command', dest='command')
+    subparsers.required = True
+
+    def add_dataset_args(subparser):
+        subparser.add_argument('--num-styles', type=int, default=20)
+        subparser.add_argument('--segments-per-song', type=int, default=8)
+        subparser.add_argument('--num-templates', type=int, default=100,
+                               help='the number of distinct random sequences')
+        subparser.add_argument('--bars-per-segment', type=int, default=8)
+        subparser.add_argument('--format', choices=['compact', 'protobuf'], default='compact')
+        subparser.add_argument('--seed', type=int, default=0)
+
+    subparser = subparsers.add_parser('generate', help='write a synthetic dataset')
+    subparser.add_argument('output_dir', metavar='OUTPUT-DIR')
+    subparser.add_argument('--num-entries', type=int, required=True)
+    add_dataset_args(subparser)
+
+    subparser = subparsers.add_parser('run', help='measure the scaling of the pipeline')
+    subparser.add_argument('data_dir', metavar='DATA-DIR',
+                           help='the directory to write the datasets to (or to reuse them from)')
+    subparser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                           help='the numbers of entries of the datasets')
+    subparser.add_argument('--targets', nargs='+', choices=TARGETS, default=TARGETS[:3])
+    subparser.add_argument('--config', metavar='YAML-FILE', default=None,
+                           help='a model configuration file (required for load_data)')
+    subparser.add_argument('--max-items', type=int, default=5000,
+                           help='the number of items to read to measure the throughput')
+    subparser.add_argument('--output', metavar='FILE', default=None,
+                           help='the output JSON file (default: standard output)')
+    add_dataset_args(subparser)
+    args = parser.parse_args()
+
+    dataset_kwargs = dict(num_styles=args.num_styles, segments_per_song=args.segments_per_song,
+                          num_templates=args.num_templates,
+                          bars_per_segment=args.bars_per_segment,
+                          compact=(args.format == 'compact'), seed=args.seed)
+    if args.command == 'generate':
+        num_entries = write_dataset(args.output_dir, args.num_entries, **dataset_kwargs)
+        _LOGGER.info(f'Wrote {num_entries} entries to {args.output_dir}')
+        return
+
+    if 'load_data' in args.targets and not args.config:
+        parser.error('--config is required for load_data')
+
+    results = []
+    for size in args.sizes:
+        path = os.path.join(args.data_dir, f'{args.format}_{size}')
+        if not os.path.exists(os.path.join(path, 'key_pairs.tsv')):
+            _LOGGER.info(f'Writing a dataset of {size} entries to {path}')
+            start_time = time.perf_counter()
+            write_dataset(path, size, **dataset_kwargs)
+            _LOGGER.info(f'Done in {time.perf_counter() - start_time:.1f} s')
+
+        for target in args.targets:
+            _LOGGER.info(f'Measuring {target} on {size} entries')
+            result = run_measurement(target, path, args.max_items, config_path=args.config)
+            results.append({'size': size, 'target': target, **result})
+
+    write_report(make_report(args, results=results), args.output)
+
+
+if __name__ == '__main__':
+    coloredlogs.install(level='INFO', logger=logging.root, isatty=True)
+    main()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""Measure the speed, memory usage and round-trip fidelity of the encodings.
+
+Synthetic sequences at 60 BPM (the tempo that the models normalize to) are generated with a
+configurable length, density, polyphony and amount of drums, and split into one segment per
+instrument, as done when training the models. Each encoding (with the settings used in
+`experiments`) encodes and decodes the segments one by one, and in batches if it supports it.
+
+For each operation, the run time, the throughput in notes and in tokens per second (piano roll
+frames count as tokens) and the peak memory allocated while running it (measured separately
+using `tracemalloc`) are reported. Decoded segments are compared to the quantized input notes,
+and piano rolls are compared to the ones computed by museflow. The results are written as JSON
+(see `groove2groove.benchmarks.report`).
+"""
+import argparse
+import functools
+import logging
+import timeit
+import tracemalloc
+import warnings
+from collections import Counter
+
+import coloredlogs
+import numpy as np
+from museflow import encodings as museflow_encodings
+
+from groove2groove.beat_duration_encoding import BeatDurationEncoding
+from groove2groove.beat_relative_encoding import BeatRelativeEncoding
+from groove2groove.benchmarks.report import make_report, write_report
+from groove2groove.benchmarks.synthetic import DEFAULT_INSTRUMENTS, make_chord_sequence
+from groove2groove.encodings import PerformanceEncoding, PianoRollEncoding
+from groove2groove.note_sequence_utils import partition_sequence
+
+_LOGGER = logging.getLogger(__name__)
+
+ENCODINGS = {
+    'beat_relative': functools.partial(BeatRelativeEncoding, units_per_beat=12,
+                                       velocity_unit=16, use_velocity=True,
+                                       use_all_off_event=True, use_drum_events=True),
+    'beat_duration': functools.partial(BeatDurationEncoding, units_per_beat=12, velocity_unit=16,
+                                       use_velocity=True, use_drum_events=True),
+    'performance': functools.partial(PerformanceEncoding, time_unit=1 / 12, velocity_unit=16,
+                                     use_velocity=True, use_all_off_event=True,
+                                     use_drum_events=True, use_magenta=True),
+    'piano_roll': functools.partial(PianoRollEncoding, sampling_frequency=4, normalize=True),
+}
+
+INSTRUMENT_FILTERS = {name: dict(instrument_re=f'^{name}$') for name, _, _ in DEFAULT_INSTRUMENTS}
+
+
+def make_segments(rng, num_sequences, **kwargs):
+    """Create synthetic sequences and split them into non-empty segments, one per instrument.
+
+    Args:
+        rng: A `numpy.random.RandomState`.
+        num_sequences: The number of sequences.
+        **kwargs: Keyword arguments for `make_chord_sequence`.
+    """
+    segments = []
+    for _ in range(num_sequences):
+        sequence = make_chord_sequence(rng, qpm=60., **kwargs)
+        segments.extend(segment for segment in
+                        partition_sequence(sequence, INSTRUMENT_FILTERS).values()
+                        if segment.notes)
+    return segments
+
+
+def benchmark_encoding(encoding, segments, batch_size, repeat):
+    """Time the operations supported by an encoding and check its results.
+
+    Returns:
+        A dictionary with the statistics of each operation under `'operations'`, and the results
+        of the checks under `'fidelity'`.
+    """
+    batches = [segments[i:i + batch_size] for i in range(0, len(segments), batch_size)]
+    encoded = [encoding.encode(segment) for segment in segments]
+    num_notes = sum(len(segment.notes) for segment in segments)
+    num_tokens = sum(np.shape(x)[-1] for x in encoded)
+
+    operations = {'encode': functools.partial(_run_all, encoding.encode, segments)}
+    if hasattr(encoding, 'encode_batch'):
+        operations['encode_batch'] = functools.partial(_run_all, encoding.encode_batch, batches)
+    if hasattr(encoding, 'decode'):
+        operations['decode'] = functools.partial(_run_all, encoding.decode, encoded)
+    if hasattr(encoding, 'decode_batch'):
+        padded = [encoding.encode_batch(batch)[0] for batch in batches]
+        operations['decode_batch'] = functools.partial(_run_all, encoding.decode_batch, padded)
+
+    results = {'num_segments': len(segments), 'num_notes': num_notes, 'num_tokens': num_tokens,
+               'operations': {}}
+    for name, fn in operations.items():
+        seconds = min(timeit.repeat(fn, number=1, repeat=repeat))
+        results['operations'][name] = {
+            'seconds': seconds,
+            'notes_per_second': num_notes / seconds,
+            'tokens_per_second': num_tokens / seconds,
+            'peak_memory_bytes': _measure_peak_memory(fn),
+        }
+
+    if hasattr(encoding, 'decode'):
+        results['fidelity'] = _compare_notes(encoding, segments,
+                                             [encoding.decode(x) for x in encoded])
+    elif isinstance(encoding, museflow_encodings.PianoRollEncoding):
+        results['fidelity'] = {'matches_museflow': all(
+            np.array_equal(roll, museflow_encodings.PianoRollEncoding.encode(encoding, segment))
+            for roll, segment in zip(encoded, segments))}
+    return results
+
+
+def _run_all(fn, inputs):
+    return [fn(x) for x in inputs]
+
+
+def _measure_peak_memory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _compare_notes(encoding, segments, decoded):
+    """Compute the fraction of the input notes found in the decoded segments.
+
+    Notes are compared after quantizing them the way the encoding does. `'onsets'` only takes the
+    pitch and the start time into account, `'notes'` also the end time and the velocity.
+    """
+    if isinstance(encoding, (BeatRelativeEncoding, BeatDurationEncoding)):
+        step = 1 / encoding._units_per_beat
+    else:
+        step = encoding._time_unit
+    velocity_unit = encoding._velocity_unit if encoding._use_velocity else None
+    max_duration = getattr(encoding, '_max_duration_units', None)
+
+    num_notes = num_onsets_found = num_notes_found = 0
+    for segment, result in zip(segments, decoded):
+        expected = _quantize_notes(segment.notes, step, velocity_unit, max_duration)
+        actual = _quantize_notes(result.notes, step, velocity_unit, max_duration)
+        num_notes += len(expected)
+        num_notes_found += sum((Counter(expected) & Counter(actual)).values())
+        num_onsets_found += sum((Counter(n[:2] for n in expected) &
+                                 Counter(n[:2] for n in actual)).values())
+    return {'onsets': num_onsets_found / max(num_notes, 1),
+            'notes': num_notes_found / max(num_notes, 1)}
+
+
+def _quantize_notes(notes, step, velocity_unit, max_duration):
+    results = []
+    for note in notes:
+        onset = int(note.start_time / step + 0.5)
+        offset = int(note.end_time / step + 0.5)
+        if max_duration is not None:
+            offset = onset + min(max(offset - onset, 1), max_duration)
+        velocity = note.velocity // velocity_unit if velocity_unit else None
+        results.append((note.pitch, onset, offset, velocity))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--encodings', nargs='+', choices=list(ENCODINGS),
+                        default=list(ENCODINGS), help='the encodings to benchmark')
+    parser.add_argument('--num-sequences', type=int, default=100)
+    parser.add_argument('--num-beats', type=int, default=32,
+                        help='the length of the sequences')
+    parser.add_argument('--onsets-per-beat', type=float, default=2.,
+                        help='the average number of onsets per beat (density)')
+    parser.add_argument('--polyphony', type=int, default=3,
+                        help='the average number of notes in a chord')
+    parser.add_argument('--drum-ratio', type=float, default=0.25,
+                        help='the probability that an onset is a drum hit')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--min-fidelity', type=float, default=1.,
+                        help='the minimum fraction of onsets to recover by decoding')
+    parser.add_argument('--output', metavar='FILE', default=None,
+                        help='the output JSON file (default: standard output)')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    segments = make_segments(rng, args.num_sequences, num_beats=args.num_beats,
+                             onsets_per_beat=args.onsets_per_beat, polyphony=args.polyphony,
+                             drum_ratio=args.drum_ratio)
+
+    report = make_report(args, encodings={})
+    failures = []
+    for name in args.encodings:
+        _LOGGER.info(f'Benchmarking {name}')
+        encoding = ENCODINGS[name]()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            results = benchmark_encoding(encoding, segments, args.batch_size, args.repeat)
+        report['encodings'][name] = results
+
+        fidelity = results.get('fidelity', {})
+        if fidelity.get('onsets', 1.) < args.min_fidelity or not fidelity.get('matches_museflow',
+                                                                              True):
+            failures.append(name)
+
+    write_report(report, args.output)
+
+    if failures:
+        raise AssertionError(f'Round trip check failed for: {", ".join(failures)}')
+
+
+if __name__ == '__main__':
+    coloredlogs.install(level='INFO', logger=logging.root, isatty=True)
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Measure the inference speed of a model with randomly initialized weights.
+
+The model is built from a configuration file (e.g. `experiments/v01/model.yaml`) without loading
+a checkpoint, so that inference can be benchmarked without the trained models, e.g. on a CPU-only
+machine. Synthetic source and style sequences are run through a `NoteSequencePipeline` (as in
+`run-midi`) for every combination of the batch size, the number of source segments and the
+maximum decoding length (an untrained decoder rarely stops before reaching it). The stages of
+`Experiment.run` are timed separately:
+
+- `data_prep`: splitting the inputs and encoding them into padded batches,
+- `session_run`: running the model on the batches,
+- `decoding`: decoding the output token IDs into `NoteSequence`s.
+
+The results are written as JSON (see `groove2groove.benchmarks.report`).
+"""
+import argparse
+import logging
+import tempfile
+import time
+
+import coloredlogs
+import numpy as np
+import tensorflow as tf
+from confugue import Configuration
+
+from groove2groove.benchmarks.report import make_report, write_report
+from groove2groove.benchmarks.synthetic import make_chord_sequence
+from groove2groove.encodings import trim_padding
+from groove2groove.io import NoteSequencePipeline
+from groove2groove.models.common import make_batched_dataset
+from groove2groove.models.roll2seq_style_transfer import Experiment
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def make_pipeline(rng, num_segments, bars_per_segment, **kwargs):
+    """Create a `NoteSequencePipeline` with synthetic inputs.
+
+    The source sequence is split into `num_segments` segments, the style sequence is as long as
+    one segment.
+
+    Args:
+        rng: A `numpy.random.RandomState`.
+        num_segments: The number of source segments.
+        bars_per_segment: The number of bars (of 4 beats) per segment.
+        **kwargs: Keyword arguments for `make_chord_sequence`.
+    """
+    beats_per_segment = 4 * bars_per_segment
+    source_seq = make_chord_sequence(rng, num_beats=num_segments * beats_per_segment, **kwargs)
+    style_seq = make_chord_sequence(rng, num_beats=beats_per_segment, **kwargs)
+    return NoteSequencePipeline(source_seq, style_seq, bars_per_segment=bars_per_segment,
+                                warp=True)
+
+
+def build_experiment(config_path, logdir, max_length, sample=False):
+    """Build an `Experiment` in a new graph and initialize its variables randomly."""
+    with open(config_path, 'rb') as f:
+        config = Configuration.from_yaml(f)
+    config['model']['decoder']['max_length'] = max_length
+
+    with tf.Graph().as_default():
+        experiment = config.configure(Experiment, logdir=logdir, train_mode=False,
+                                      decoder_modes=('sample' if sample else 'greedy',))
+        experiment.trainer.session.run(tf.global_variables_initializer())
+    return experiment
+
+
+def benchmark_run(experiment, pipeline, batch_size, filters='program', sample=False):
+    """Run the model on the inputs of a pipeline like `Experiment.run`, timing each stage.
+
+    Returns:
+        A dictionary with the timings (in seconds) and the sizes of the inputs and outputs.
+    """
+    start_time = time.perf_counter()
+    apply_filters = '__program__' if filters == 'program' else True
+    batches = list(experiment._load_data(pipeline, apply_filters=apply_filters,
+                                         metadata_list=[], batch_size=batch_size)())
+    data_prep_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    with experiment.trainer.session.graph.as_default():
+        dataset = make_batched_dataset(lambda: iter(batches),
+                                       output_types=experiment.input_types,
+                                       output_shapes=experiment.input_shapes)
+        output_ids = experiment.model.run(experiment.trainer.session, dataset, sample) or []
+    session_run_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    sequences = experiment._decode_outputs(output_ids)
+    decoding_time = time.perf_counter() - start_time
+
+    pad_id = experiment.output_encoding.vocabulary.pad_id
+    num_examples = sum(len(batch[0]) for batch in batches)
+    num_output_tokens = sum(len(trim_padding(np.asarray(ids), pad_id)) for ids in output_ids)
+    total_time = data_prep_time + session_run_time + decoding_time
+    return {
+        'num_examples': num_examples,
+        'num_batches': len(batches),
+        'num_output_tokens': num_output_tokens,
+        'num_output_notes': sum(len(sequence.notes) for sequence in sequences),
+        'data_prep_seconds': data_prep_time,
+        'session_run_seconds': session_run_time,
+        'decoding_seconds': decoding_time,
+        'total_seconds': total_time,
+        'examples_per_second': num_examples / total_time,
+        'output_tokens_per_second': num_output_tokens / session_run_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('config', metavar='YAML-FILE', help='the model configuration file')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--num-segments', type=int, nargs='+', default=[4, 16],
+                        help='the numbers of source segments to try')
+    parser.add_argument('--max-lengths', type=int, nargs='+', default=[100, 500],
+                        help='the maximum decoding lengths to try')
+    parser.add_argument('--bars-per-segment', type=int, default=8)
+    parser.add_argument('--onsets-per-beat', type=float, default=2.)
+    parser.add_argument('--polyphony', type=int, default=3)
+    parser.add_argument('--drum-ratio', type=float, default=0.25)
+    parser.add_argument('--filters', choices=['training', 'program'], default='program',
+                        help='how to filter the input, as in the run-* commands')
+    parser.add_argument('--sample', action='store_true')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='the number of runs per setting; the fastest one is reported')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', metavar='FILE', default=None,
+                        help='the output JSON file (default: standard output)')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    pipelines = {num_segments: make_pipeline(rng, num_segments, args.bars_per_segment,
+                                             onsets_per_beat=args.onsets_per_beat,
+                                             polyphony=args.polyphony,
+                                             drum_ratio=args.drum_ratio)
+                 for num_segments in args.num_segments}
+
+    results = []
+    with tempfile.TemporaryDirectory() as logdir:
+        for max_length in args.max_lengths:
+            _LOGGER.info(f'Building the model with max_length={max_length}')
+            experiment = build_experiment(args.config, logdir, max_length, sample=args.sample)
+
+            # Warm up (the first session run is slower)
+            benchmark_run(experiment, pipelines[args.num_segments[0]], args.batch_sizes[0],
+                          filters=args.filters, sample=args.sample)
+
+            for num_segments, pipeline in pipelines.items():
+                for batch_size in args.batch_sizes:
+                    _LOGGER.info(f'Running: num_segments={num_segments}, '
+                                 f'batch_size={batch_size}')
+                    result = min((benchmark_run(experiment, pipeline, batch_size,
+                                                filters=args.filters, sample=args.sample)
+                                  for _ in range(args.repeat)),
+                                 key=lambda r: r['total_seconds'])
+                    results.append({'max_length': max_length, 'num_segments': num_segments,
+                                    'batch_size': batch_size, **result})
+            experiment.trainer.session.close()
+
+    write_report(make_report(args, results=results), args.output)
+
+
+if __name__ == '__main__':
+    coloredlogs.install(level='INFO', logger=logging.root, isatty=True)
+    logging.getLogger('tensorflow').handlers.clear()
+    main()
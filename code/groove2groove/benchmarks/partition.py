@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Compare `partition_sequence` to copying and filtering the sequence once per filter.
+
+Both ways of splitting a sequence are applied to a set of synthetic sequences, with the named
+filters from a model configuration (or a default set) and with one filter per program. The results
+are checked to be identical and the run times are printed.
+"""
+import argparse
+import functools
+import timeit
+
+import numpy as np
+from confugue import Configuration
+from museflow.note_sequence_utils import filter_sequence
+from note_seq.protobuf import music_pb2
+
+from groove2groove.benchmarks.synthetic import DEFAULT_INSTRUMENTS, make_sequence
+from groove2groove.note_sequence_utils import partition_sequence
+
+DEFAULT_FILTERS = {name.split()[-1]: dict(instrument_re=f'^{name}$')
+                   for name, _, _ in DEFAULT_INSTRUMENTS}
+
+
+def filter_each(sequence, note_filters=None):
+    """Split a sequence the way `Experiment._load_data` used to, for comparison."""
+    if note_filters is None:
+        programs = sorted(set((n.program, n.is_drum) for n in sequence.notes))
+        note_filters = {f'program{p}' + ('d' if d else ''): dict(programs=[p], drums=d)
+                        for p, d in programs}
+
+    results = {}
+    for name, filter_kwargs in note_filters.items():
+        filtered = music_pb2.NoteSequence()
+        filtered.CopyFrom(sequence)
+        filter_sequence(filtered, **filter_kwargs)
+        results[name] = filtered
+    return results
+
+
+def _split_all(fn, sequences, note_filters):
+    return [fn(sequence, note_filters) for sequence in sequences]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--config', metavar='YAML-FILE', default=None,
+                        help='a model configuration file to take the style note filters from')
+    parser.add_argument('--num-sequences', type=int, default=200)
+    parser.add_argument('--num-notes', type=int, default=400)
+    parser.add_argument('--num-control-changes', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    note_filters = DEFAULT_FILTERS
+    if args.config:
+        with open(args.config, 'rb') as f:
+            note_filters = Configuration.from_yaml(f).get('style_note_filters')
+
+    rng = np.random.RandomState(args.seed)
+    sequences = [make_sequence(rng, num_notes=args.num_notes,
+                               num_control_changes=args.num_control_changes)
+                 for _ in range(args.num_sequences)]
+
+    for mode, filters in [('named filters', note_filters), ('program filters', None)]:
+        for sequence in sequences:
+            if partition_sequence(sequence, filters) != filter_each(sequence, filters):
+                raise AssertionError(f'Results differ ({mode})')
+
+        times = {}
+        for fn in [filter_each, partition_sequence]:
+            times[fn.__name__] = min(timeit.repeat(
+                functools.partial(_split_all, fn, sequences, filters),
+                number=1, repeat=args.repeat)) / len(sequences)
+        print(f'{mode}: ' +
+              ', '.join(f'{name} {t * 1e3:.3f} ms/sequence' for name, t in times.items()) +
+              f'; speedup {times["filter_each"] / times["partition_sequence"]:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""Writing benchmark results as JSON, so that they can be compared across commits."""
+import json
+import platform
+import subprocess
+import sys
+
+import numpy as np
+
+
+def make_report(args, **results):
+    """Create a report dictionary with information about the environment.
+
+    Args:
+        args: The parsed command line arguments of the benchmark.
+        **results: The results to include in the report.
+    """
+    return {
+        'revision': _get_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'args': vars(args),
+        **results,
+    }
+
+
+def write_report(report, path=None):
+    """Write a report to the given JSON file, or to the standard output if `path` is `None`."""
+    if path:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+def _get_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, check=True,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
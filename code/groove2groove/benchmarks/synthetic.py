@@ -0,0 +1,113 @@
+"""Generating synthetic `NoteSequence`s for benchmarking."""
+import numpy as np
+from note_seq.protobuf import music_pb2
+
+DEFAULT_INSTRUMENTS = [
+    ('BB Bass', 33, False),
+    ('BB Piano', 0, False),
+    ('BB Guitar', 25, False),
+    ('BB Strings', 48, False),
+    ('BB Drums', 0, True),
+]
+
+
+def make_sequence(rng, num_notes=400, num_beats=32, qpm=120., instruments=None,
+                  num_control_changes=0):
+    """Create a random `NoteSequence`.
+
+    The note onsets are random (but quantized to 1/12 of a beat) and spread over the given number
+    of beats, and the notes are distributed randomly between the instruments.
+
+    Args:
+        rng: A `numpy.random.RandomState`.
+        num_notes: The number of notes.
+        num_beats: The length of the sequence in beats.
+        qpm: The tempo.
+        instruments: A list of tuples `(name, program, is_drum)`. Defaults to
+            `DEFAULT_INSTRUMENTS`.
+        num_control_changes: The number of control changes per instrument.
+    """
+    if instruments is None:
+        instruments = DEFAULT_INSTRUMENTS
+    beat_duration = 60. / qpm
+
+    sequence = music_pb2.NoteSequence()
+    sequence.ticks_per_quarter = 480
+    sequence.tempos.add(qpm=qpm)
+    sequence.time_signatures.add(numerator=4, denominator=4)
+    sequence.total_time = num_beats * beat_duration
+    for i, (name, program, is_drum) in enumerate(instruments):
+        sequence.instrument_infos.add(instrument=i, name=name)
+        for time in np.sort(rng.randint(0, num_beats * 12, size=num_control_changes)):
+            sequence.control_changes.add(time=time * beat_duration / 12, control_number=7,
+                                         control_value=rng.randint(128), instrument=i,
+                                         program=program, is_drum=is_drum)
+
+    onsets = np.sort(rng.randint(0, num_beats * 12, size=num_notes)) / 12
+    durations = rng.randint(1, 13, size=num_notes) / 12
+    instrument_ids = rng.randint(len(instruments), size=num_notes)
+    for onset, duration, i in zip(onsets, durations, instrument_ids):
+        _, program, is_drum = instruments[i]
+        sequence.notes.add(
+            pitch=rng.randint(35, 82) if is_drum else rng.randint(28, 97),
+            velocity=rng.randint(1, 128),
+            start_time=onset * beat_duration,
+            end_time=min(onset + duration, num_beats) * beat_duration,
+            instrument=i, program=program, is_drum=is_drum)
+    return sequence
+
+
+def make_chord_sequence(rng, num_beats=32, onsets_per_beat=2., polyphony=3, drum_ratio=0.25,
+                        qpm=120., instruments=None):
+    """Create a random `NoteSequence` consisting of chords and drum hits.
+
+    The onsets are quantized to 1/12 of a beat. Each onset is either a drum hit (with probability
+    `drum_ratio`) or a chord played by one of the other instruments. Chords consist of between 1
+    and `2 * polyphony - 1` notes (`polyphony` on average) with distinct pitches, and drum hits of
+    between 1 and `polyphony` notes.
+
+    Args:
+        rng: A `numpy.random.RandomState`.
+        num_beats: The length of the sequence in beats.
+        onsets_per_beat: The average number of onsets per beat.
+        polyphony: The average number of notes in a chord.
+        drum_ratio: The probability that an onset is a drum hit.
+        qpm: The tempo.
+        instruments: A list of tuples `(name, program, is_drum)`. Defaults to
+            `DEFAULT_INSTRUMENTS`.
+    """
+    if instruments is None:
+        instruments = DEFAULT_INSTRUMENTS
+    beat_duration = 60. / qpm
+    drum_ids = [i for i, (_, _, is_drum) in enumerate(instruments) if is_drum]
+    pitched_ids = [i for i, (_, _, is_drum) in enumerate(instruments) if not is_drum]
+
+    sequence = music_pb2.NoteSequence()
+    sequence.ticks_per_quarter = 480
+    sequence.tempos.add(qpm=qpm)
+    sequence.time_signatures.add(numerator=4, denominator=4)
+    sequence.total_time = num_beats * beat_duration
+    for i, (name, _, _) in enumerate(instruments):
+        sequence.instrument_infos.add(instrument=i, name=name)
+
+    num_onsets = rng.poisson(num_beats * onsets_per_beat)
+    for onset in np.sort(rng.randint(0, num_beats * 12, size=num_onsets)) / 12:
+        is_drum = bool(drum_ids) and (not pitched_ids or rng.rand() < drum_ratio)
+        i = int(rng.choice(drum_ids if is_drum else pitched_ids))
+        _, program, _ = instruments[i]
+        if is_drum:
+            pitches = rng.choice(np.arange(35, 82), size=rng.randint(1, polyphony + 1),
+                                 replace=False)
+            duration = 1 / 12
+        else:
+            pitches = rng.choice(np.arange(28, 97), size=rng.randint(1, 2 * polyphony),
+                                 replace=False)
+            duration = rng.randint(1, 25) / 12
+        velocity = rng.randint(1, 128)
+        for pitch in pitches:
+            sequence.notes.add(
+                pitch=int(pitch), velocity=velocity,
+                start_time=onset * beat_duration,
+                end_time=min(onset + duration, num_beats) * beat_duration,
+                instrument=i, program=program, is_drum=is_drum)
+    return sequence
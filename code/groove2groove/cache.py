@@ -0,0 +1,136 @@
+"""A cache for parsed sequences and values derived from them."""
+import collections
+import logging
+import sys
+
+import numpy as np
+from note_seq.protobuf import music_pb2
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class SequenceCache:
+    """A least-recently-used cache of parsed sequences and values derived from them.
+
+    Each entry holds a sequence loaded from a database, together with the values derived from it
+    (e.g. filtered and encoded versions), which are evicted with it. The size of an entry is
+    estimated from the serialized size of the sequences and the size of the arrays it holds.
+
+    The cached objects are shared between all users of the cache, so they must not be modified.
+
+    Args:
+        max_bytes: The maximum total size of the cached entries.
+        name: A name to use when logging the statistics.
+    """
+
+    def __init__(self, max_bytes, name='Sequence cache'):
+        self._max_bytes = max_bytes
+        self._name = name
+        self._entries = collections.OrderedDict()
+        self._keys_by_id = {}
+        self._size = 0
+        self._stats = collections.Counter()
+
+    def get_sequence(self, key, load_fn):
+        """Return the sequence with the given key, calling `load_fn` to load it if not cached.
+
+        Args:
+            key: A hashable key, unique among all the databases the cache is used with.
+            load_fn: A function returning the sequence (or `None`, which is not cached).
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            self._stats['sequence_hits'] += 1
+            return entry.sequence
+
+        self._stats['sequence_misses'] += 1
+        sequence = load_fn()
+        if sequence is not None:
+            entry = _CacheEntry(sequence=sequence, derived={}, size=_get_size(sequence))
+            self._entries[key] = entry
+            self._keys_by_id[id(sequence)] = key
+            self._size += entry.size
+            self._evict()
+        return sequence
+
+    def get_derived(self, sequence, name, compute_fn):
+        """Return a value derived from a sequence, calling `compute_fn` to compute it if not cached.
+
+        Values are only cached for sequences currently held by the cache (i.e. returned by
+        `get_sequence` and not evicted); for other sequences, the value is always computed.
+
+        Args:
+            sequence: The sequence the value is derived from.
+            name: A hashable name of the value, unique among the values derived from a sequence.
+            compute_fn: A function computing the value.
+        """
+        key = self._keys_by_id.get(id(sequence))
+        entry = self._entries.get(key) if key is not None else None
+        if entry is None or entry.sequence is not sequence:
+            return compute_fn()
+
+        self._entries.move_to_end(key)
+        if name in entry.derived:
+            self._stats['derived_hits'] += 1
+            return entry.derived[name]
+
+        self._stats['derived_misses'] += 1
+        value = compute_fn()
+        entry.derived[name] = value
+        size = _get_size(value)
+        entry.size += size
+        self._size += size
+        self._evict()
+        return value
+
+    def log_stats(self, reset=True):
+        """Log the hit rates and the size of the cache."""
+        def format_rate(kind):
+            hits, misses = self._stats[kind + '_hits'], self._stats[kind + '_misses']
+            rate = hits / (hits + misses) if hits + misses else 0.
+            return f'{hits}/{hits + misses} {kind} hits ({rate:.1%})'
+
+        _LOGGER.info(f'{self._name}: {format_rate("sequence")}, {format_rate("derived")}; '
+                     f'{len(self._entries)} entries, {self._size / 2**20:.1f} MiB')
+        if reset:
+            self._stats.clear()
+
+    def __getstate__(self):
+        # The entries are looked up by the IDs of the sequences, which are only valid in this
+        # process, so a pickled cache (e.g. sent to another process) starts empty
+        state = dict(self.__dict__)
+        state.update(_entries=collections.OrderedDict(), _keys_by_id={}, _size=0,
+                     _stats=collections.Counter())
+        return state
+
+    def _evict(self):
+        while self._size > self._max_bytes and self._entries:
+            key, entry = self._entries.popitem(last=False)
+            del self._keys_by_id[id(entry.sequence)]
+            self._size -= entry.size
+
+
+class _CacheEntry:
+
+    def __init__(self, sequence, derived, size):
+        self.sequence = sequence
+        self.derived = derived
+        self.size = size
+
+
+def _get_size(value):
+    if value is None:
+        return 0
+    if isinstance(value, music_pb2.NoteSequence):
+        return value.ByteSize()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(_get_size(v) for v in value.values())
+    if isinstance(value, tuple):
+        return sum(_get_size(v) for v in value)
+    if isinstance(value, list):
+        # getsizeof only counts the array of pointers, not the items (e.g. the token IDs)
+        return sys.getsizeof(value) + sum(_get_size(v) for v in value)
+    return sys.getsizeof(value)
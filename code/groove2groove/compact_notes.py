@@ -0,0 +1,174 @@
+"""A compact binary format for storing note sequences in LMDB databases.
+
+A value in this format consists of:
+
+- the magic bytes `b'G2GN'` and a format version (`uint16`), followed by the header counts,
+- a table of tempos, time signatures and key signatures,
+- a table of instruments (ID and name),
+- the filename and the ID of the sequence,
+- the notes, as an array of fixed-width records with dtype `NOTE_DTYPE` (see `note_array`).
+
+All sections are aligned to 8 bytes, so the notes can be read with `np.frombuffer` directly from
+the LMDB memory map (when opening a transaction with `buffers=True`), without parsing or copying.
+
+Only the parts of a `NoteSequence` used by the models are stored: control changes, pitch bends,
+text annotations and other metadata are dropped. A serialized `NoteSequence` can never start with
+the magic bytes, so the two formats can be mixed and are told apart using `is_compact`.
+"""
+import struct
+
+import numpy as np
+from note_seq.protobuf import music_pb2
+
+from groove2groove.note_array import NOTE_DTYPE, NoteArray
+
+MAGIC = b'G2GN'
+VERSION = 1
+
+_HEADER = struct.Struct('<4sHxxdi8I')
+_TEMPO_DTYPE = np.dtype([('time', '<f8'), ('qpm', '<f8')])
+_TIME_SIGNATURE_DTYPE = np.dtype([('time', '<f8'), ('numerator', '<i4'), ('denominator', '<i4')])
+_KEY_SIGNATURE_DTYPE = np.dtype([('time', '<f8'), ('key', '<i4'), ('mode', '<i4')])
+_INSTRUMENT_DTYPE = np.dtype([('instrument', '<i4'), ('name_length', '<u4')])
+_NOTE_DTYPE = NOTE_DTYPE.newbyteorder('<')
+_DROPPED_FIELDS = ['control_changes', 'pitch_bends', 'text_annotations']
+
+
+class CompactSequence:
+    """A sequence in the compact format, read without copying.
+
+    Attributes:
+        notes: A `NoteArray` backed by the buffer that the sequence was read from.
+        tempos, time_signatures, key_signatures: Structured arrays.
+        instruments: A dictionary mapping instrument IDs to names.
+        total_time, ticks_per_quarter, filename, id: The corresponding `NoteSequence` fields.
+    """
+
+    def __init__(self, buffer):
+        (magic, version, self.total_time, self.ticks_per_quarter, num_tempos,
+         num_time_signatures, num_key_signatures, num_instruments, names_length,
+         filename_length, id_length, num_notes) = _HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ValueError('Not a sequence in the compact format')
+        if version != VERSION:
+            raise ValueError(f'Unsupported compact format version {version}')
+
+        offset = _HEADER.size + _get_padding(_HEADER.size)
+        self.tempos, offset = _read_array(buffer, _TEMPO_DTYPE, num_tempos, offset)
+        self.time_signatures, offset = _read_array(buffer, _TIME_SIGNATURE_DTYPE,
+                                                   num_time_signatures, offset)
+        self.key_signatures, offset = _read_array(buffer, _KEY_SIGNATURE_DTYPE,
+                                                  num_key_signatures, offset)
+        instruments, offset = _read_array(buffer, _INSTRUMENT_DTYPE, num_instruments, offset)
+        names, offset = _read_bytes(buffer, names_length, offset)
+        self.filename, offset = _read_string(buffer, filename_length, offset)
+        self.id, offset = _read_string(buffer, id_length, offset)
+        notes, offset = _read_array(buffer, _NOTE_DTYPE, num_notes, offset)
+        self.notes = NoteArray(notes)
+
+        self.instruments = {}
+        name_offset = 0
+        for instrument, name_length in instruments.tolist():
+            self.instruments[instrument] = names[name_offset:name_offset + name_length].decode()
+            name_offset += name_length
+
+    def to_sequence(self):
+        """Convert the sequence to a `NoteSequence`."""
+        sequence = music_pb2.NoteSequence(filename=self.filename, id=self.id,
+                                          total_time=self.total_time,
+                                          ticks_per_quarter=self.ticks_per_quarter)
+        for time, qpm in self.tempos.tolist():
+            sequence.tempos.add(time=time, qpm=qpm)
+        for time, numerator, denominator in self.time_signatures.tolist():
+            sequence.time_signatures.add(time=time, numerator=numerator, denominator=denominator)
+        for time, key, mode in self.key_signatures.tolist():
+            sequence.key_signatures.add(time=time, key=key, mode=mode)
+        for instrument, name in self.instruments.items():
+            sequence.instrument_infos.add(instrument=instrument, name=name)
+        return self.notes.to_sequence(sequence)
+
+
+def is_compact(value):
+    """Check whether a database value is in the compact format."""
+    return value is not None and bytes(value[:len(MAGIC)]) == MAGIC
+
+
+def to_compact(sequence):
+    """Serialize a `NoteSequence` in the compact format.
+
+    Returns:
+        A tuple `(value, dropped)` where `value` are the serialized bytes and `dropped` is `True`
+        if some content of the sequence could not be stored (e.g. control changes).
+    """
+    names = [info.name.encode() for info in sequence.instrument_infos]
+    filename, seq_id = sequence.filename.encode(), sequence.id.encode()
+    header = _HEADER.pack(MAGIC, VERSION, sequence.total_time, sequence.ticks_per_quarter,
+                          len(sequence.tempos), len(sequence.time_signatures),
+                          len(sequence.key_signatures), len(sequence.instrument_infos),
+                          sum(len(name) for name in names), len(filename), len(seq_id),
+                          len(sequence.notes))
+
+    sections = [
+        header,
+        np.array([(t.time, t.qpm) for t in sequence.tempos], dtype=_TEMPO_DTYPE),
+        np.array([(t.time, t.numerator, t.denominator) for t in sequence.time_signatures],
+                 dtype=_TIME_SIGNATURE_DTYPE),
+        np.array([(k.time, k.key, k.mode) for k in sequence.key_signatures],
+                 dtype=_KEY_SIGNATURE_DTYPE),
+        np.array([(info.instrument, len(name))
+                  for info, name in zip(sequence.instrument_infos, names)],
+                 dtype=_INSTRUMENT_DTYPE),
+        b''.join(names),
+        filename,
+        seq_id,
+        NoteArray.from_sequence(sequence).notes.astype(_NOTE_DTYPE),
+    ]
+    chunks = []
+    for section in sections:
+        data = section.tobytes() if isinstance(section, np.ndarray) else section
+        chunks.append(data)
+        chunks.append(b'\0' * _get_padding(len(data)))
+
+    dropped = any(len(getattr(sequence, field)) > 0 for field in _DROPPED_FIELDS)
+    return b''.join(chunks), dropped
+
+
+def read_compact(value):
+    """Read a value in the compact format as a `CompactSequence`, without copying."""
+    return CompactSequence(value)
+
+
+def load_sequence(value):
+    """Deserialize a `NoteSequence` stored either in the compact format or as a protobuf."""
+    if is_compact(value):
+        return CompactSequence(value).to_sequence()
+    return music_pb2.NoteSequence.FromString(value)
+
+
+def load_note_array(value):
+    """Load the notes of a sequence stored in either format as a `NoteArray`.
+
+    For the compact format, the array is backed by `value`, which must stay valid (e.g. the LMDB
+    transaction must stay open) while the array is used.
+    """
+    if is_compact(value):
+        return CompactSequence(value).notes
+    return NoteArray.from_sequence(music_pb2.NoteSequence.FromString(value))
+
+
+def _read_array(buffer, dtype, count, offset):
+    array = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+    return array, offset + array.nbytes + _get_padding(array.nbytes)
+
+
+def _read_bytes(buffer, length, offset):
+    return bytes(buffer[offset:offset + length]), offset + length + _get_padding(length)
+
+
+def _read_string(buffer, length, offset):
+    data, offset = _read_bytes(buffer, length, offset)
+    return data.decode(), offset
+
+
+def _get_padding(length):
+    return -length % 8
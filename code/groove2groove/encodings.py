@@ -0,0 +1,188 @@
+"""Utilities shared by the encodings, and encoding batches of sequences into padded arrays.
+
+Encodings with an `encode_batch` method take a list of `NoteSequence`s and return a tuple
+`(batch, lengths)`, where `batch` is a preallocated array with the encoded sequences, padded along
+the last axis, and `lengths` holds their unpadded lengths. This is the case for
+`BeatRelativeEncoding` and for the wrappers of the museflow encodings defined here, which can be
+used in place of the museflow classes in model configurations. `encode_batch` works with any
+encoding, falling back to encoding the sequences one by one.
+"""
+import warnings
+
+import numpy as np
+from museflow import encodings as museflow_encodings
+from museflow import note_sequence_utils
+from note_seq.protobuf import music_pb2
+
+from groove2groove.note_array import NoteArray
+
+
+def encode_batch(encoding, sequences, **kwargs):
+    """Encode a list of sequences using the `encode_batch` method of the encoding, if it has one.
+
+    Otherwise, the sequences are encoded one by one using `encode`, and padded with zeros.
+    Sequences which are `None` are encoded as empty sequences.
+
+    Args:
+        encoding: The encoding.
+        sequences: A list of `NoteSequence`s.
+        **kwargs: Keyword arguments for `encode` (e.g. `add_start`, `add_end`).
+
+    Returns:
+        A tuple `(batch, lengths)`. Token IDs are returned as `int32`.
+    """
+    if hasattr(encoding, 'encode_batch'):
+        return encoding.encode_batch(sequences, **kwargs)
+
+    encoded = [np.asarray(encoding.encode(sequence, **kwargs)) if sequence is not None
+               else np.zeros(0, dtype=np.int32) for sequence in sequences]
+    dtype = np.result_type(*encoded) if encoded else np.int32
+    return pad_batch(encoded, dtype=np.int32 if np.issubdtype(dtype, np.integer) else dtype)
+
+
+def pad_batch(arrays, pad_value=0, dtype=None, axis=-1):
+    """Stack arrays of different lengths into a single array.
+
+    Args:
+        arrays: A list of arrays with the same number of dimensions, and with the same shape except
+            along `axis`.
+        pad_value: The value to pad the arrays with.
+        dtype: The data type of the result. Defaults to the type of the first array.
+        axis: The axis to pad along.
+
+    Returns:
+        A tuple `(batch, lengths)` where `batch` has a new leading batch dimension and `lengths` is
+        an `int32` array with the sizes of the arrays along `axis`.
+    """
+    if not arrays:
+        return np.zeros((0, 0), dtype=dtype or np.int32), np.zeros(0, dtype=np.int32)
+
+    lengths = np.array([array.shape[axis] for array in arrays], dtype=np.int32)
+    shape = list(arrays[0].shape)
+    shape[axis] = lengths.max()
+    batch = np.full([len(arrays), *shape], pad_value, dtype=dtype or arrays[0].dtype)
+    for i, (array, length) in enumerate(zip(arrays, lengths)):
+        index = [i] + [slice(None)] * array.ndim
+        index[axis if axis < 0 else axis + 1] = slice(length)
+        batch[tuple(index)] = array
+    return batch, lengths
+
+
+def pad_token_batch(encoded, pad_id):
+    """Stack a list of token ID sequences into an `int32` matrix padded with `pad_id`."""
+    return pad_batch([np.asarray(ids, dtype=np.int32) for ids in encoded], pad_value=pad_id,
+                     dtype=np.int32)
+
+
+def get_normalized_notes(sequence):
+    """Return the notes of a sequence as a `NoteArray`, with the tempo normalized to 60 BPM.
+
+    The result is the same as with `museflow.note_sequence_utils.normalize_tempo`, which is used
+    whenever it would raise an exception (on notes with negative times or durations).
+    """
+    notes = NoteArray.from_sequence(sequence)
+    if np.any(notes.start_time < 0) or np.any(notes.end_time < notes.start_time):
+        return NoteArray.from_sequence(note_sequence_utils.normalize_tempo(sequence))
+
+    normalized = notes.normalize_tempo(sequence.tempos, sequence.total_time)
+    if len(normalized) < len(notes):
+        warnings.warn(f'{len(notes) - len(normalized)} notes skipped in '
+                      'adjust_notesequence_times', RuntimeWarning)
+    return normalized
+
+
+def get_ids(vocabulary, event, values):
+    """Return an array with the IDs of the tokens `(event, value)` for the given values."""
+    return np.array([vocabulary.to_id((event, value)) for value in values], dtype=np.int64)
+
+
+def to_id_array(vocabulary, tokens):
+    """Convert a list of tokens and/or token IDs to an array of IDs.
+
+    Raises:
+        RuntimeError: If a token or an ID is not in the vocabulary.
+    """
+    if isinstance(tokens, np.ndarray) and np.issubdtype(tokens.dtype, np.integer):
+        ids = tokens
+    else:
+        ids = np.array([token if isinstance(token, (int, np.integer))
+                        else _token_to_id(vocabulary, token) for token in tokens],
+                       dtype=np.int64)
+    invalid = (ids < 0) | (ids >= len(vocabulary))
+    if np.any(invalid):
+        raise RuntimeError(f'Invalid token: {ids[invalid][0]}')
+    return ids
+
+
+def trim_padding(ids, pad_id):
+    """Remove the padding from the end of an array of token IDs."""
+    content_positions = np.flatnonzero(ids != pad_id)
+    return ids[:content_positions[-1] + 1] if len(content_positions) else ids[:0]
+
+
+def _token_to_id(vocabulary, token):
+    try:
+        return vocabulary.to_id(token)
+    except (KeyError, TypeError):
+        raise RuntimeError(f'Invalid token: {token}') from None
+
+
+class PerformanceEncoding(museflow_encodings.PerformanceEncoding):
+    """`museflow.encodings.PerformanceEncoding` with an `encode_batch` method."""
+
+    def encode_batch(self, sequences, add_start=False, add_end=False):
+        return pad_token_batch(
+            [self.encode(sequence, add_start=add_start, add_end=add_end)
+             if sequence is not None else [] for sequence in sequences],
+            pad_id=self.vocabulary.pad_id)
+
+
+class PianoRollEncoding(museflow_encodings.PianoRollEncoding):
+    """`museflow.encodings.PianoRollEncoding` with a vectorized `encode` and `encode_batch`.
+
+    The piano rolls of all sequences in a batch are computed at once (without going through
+    `pretty_midi`) and are identical to the ones computed by museflow. Drum notes are ignored.
+    """
+
+    def encode(self, notes):
+        if not isinstance(notes, music_pb2.NoteSequence):
+            return super().encode(notes)
+        rolls, lengths = self.encode_batch([notes])
+        return rolls[0, :, :lengths[0]]
+
+    def encode_batch(self, sequences):
+        note_arrays = [NoteArray.from_sequence(sequence).filter(drums=False)
+                       if sequence is not None else NoteArray() for sequence in sequences]
+        if any(np.any(notes.start_time < 0) for notes in note_arrays):
+            # Negative times are handled in a peculiar way by pretty_midi, so leave them to it
+            return pad_batch([super(PianoRollEncoding, self).encode(sequence)
+                              if sequence is not None
+                              else np.zeros((self.num_rows, 0), dtype=self._dtype)
+                              for sequence in sequences], dtype=self._dtype)
+
+        notes = NoteArray(np.concatenate([n.notes for n in note_arrays] or [NoteArray().notes]))
+        sequence_ids = np.repeat(np.arange(len(note_arrays)), [len(n) for n in note_arrays])
+        starts = (notes.start_time * self._fs).astype(np.int64)
+        ends = (notes.end_time * self._fs).astype(np.int64)
+        lengths = np.zeros(len(note_arrays), dtype=np.int32)
+        np.maximum.at(lengths, sequence_ids, ends)
+        num_steps = lengths.max() if len(lengths) else 0
+
+        # Compute the rolls from their differences along the time axis: each note adds its
+        # velocity at its first step and subtracts it after its last step
+        valid = starts < ends
+        row_offsets = (sequence_ids * 128 + notes.pitch)[valid] * (num_steps + 1)
+        velocities = notes.velocity[valid].astype(np.float64)
+        size = len(note_arrays) * 128 * (num_steps + 1)
+        diffs = (np.bincount(row_offsets + starts[valid], weights=velocities, minlength=size)
+                 - np.bincount(row_offsets + ends[valid], weights=velocities, minlength=size))
+        rolls = np.cumsum(diffs.reshape(len(note_arrays), 128, num_steps + 1)[:, :, :-1], axis=-1,
+                          dtype=np.float64)
+        rolls = rolls[:, self._min_pitch:self._max_pitch + 1]
+
+        if self._binarize:
+            rolls = rolls > 1e-9
+        elif self._normalize:
+            rolls /= 127.
+
+        return rolls.astype(self._dtype), lengths
@@ -1,6 +1,8 @@
 import numpy as np
 from note_seq import midi_io
 
+from groove2groove.note_array import NoteArray
+
 _EPSILON = 1e-9
 
 
@@ -12,28 +14,34 @@ def extract_features(note_sequences, features):
         features: a dictionary with feature objects as values.
 
     Returns:
-        A dictionary mapping keys from `features` to lists of feature values.
+        A dictionary mapping keys from `features` to arrays of feature values.
     """
     results = {key: [] for key in features}
     for sequence in note_sequences:
+        notes = NoteArray.from_sequence(sequence)
         for key, feature in features.items():
-            old_len = len(results[key])
-            results[key].extend(feature.extract(sequence))
-            if len(results[key]) - old_len != len(sequence.notes):
-                raise RuntimeError(f'Feature {key} has {len(results[key]) - old_len} values for '
+            values = np.asarray(feature.extract(sequence, notes=notes))
+            if len(values) != len(sequence.notes):
+                raise RuntimeError(f'Feature {key} has {len(values)} values for '
                                    f'note sequence of length {len(sequence.notes)}')
+            results[key].append(values)
 
+    results = {key: np.concatenate(values) if values else np.zeros(0)
+               for key, values in results.items()}
     assert len(set(len(x) for x in results.values())) <= 1
 
     return results
 
 
+def _get_notes(sequence, notes):
+    return notes if notes is not None else NoteArray.from_sequence(sequence)
+
+
 class Pitch:
     """The MIDI pitch of the note."""
 
-    def extract(self, sequence):
-        for note in sequence.notes:
-            yield note.pitch
+    def extract(self, sequence, notes=None):
+        return _get_notes(sequence, notes).pitch
 
     def get_bins(self, min_value=0, max_value=127):
         return np.arange(min_value, max_value + 1) - 0.5
@@ -46,9 +54,9 @@ class Duration:
     expressed in beats.
     """
 
-    def extract(self, sequence):
-        for note in sequence.notes:
-            yield note.end_time - note.start_time
+    def extract(self, sequence, notes=None):
+        notes = _get_notes(sequence, notes)
+        return notes.end_time - notes.start_time
 
     def get_bins(self, bin_size=1/6, max_value=2):
         return np.arange(0., max_value + bin_size - _EPSILON, bin_size)
@@ -57,9 +65,8 @@ class Duration:
 class Velocity:
     """The MIDI velocity of the note."""
 
-    def extract(self, sequence):
-        for note in sequence.notes:
-            yield note.velocity
+    def extract(self, sequence, notes=None):
+        return _get_notes(sequence, notes).velocity
 
     def get_bins(self, num_bins=8):
         return np.arange(0, 127, 128 / num_bins) - 0.5
@@ -77,21 +84,23 @@ class OnsetPositionInBar:
         self._bar_duration = bar_duration
         self._beat_duration = 1. if bar_duration and not beat_duration else beat_duration
 
-    def extract(self, sequence):
+    def extract(self, sequence, notes=None):
         if self._bar_duration:
-            for note in sequence.notes:
-                yield (note.start_time % self._bar_duration) / self._beat_duration
-        else:
-            # Warning: Untested code ahead
-            pm = midi_io.sequence_proto_to_pretty_midi(sequence)
-            downbeat_ticks = [pm.time_to_tick(t) for t in pm.get_downbeats(sequence)]
-
-            bar_idx = 0
-            for note in sequence.notes:
-                onset_tick = pm.time_to_tick(note.start_time)
-                while bar_idx + 1 < len(downbeat_ticks) and downbeat_ticks[bar_idx] > onset_tick:
-                    bar_idx += 1
-                yield (onset_tick - downbeat_ticks[bar_idx]) / pm.resolution
+            notes = _get_notes(sequence, notes)
+            return (notes.start_time % self._bar_duration) / self._beat_duration
+        return list(self._extract_with_downbeats(sequence))
+
+    def _extract_with_downbeats(self, sequence):
+        # Warning: Untested code ahead
+        pm = midi_io.sequence_proto_to_pretty_midi(sequence)
+        downbeat_ticks = [pm.time_to_tick(t) for t in pm.get_downbeats(sequence)]
+
+        bar_idx = 0
+        for note in sequence.notes:
+            onset_tick = pm.time_to_tick(note.start_time)
+            while bar_idx + 1 < len(downbeat_ticks) and downbeat_ticks[bar_idx] > onset_tick:
+                bar_idx += 1
+            yield (onset_tick - downbeat_ticks[bar_idx]) / pm.resolution
 
     def get_bins(self, bin_size=1/6, max_beats=None):
         if max_beats is None:
@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 import argparse
 import collections
-import gzip
 import json
 import logging
 import random
@@ -12,9 +11,11 @@ import lmdb
 import numpy as np
 from confugue import Configuration, configurable
 from museflow import note_sequence_utils
-from note_seq.protobuf.music_pb2 import NoteSequence
 
+from groove2groove.compact_notes import load_sequence
 from groove2groove.eval import note_features
+from groove2groove.metadata_index import MetadataIndex
+from groove2groove.note_array import NoteArray
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -40,19 +41,18 @@ def time_pitch_diff_hist(data, max_time=2, bin_size=1/6, pitch_range=20, normed=
     epsilon = 1e-9
     time_diffs, intervals = [], []
     for seq in data:
-        onsets = [n.start_time for n in seq.notes]
-        diff_mat = np.subtract.outer(onsets, onsets)
+        notes = NoteArray.from_sequence(seq)
+        diff_mat = np.subtract.outer(notes.start_time, notes.start_time)
 
         # Count only positive time differences.
-        index_pairs = zip(*np.where((diff_mat < max_time - epsilon) & (diff_mat >= 0.)))
-        for j, i in index_pairs:
-            if j == i:
-                continue
-
-            time_diffs.append(diff_mat[j, i])
-            intervals.append(seq.notes[j].pitch - seq.notes[i].pitch)
-
-    if not time_diffs and not allow_empty:
+        j, i = np.where((diff_mat < max_time - epsilon) & (diff_mat >= 0.))
+        j, i = j[j != i], i[j != i]
+        time_diffs.append(diff_mat[j, i])
+        intervals.append(notes.pitch[j].astype(np.int32) - notes.pitch[i])
+
+    time_diffs = np.concatenate(time_diffs) if time_diffs else np.zeros(0)
+    intervals = np.concatenate(intervals) if intervals else np.zeros(0)
+    if not len(time_diffs) and not allow_empty:
         return None
 
     with np.errstate(divide='ignore', invalid='ignore'):
@@ -125,7 +125,9 @@ def main():
     parser.add_argument('meta_path', metavar='METADATA-FILE')
     parser.add_argument('--config', metavar='YAML-FILE', default=None)
     parser.add_argument('--max-segments-per-style', type=int, default=None)
-    parser.add_argument('--style-key', type=str, default='style')
+    parser.add_argument('--style-key', type=str, default='style',
+                        help='the metadata field to use as the style; ignored if METADATA-FILE is '
+                             'a metadata index, which always uses the field it was built with')
     args = parser.parse_args()
 
     if args.config:
@@ -136,11 +138,11 @@ def main():
 
     random.seed(42)
 
-    with gzip.open(args.meta_path, 'rt') as f:
-        metadata = json.load(f)
-    styles = sorted(set(v[args.style_key] for v in metadata.values()))
-    keys_by_style = {s: [k for k in sorted(metadata.keys()) if metadata[k][args.style_key] == s]
-                     for s in styles}
+    metadata = MetadataIndex.open(args.meta_path, style_key=args.style_key)
+    styles = sorted(metadata.styles)
+    # Rows are sorted by key, so sorting them gives the keys in sorted order
+    keys_by_style = {s: metadata.get_keys(np.sort(metadata.get_style_rows(style_id=i)))
+                     for i, s in enumerate(metadata.styles)}
 
     def get_sequences(style):
         keys = list(keys_by_style[style])
@@ -151,7 +153,7 @@ def main():
             with db.begin(buffers=True) as txn:
                 for key in keys:
                     val = txn.get(key.encode())
-                    seq = NoteSequence.FromString(val)
+                    seq = load_sequence(val)
                     yield note_sequence_utils.normalize_tempo(seq)
 
     results = collections.defaultdict(dict)
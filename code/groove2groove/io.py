@@ -5,20 +5,22 @@ model. A pipeline is a loader that additionally supports saving the outputs of t
 that makes it possible to pair them with the inputs.
 """
 import abc
-import collections
 import contextlib
+import copy
 import csv
-import gzip
-import json
 import logging
 import random
+import traceback
 
 import lmdb
 import numpy as np
 from museflow.io.note_sequence_io import save_sequences_db
 from museflow.note_sequence_utils import normalize_tempo, split_on_downbeats
 from note_seq import midi_io, sequences_lib
-from note_seq.protobuf import music_pb2
+
+from groove2groove.compact_notes import load_sequence
+from groove2groove.metadata_index import MetadataIndex
+from groove2groove.stats_index import SequenceStatsIndex
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -42,6 +44,8 @@ class TrainLoader(Loader):
     Args:
         metadata_path: Path to a gzipped JSON file mapping database keys to metadata. Each entry
             needs to have `'song_name'`, `'segment_id'` (unique within each song) and `'style'`.
+            Can also be a metadata index directory (see `build_metadata_index.py`), which is much
+            faster to load.
         db_path: Path to a LMDB database of `NoteSequence`s (use if the source and the target
             database are the same).
         source_db_path: Path to the source database (if different from the target database).
@@ -58,18 +62,42 @@ class TrainLoader(Loader):
         allow_same_style: Whether the source and target style can be the same.
         autoencode: Whether the source and target should always be the same. This causes
             `allow_same_style` to be ignored.
+        stats_path: Path to a statistics index of the database (see `build_stats_index.py`), used
+            to skip triplets that would be discarded during training before reading them.
+        source_stats_path: Path to a statistics index of the source database (if different from
+            the target database).
+        target_stats_path: Path to a statistics index of the target database (if different from
+            the source database).
+        note_filters: A list of `filter_sequence` keyword argument dictionaries. If a statistics
+            index is given, a triplet is skipped if the source is empty or, for every filter,
+            the filtered style is empty or the filtered target has more than `max_target_notes`
+            notes.
+        max_target_notes: The maximum number of notes in a filtered target sequence.
+        lookahead: If given, plan this many triplets ahead and read their target and style
+            sequences in key order (and only once per key) before yielding them in the planned
+            order. This turns random reads from the target database into mostly sequential ones,
+            at the cost of keeping up to `2 * lookahead` sequences in memory. The triplets and
+            their order are the same as without lookahead.
+        cache: A `SequenceCache` to use for the style sequences in `'one_shot_random'` mode.
     """
 
     def __init__(self, metadata_path, db_path=None, source_db_path=None, target_db_path=None,
                  mode='one_shot_random', random_seed=None, reseed=False, allow_same_style=False,
-                 autoencode=False):
+                 autoencode=False, stats_path=None, source_stats_path=None,
+                 target_stats_path=None, note_filters=None, max_target_notes=None,
+                 lookahead=None, cache=None):
         self._source_db_path = source_db_path or db_path
         self._target_db_path = target_db_path
 
-        with gzip.open(metadata_path, 'rt') as f:
-            self._metadata = json.load(f)
-        self._segment_index = _build_segment_index(self._metadata)
-        self._style_index = _build_style_index(self._metadata)
+        self._source_stats, self._target_stats = None, None
+        if source_stats_path or stats_path:
+            self._source_stats = SequenceStatsIndex(source_stats_path or stats_path)
+            self._target_stats = (SequenceStatsIndex(target_stats_path) if target_stats_path
+                                  else self._source_stats)
+        self._note_filters = list(note_filters) if note_filters is not None else [{}]
+        self._max_target_notes = max_target_notes
+
+        self._metadata = MetadataIndex.open(metadata_path)
 
         if random_seed is None:
             random_seed = random.random()
@@ -84,6 +112,32 @@ class TrainLoader(Loader):
             raise ValueError(f"mode '{mode}' not recognized")
         self._mode = mode
 
+        self._lookahead = lookahead
+        self._cache = cache
+
+        self._num_shards = 1
+        self._shard_index = 0
+
+    def shard(self, num_shards, index):
+        """Return a loader for a part of the source segments (e.g. to use in a worker process).
+
+        The shards are disjoint and together cover all the source segments. The metadata is shared
+        with this loader, but each shard has its own random generator, seeded deterministically
+        from the random generator of this loader (or from its seed if `reseed` is set). Creating
+        the shards anew for each epoch therefore gives a different random choice of styles.
+        """
+        if not 0 <= index < num_shards:
+            raise ValueError(f'Invalid shard index {index} for {num_shards} shards')
+        loader = copy.copy(self)
+        loader._num_shards = num_shards
+        loader._shard_index = index
+        if self._reseed:
+            loader._random_seed = f'{self._random_seed}/{index}/{num_shards}'
+        else:
+            loader._random_seed = self._random.getrandbits(64)
+        loader._random = random.Random(loader._random_seed)
+        return loader
+
     def load(self):
         if self._reseed:
             self._random.seed(self._random_seed)
@@ -104,36 +158,120 @@ class TrainLoader(Loader):
             # Load the source segments sequentially. For each source segment, go through all
             # corresponding target segments. For each target segment, pick one of the corresponding
             # style segments at random.
-            for src_key, src_val in src_txn.cursor():
+            skip_count = 0
+            planned, num_planned = [], 0
+            for i, (src_key, src_val) in enumerate(src_txn.cursor()):
+                if i % self._num_shards != self._shard_index:
+                    continue
                 src_key = bytes(src_key).decode()
+
+                tgt_and_style_keys = self._get_tgt_and_style_keys(src_key)
+                if self._source_stats is not None:
+                    num_keys = len(tgt_and_style_keys)
+                    tgt_and_style_keys = [(tgt_key, style_key)
+                                          for tgt_key, style_key in tgt_and_style_keys
+                                          if self._is_eligible(src_key, tgt_key, style_key)]
+                    skip_count += num_keys - len(tgt_and_style_keys)
+                    if not tgt_and_style_keys:
+                        continue
+
                 src_seq = _deserialize_seq(src_val)
+                if self._lookahead:
+                    planned.append((src_seq, tgt_and_style_keys))
+                    num_planned += len(tgt_and_style_keys)
+                    if num_planned >= self._lookahead:
+                        yield from self._read_planned(planned, tgt_cur)
+                        planned, num_planned = [], 0
+                    continue
 
-                for tgt_key, style_key in self._get_tgt_and_style_keys(src_key):
+                for tgt_key, style_key in tgt_and_style_keys:
                     tgt_seq = _deserialize_seq(tgt_cur.get(tgt_key.encode()))
                     if self._mode == 'one_shot_random':
-                        style = _deserialize_seq(style_cur.get(style_key.encode()))
+                        style = _read_cached(self._cache, self._target_db_path or
+                                             self._source_db_path, style_cur, style_key)
                     elif self._mode == 'style_id':
                         style = style_key
 
                     yield src_seq, style, tgt_seq
 
+            yield from self._read_planned(planned, tgt_cur)
+
+            if self._source_stats is not None:
+                _LOGGER.info(f'Skipped {skip_count} ineligible triplets using the statistics index')
+            if self._cache is not None:
+                self._cache.log_stats()
+
+    def _read_planned(self, planned, tgt_cur):
+        """Read the sequences needed for the planned triplets in key order and yield the triplets.
+
+        Args:
+            planned: A list of pairs `(src_seq, tgt_and_style_keys)`.
+            tgt_cur: A cursor of the target database.
+        """
+        tgt_keys = {tgt_key for _, tgt_and_style_keys in planned
+                    for tgt_key, _ in tgt_and_style_keys}
+        style_keys = set()
+        if self._mode == 'one_shot_random':
+            style_keys = {style_key for _, tgt_and_style_keys in planned
+                          for _, style_key in tgt_and_style_keys}
+        sequences = {}
+        for key in sorted(tgt_keys | style_keys):
+            if key in style_keys:
+                sequences[key] = _read_cached(self._cache, self._target_db_path or
+                                              self._source_db_path, tgt_cur, key)
+            else:
+                sequences[key] = _deserialize_seq(tgt_cur.get(key.encode()))
+
+        for src_seq, tgt_and_style_keys in planned:
+            for tgt_key, style_key in tgt_and_style_keys:
+                if self._mode == 'one_shot_random':
+                    style = sequences[style_key]
+                elif self._mode == 'style_id':
+                    style = style_key
+
+                yield src_seq, style, sequences[tgt_key]
+
+    def _is_eligible(self, src_key, tgt_key, style_key):
+        """Check if a triplet can be useful for training, based on the statistics index.
+
+        Keys missing from the index are considered eligible.
+        """
+        if self._source_stats.num_notes(src_key) == 0:
+            return False
+
+        for filter_kwargs in self._note_filters:
+            num_tgt_notes = self._target_stats.num_notes(tgt_key, **filter_kwargs)
+            if (num_tgt_notes is not None and self._max_target_notes is not None
+                    and num_tgt_notes > self._max_target_notes):
+                continue
+            if (self._mode == 'one_shot_random'
+                    and self._target_stats.num_notes(style_key, **filter_kwargs) == 0):
+                continue
+            return True
+        return False
+
     def _get_tgt_and_style_keys(self, src_key):
+        if self._autoencode and self._mode == 'one_shot_random':
+            return [(src_key, src_key)]
+
+        src_row = self._metadata.get_row(src_key)
         if self._autoencode:
-            if self._mode == 'one_shot_random':
-                return [(src_key, src_key)]
-            elif self._mode == 'style_id':
-                return [(src_key, self._metadata[src_key]['style'])]
+            if self._mode == 'style_id':
+                return [(src_key, self._metadata.get_style(src_row))]
 
         result = []
-        for tgt_key in self._segment_index[src_key]:
+        for tgt_row in self._metadata.get_segment_rows(src_row):
+            tgt_key = self._metadata.get_key(tgt_row)
             if self._mode == 'one_shot_random':
                 if (not self._allow_same_style and
-                        self._metadata[tgt_key]['style'] == self._metadata[src_key]['style']):
+                        self._metadata.get_style_id(tgt_row) ==
+                        self._metadata.get_style_id(src_row)):
                     continue
 
-                style_key = self._random.choice(self._style_index[tgt_key])
+                style_row = self._random.choice(self._metadata.get_style_rows(tgt_row))
+                style_key = self._metadata.get_key(style_row)
             elif self._mode == 'style_id':
-                style_key = self._metadata[tgt_key]['style']
+                style_key = self._metadata.get_style(tgt_row)
             result.append((tgt_key, style_key))
         return result
 
@@ -149,13 +287,22 @@ class EvalPipeline(Loader):
         style_db_path: Path to the style database. If `None`, the target key in each pair will be
             treated as a style ID and returned instead of the style sequence.
         skip_empty: Whether to skip examples containing no notes.
+        source_stats_path: Path to a statistics index of the source database (see
+            `build_stats_index.py`). If given, empty source sequences are skipped without
+            reading them.
+        style_stats_path: Path to a statistics index of the style database.
+        cache: A `SequenceCache` to use for the style sequences.
     """
 
-    def __init__(self, source_db_path, key_pairs_path, style_db_path=None, skip_empty=True):
+    def __init__(self, source_db_path, key_pairs_path, style_db_path=None, skip_empty=True,
+                 source_stats_path=None, style_stats_path=None, cache=None):
         self._source_db_path = source_db_path
         self._style_db_path = style_db_path
         self._key_pairs_path = key_pairs_path
         self._skip_empty = skip_empty
+        self._source_stats = SequenceStatsIndex(source_stats_path) if source_stats_path else None
+        self._style_stats = SequenceStatsIndex(style_stats_path) if style_stats_path else None
+        self._cache = cache
 
         self.key_pairs = None
 
@@ -181,14 +328,24 @@ class EvalPipeline(Loader):
                 total_examples += 1
                 skip = False
 
+                if self._skip_empty:
+                    # Check the statistics indices first to avoid reading empty sequences
+                    source_empty = _is_empty(self._source_stats, source_key)
+                    style_empty = (self._style_db_path is not None
+                                   and _is_empty(self._style_stats, style_key))
+                    if source_empty or style_empty:
+                        empty_source_seqs += source_empty
+                        empty_style_seqs += style_empty
+                        continue
+
                 source_seq = _deserialize_seq(source_txn.get(source_key.encode()), allow_none=True)
                 if source_seq is not None and not source_seq.notes:
                     empty_source_seqs += 1
                     skip = skip or self._skip_empty
 
                 if self._style_db_path:
-                    style_seq_or_id = _deserialize_seq(style_txn.get(style_key.encode()),
-                                                       allow_none=True)
+                    style_seq_or_id = _read_cached(self._cache, self._style_db_path, style_txn,
+                                                   style_key, allow_none=True)
                     if style_seq_or_id is not None and not style_seq_or_id.notes:
                         empty_style_seqs += 1
                         skip = skip or self._skip_empty
@@ -203,6 +360,8 @@ class EvalPipeline(Loader):
         _LOGGER.info(f'Loaded {len(self.key_pairs)} / {total_examples} examples.')
         _LOGGER.info(f'Found {empty_source_seqs} empty source sequences and '
                      f'{empty_style_seqs} empty style sequences.')
+        if self._cache is not None:
+            self._cache.log_stats()
 
     def save(self, sequences, db_path):
         if self.key_pairs is None:
@@ -303,30 +462,88 @@ class MidiPipeline(Loader):
         midi_io.note_sequence_to_midi_file(sequence, path)
 
 
-def _build_segment_index(metadata):
-    """Return a dictionary mapping each key to a list of keys corresponding to the same segment."""
-    segment_id_to_keys = collections.defaultdict(list)
-    index = {}
-    for key, item in metadata.items():
-        full_segment_id = (item['song_name'], item['segment_id'])
-        item['full_segment_id'] = full_segment_id
-        segment_id_to_keys[full_segment_id].append(key)
-        index[key] = segment_id_to_keys[full_segment_id]
-    return index
+class ConcatPipeline(Loader):
+    """A pipeline chaining the inputs of several pipelines.
+
+    This makes it possible to run the model on the inputs of many pipelines at once (so that
+    segments of different songs can share a batch) and then hand each pipeline its own outputs.
+
+    Args:
+        pipelines: A list of pipelines (e.g. `MidiPipeline`s).
+    """
+
+    def __init__(self, pipelines):
+        self.pipelines = list(pipelines)
+
+        self.key_pairs = None
+        self._counts = None
+
+    def load(self):
+        self.key_pairs = []
+        self._counts = []
+        for i, pipeline in enumerate(self.pipelines):
+            count = 0
+            for item in pipeline:
+                self.key_pairs.append((str(i), str(count)))
+                count += 1
+                yield item
+            self._counts.append(count)
+
+    def split(self, sequences):
+        """Split the outputs of the model into one list per pipeline."""
+        if self._counts is None:
+            raise RuntimeError("'split' called before 'load'")
+
+        sequences = list(sequences)
+        if len(sequences) != sum(self._counts):
+            raise RuntimeError(f'Expected {sum(self._counts)} sequences, got {len(sequences)}')
+
+        boundaries = np.cumsum([0] + self._counts)
+        return [sequences[start:end] for start, end in zip(boundaries[:-1], boundaries[1:])]
+
+
+def load_midi_pipeline(source_path, style_path, bars_per_segment=None, warp=False):
+    """Create a `MidiPipeline`, catching any errors (to be used with `multiprocessing`).
+
+    Returns:
+        A tuple `(pipeline, error)`, where `pipeline` is `None` and `error` is the error message
+        if the files could not be loaded.
+    """
+    try:
+        return MidiPipeline(source_path, style_path, bars_per_segment=bars_per_segment,
+                            warp=warp), None
+    except Exception:  # pylint: disable=broad-except
+        return None, traceback.format_exc()
+
+
+def save_midi_pipeline(pipeline, sequences, path):
+    """Call `pipeline.save`, catching any errors (to be used with `multiprocessing`).
+
+    Returns:
+        The error message, or `None` if successful.
+    """
+    try:
+        pipeline.save(sequences, path)
+        return None
+    except Exception:  # pylint: disable=broad-except
+        return traceback.format_exc()
+
+
+def _is_empty(stats_index, key):
+    return stats_index is not None and stats_index.num_notes(key) == 0
+
 
+def _read_cached(cache, db_path, txn_or_cursor, key, allow_none=False):
+    """Read and deserialize a sequence, using the given `SequenceCache` if not `None`."""
+    def load():
+        return _deserialize_seq(txn_or_cursor.get(key.encode()), allow_none=allow_none)
 
-def _build_style_index(metadata):
-    """Return a dictionary mapping each key to a list of keys with the same style."""
-    style_to_keys = collections.defaultdict(list)
-    index = {}
-    for key, item in metadata.items():
-        style = item['style']
-        style_to_keys[style].append(key)
-        index[key] = style_to_keys[style]
-    return index
+    if cache is None:
+        return load()
+    return cache.get_sequence((db_path, key), load)
 
 
 def _deserialize_seq(string, allow_none=False):
     if string is None and allow_none:
         return None
-    return music_pb2.NoteSequence.FromString(string)
+    return load_sequence(string)
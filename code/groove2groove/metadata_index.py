@@ -0,0 +1,158 @@
+"""A compact, memory-mapped index of dataset metadata.
+
+The metadata of a dataset is a gzipped JSON file mapping each database key to a dictionary with
+(at least) the fields `'song_name'`, `'segment_id'` and `'style'`. Loading it into Python
+dictionaries and building per-key indices is slow and memory hungry for millions of keys, so it
+can be converted (using `build_metadata_index.py`) to a directory of NumPy arrays:
+
+- `keys.npy`: the sorted keys, as an array of UTF-8 encoded byte strings,
+- `style_ids.npy`, `segment_ids.npy`: for each key, the integer ID of its style and of its segment
+  (a unique `(song_name, segment_id)` pair),
+- `styles.npy`: the style names, indexed by style ID,
+- `{style,segment}_members.npy`, `{style,segment}_offsets.npy`: the rows (key indices) belonging to
+  each style and each segment, in the order in which the keys appear in the original metadata.
+
+The arrays are memory-mapped when loaded, so opening the index is almost instantaneous and the
+memory is shared between processes. A memory-mapped index is pickled as its path, so sending it
+to another process is cheap too.
+"""
+import gzip
+import json
+import os
+
+import numpy as np
+
+_ARRAY_NAMES = ['keys', 'style_ids', 'segment_ids', 'styles',
+                'style_members', 'style_offsets', 'segment_members', 'segment_offsets']
+
+
+class MetadataIndex:
+    """A columnar index of dataset metadata.
+
+    Use `MetadataIndex.open` to create an instance.
+    """
+
+    def __init__(self, arrays):
+        for name in _ARRAY_NAMES:
+            setattr(self, '_' + name, arrays[name])
+        self.styles = [str(s) for s in self._styles]
+        self._path = None
+
+    @classmethod
+    def open(cls, path, style_key='style'):
+        """Open an index directory or load a gzipped JSON metadata file.
+
+        Args:
+            path: Path to an index directory written by `save` or to a gzipped JSON file.
+            style_key: The metadata field to use as the style (only if `path` is a JSON file).
+        """
+        if os.path.isdir(path):
+            return cls.load(path)
+
+        with gzip.open(path, 'rt') as f:
+            return cls.from_metadata(json.load(f), style_key=style_key)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map an index directory written by `save`."""
+        index = cls({name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                     for name in _ARRAY_NAMES})
+        index._path = path
+        return index
+
+    @classmethod
+    def from_metadata(cls, metadata, style_key='style'):
+        """Build the index from a metadata dictionary."""
+        keys = list(metadata.keys())
+        # Encode explicitly, since NumPy would encode the keys as ASCII
+        encoded_keys = np.array([key.encode('utf-8') for key in keys], dtype=bytes)
+        order = np.argsort(encoded_keys, kind='stable')
+
+        style_to_id, segment_to_id = {}, {}
+        style_ids = np.empty(len(keys), dtype=np.int32)
+        segment_ids = np.empty(len(keys), dtype=np.int32)
+        for row, i in enumerate(order):
+            item = metadata[keys[i]]
+            style_ids[row] = style_to_id.setdefault(item[style_key], len(style_to_id))
+            segment_ids[row] = segment_to_id.setdefault((item['song_name'], item['segment_id']),
+                                                        len(segment_to_id))
+
+        # `order` maps rows to positions in the original metadata; sorting the rows by position
+        # makes the group members appear in the original order.
+        rows_by_position = np.argsort(order, kind='stable')
+        arrays = {
+            'keys': encoded_keys[order],
+            'style_ids': style_ids,
+            'segment_ids': segment_ids,
+            'styles': np.array(list(style_to_id.keys()), dtype=str),
+        }
+        for name, ids, num_groups in [('style', style_ids, len(style_to_id)),
+                                      ('segment', segment_ids, len(segment_to_id))]:
+            arrays[name + '_members'], arrays[name + '_offsets'] = _group_rows(
+                ids[rows_by_position], rows_by_position, num_groups)
+        return cls(arrays)
+
+    def save(self, path):
+        """Save the index to a directory."""
+        os.makedirs(path, exist_ok=True)
+        for name in _ARRAY_NAMES:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, '_' + name))
+
+    def __reduce__(self):
+        if self._path is not None:
+            return type(self).load, (self._path,)
+        return super().__reduce__()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return self.find(key) is not None
+
+    def find(self, key):
+        """Return the row of the given key, or `None` if not found."""
+        key = key.encode('utf-8')
+        row = np.searchsorted(self._keys, key)
+        if row < len(self._keys) and self._keys[row] == key:
+            return int(row)
+        return None
+
+    def get_row(self, key):
+        """Return the row of the given key, raising a `KeyError` if not found."""
+        row = self.find(key)
+        if row is None:
+            raise KeyError(key)
+        return row
+
+    def get_key(self, row):
+        return self._keys[row].decode('utf-8')
+
+    def get_keys(self, rows):
+        return [key.decode('utf-8') for key in self._keys[rows]]
+
+    def get_style_id(self, row):
+        return int(self._style_ids[row])
+
+    def get_style(self, row):
+        return self.styles[self._style_ids[row]]
+
+    def get_segment_rows(self, row):
+        """Return the rows of all keys belonging to the same segment as the given row."""
+        segment_id = self._segment_ids[row]
+        return self._segment_members[self._segment_offsets[segment_id]:
+                                     self._segment_offsets[segment_id + 1]]
+
+    def get_style_rows(self, row=None, style_id=None):
+        """Return the rows of all keys with the given style (or the same style as `row`)."""
+        if style_id is None:
+            style_id = self._style_ids[row]
+        return self._style_members[self._style_offsets[style_id]:
+                                   self._style_offsets[style_id + 1]]
+
+
+def _group_rows(group_ids, rows, num_groups):
+    """Group `rows` by `group_ids`, keeping their order; return the members and offsets arrays."""
+    order = np.argsort(group_ids, kind='stable')
+    offsets = np.zeros(num_groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(group_ids, minlength=num_groups), out=offsets[1:])
+    return rows[order].astype(np.int32), offsets
@@ -1,8 +1,12 @@
+import itertools
 import logging
 
+import numpy as np
 import tensorflow as tf
 from confugue import configurable
 from museflow.components import Component, using_scope
+from museflow.model_utils import (clip_gradients, make_simple_dataset, make_train_dataset,
+                                  summarize_variables)
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -53,3 +57,231 @@ class CNN(Component):
         if isinstance(layer, (tf.layers.Dropout, tf.keras.layers.Dropout)):
             return layer(features, training=self._is_training)
         return layer(features)
+
+
+@configurable(params=['variables', 'max_gradient_norm', 'name'])
+def create_train_op(loss, optimizer=None, variables=None, max_gradient_norm=None,
+                    name='training', all_reduce_fn=None, *, _cfg):
+    """Create a training op.
+
+    Like `museflow.model_utils.create_train_op`, but if `all_reduce_fn` is given, the gradients are
+    flattened into a single float32 vector and passed through it (using `tf.py_func`) before they
+    are clipped and applied, e.g. to average them over data-parallel workers (see
+    `groove2groove.models.data_parallel`). The variables created are the same in both cases.
+    """
+    global_step = tf.train.get_or_create_global_step()
+
+    if optimizer is None:
+        opt_args = {}
+        learning_rate = _cfg['lr_decay'].maybe_configure(global_step=global_step)
+        if learning_rate is not None:
+            opt_args['learning_rate'] = learning_rate
+            tf.summary.scalar('learning_rate', learning_rate, family='train')
+
+        optimizer = _cfg['optimizer'].configure(tf.train.AdamOptimizer, **opt_args)
+
+    if variables is None:
+        variables = tf.trainable_variables()
+
+    _LOGGER.info(f"'{name}' op trains {len(variables)} variables:\n\n"
+                 f'{summarize_variables(variables)}\n')
+
+    with tf.variable_scope(name):
+        grads_and_vars = optimizer.compute_gradients(loss, variables)
+        if all_reduce_fn is not None:
+            grads_and_vars = _all_reduce_gradients(grads_and_vars, all_reduce_fn)
+        return optimizer.apply_gradients(clip_gradients(grads_and_vars, max_gradient_norm),
+                                         global_step=global_step)
+
+
+def _all_reduce_gradients(grads_and_vars, all_reduce_fn):
+    grads_and_vars = [(grad, var) for grad, var in grads_and_vars if grad is not None]
+    grad_vars = [var for _, var in grads_and_vars]
+    # Sparse gradients (of embeddings) are converted to dense ones
+    flat_grads = tf.concat([tf.reshape(tf.convert_to_tensor(grad), [-1])
+                            for grad, _ in grads_and_vars], axis=0)
+    flat_grads = tf.py_func(all_reduce_fn, [flat_grads], tf.float32, stateful=True,
+                            name='all_reduce')
+    grads = [tf.reshape(grad, var.shape)
+             for grad, var in zip(tf.split(flat_grads,
+                                           [var.shape.num_elements() for var in grad_vars]),
+                                  grad_vars)]
+    return list(zip(grads, grad_vars))
+
+
+@configurable
+def prepare_train_and_val_data(train_generator, val_generator, output_types, output_shapes,
+                               train_batch_size, val_batch_size, shuffle_buffer_size=100000,
+                               preprocess_fn=None, num_epochs=None, num_train_examples=None,
+                               dataset_manager=None, length_fn=None, *, _cfg):
+    """Prepare a DatasetManager with training and validation data.
+
+    Like `museflow.model_utils.prepare_train_and_val_data`, but if the configuration contains a
+    `bucketing` section, the training batches are formed by `make_bucketed_train_dataset`, using
+    `length_fn` to obtain the lengths of each example.
+
+    Return:
+        A tuple `(train_dataset, val_dataset)`.
+    """
+    if 'bucketing' in _cfg:
+        train_dataset = _cfg['bucketing'].configure(
+            make_bucketed_train_dataset,
+            generator=train_generator, output_types=output_types, output_shapes=output_shapes,
+            length_fn=length_fn, batch_size=train_batch_size,
+            shuffle_buffer_size=shuffle_buffer_size, preprocess_fn=preprocess_fn,
+            num_epochs=num_epochs, num_examples=num_train_examples)
+    else:
+        train_dataset = make_train_dataset(train_generator, output_types, output_shapes,
+                                           train_batch_size, shuffle_buffer_size, preprocess_fn,
+                                           num_epochs, num_train_examples)
+    if dataset_manager:
+        dataset_manager.add_dataset('train', train_dataset, one_shot=True)
+
+    val_dataset = make_simple_dataset(val_generator, output_types, output_shapes, val_batch_size,
+                                      'val', preprocess_fn=preprocess_fn)
+    if dataset_manager:
+        dataset_manager.add_dataset('val', val_dataset)
+
+    return train_dataset, val_dataset
+
+
+def make_batched_dataset(generator, output_types, output_shapes, name='dataset'):
+    """Create a dataset from a generator yielding whole batches (e.g. made by `encode_batch`).
+
+    Unlike `make_simple_dataset`, the examples are not padded and batched by TensorFlow.
+
+    Args:
+        generator: A generator yielding tuples of padded arrays.
+        output_types: A tuple with the types of the components of the examples.
+        output_shapes: A tuple with the shapes of the components of a single example (without
+            the batch dimension).
+        name: A name for the name scope for the dataset.
+    """
+    with tf.name_scope(name):
+        return tf.data.Dataset.from_generator(
+            generator, output_types,
+            output_shapes=tuple([None, *shape] for shape in output_shapes))
+
+
+def make_bucketed_train_dataset(generator, output_types, output_shapes, length_fn, boundaries,
+                                batch_size, tokens_per_batch=None, shuffle_buffer_size=100000,
+                                preprocess_fn=None, num_epochs=None, num_examples=None,
+                                name='train'):
+    """Prepare a training dataset with batches of examples of similar length.
+
+    Each example is assigned to a bucket based on one or more lengths (e.g. the target length and
+    the style length). Along each length dimension `d`, the buckets are delimited by
+    `boundaries[d]`: bucket `i` holds the lengths in `(boundaries[d][i - 1], boundaries[d][i]]`,
+    except that the last bucket also holds all lengths above the last boundary.
+
+    Args:
+        generator: A generator yielding the examples.
+        output_types: The type(s) of the elements of the dataset.
+        output_shapes: The padded shape(s) of the elements of the dataset.
+        length_fn: A function taking the components of a (pre-processed) example and returning
+            a list of scalar length tensors, one for each list in `boundaries`.
+        boundaries: A list of lists of bucket boundaries, one list for each length.
+        batch_size: The batch size to use if `tokens_per_batch` is not given.
+        tokens_per_batch: If given, the batch size for each bucket is chosen so that the number
+            of (padded) tokens per batch is roughly constant, counting the upper boundary of the
+            bucket along each length dimension.
+        shuffle_buffer_size: The size of the buffer used for sampling elements from the dataset.
+        preprocess_fn: The pre-processing function to apply to the data.
+        num_epochs: The number of training epochs. If `None`, the training dataset will loop
+            indefinitely.
+        num_examples: If given, the number of examples per training epoch will be limited
+            to this number (before shuffling).
+        name: A name for the name scope for the dataset.
+
+    Return:
+        A `tf.data.Dataset`.
+    """
+    boundaries = [list(b) for b in boundaries]
+    num_buckets = [len(b) for b in boundaries]
+
+    # Batch size for each combination of buckets, in row-major order
+    batch_sizes = []
+    for bucket in itertools.product(*(range(n) for n in num_buckets)):
+        if tokens_per_batch:
+            num_tokens = sum(b[i] for b, i in zip(boundaries, bucket))
+            batch_sizes.append(max(1, tokens_per_batch // num_tokens))
+        else:
+            batch_sizes.append(batch_size)
+    _LOGGER.debug(f'Bucket batch sizes: {batch_sizes}')
+
+    with tf.name_scope(name):
+        batch_sizes = tf.constant(batch_sizes, dtype=tf.int64)
+
+        def key_fn(*example):
+            lengths = length_fn(*example)
+            if len(lengths) != len(boundaries):
+                raise ValueError(f'Expected {len(boundaries)} lengths (one for each list of '
+                                 f'boundaries), got {len(lengths)}')
+            key = tf.constant(0, dtype=tf.int64)
+            for length, b, n in zip(lengths, boundaries, num_buckets):
+                index = tf.reduce_sum(tf.cast(
+                    tf.greater(tf.to_int64(length), tf.constant(b[:-1], dtype=tf.int64)),
+                    tf.int64))
+                key = key * n + index
+            return key
+
+        def reduce_fn(key, window):
+            return window.padded_batch(tf.gather(batch_sizes, key), output_shapes)
+
+        dataset = tf.data.Dataset.from_generator(generator, output_types)
+        if num_examples:
+            dataset = dataset.take(num_examples)
+        if shuffle_buffer_size:
+            dataset = dataset.shuffle(shuffle_buffer_size, reshuffle_each_iteration=True)
+        if preprocess_fn:
+            dataset = dataset.map(preprocess_fn)
+        dataset = dataset.repeat(num_epochs)
+        dataset = dataset.apply(tf.data.experimental.group_by_window(
+            key_func=key_fn, reduce_func=reduce_fn,
+            window_size_func=lambda key: tf.gather(batch_sizes, key)))
+        return dataset
+
+
+def sparsify_roll(roll):
+    """Convert a piano roll to a sparse representation, to be densified using `densify_roll`.
+
+    Args:
+        roll: A piano roll of shape `[num_rows, num_steps]`.
+
+    Returns:
+        A `float32` array of shape `[1 + num_entries, 3]`. The first row is `[0, num_steps, 0]`,
+        each of the remaining rows holds the row index, the step index and the value of a non-zero
+        entry of the roll.
+    """
+    rows, steps = np.nonzero(roll)
+    sparse = np.empty((len(rows) + 1, 3), dtype=np.float32)
+    sparse[0] = (0, roll.shape[1], 0)
+    sparse[1:, 0] = rows
+    sparse[1:, 1] = steps
+    sparse[1:, 2] = roll[rows, steps]
+    return sparse
+
+
+def densify_roll(sparse_rolls, num_rows):
+    """Convert a batch of piano rolls from the representation returned by `sparsify_roll`.
+
+    Args:
+        sparse_rolls: A `float32` tensor of shape `[batch_size, 1 + max_entries, 3]` (padded with
+            zeros).
+        num_rows: The number of rows of the piano rolls.
+
+    Returns:
+        A tensor of shape `[batch_size, num_rows, max_steps]`, padded with zeros.
+    """
+    num_steps = tf.cast(sparse_rolls[:, 0, 1], tf.int32)
+    entries = sparse_rolls[:, 1:, :]
+    shape = tf.shape(entries)
+    batch_indices = tf.tile(tf.range(shape[0])[:, tf.newaxis], [1, shape[1]])
+    indices = tf.stack([batch_indices,
+                        tf.cast(entries[:, :, 0], tf.int32),
+                        tf.cast(entries[:, :, 1], tf.int32)], axis=-1)
+    # The padding entries add zeros at position [0, 0], which does not change the result
+    rolls = tf.scatter_nd(indices, entries[:, :, 2],
+                          shape=[shape[0], num_rows, tf.reduce_max(num_steps)])
+    rolls.set_shape([None, num_rows, None])
+    return rolls
@@ -0,0 +1,172 @@
+"""Synchronous data-parallel training in multiple local processes.
+
+Each worker process builds the whole model and trains it on its own part of the training data.
+In each training step, the gradients computed by the workers are averaged through shared memory
+(see `GradientAverager` and `groove2groove.models.common.create_train_op`) and every worker
+applies the same update to its own copy of the variables, so that the copies stay identical.
+Only the first worker (the chief) validates the model, writes summaries and saves checkpoints,
+which are therefore the same as the ones saved by single-process training.
+"""
+import logging
+import multiprocessing
+import threading
+import time
+
+import numpy as np
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class GradientAverager:
+    """Averages float32 vectors (e.g. flattened gradients) over a group of processes.
+
+    The averager is created in the chief process (with rank 0), allocated using `allocate` and
+    then passed to the other worker processes using `start_workers`, which assigns them their
+    ranks. A call to `all_reduce_mean` blocks until all the workers have made it and returns the
+    mean of their vectors; each worker computes the mean of a different slice of the vectors.
+
+    Once any of the workers calls `stop`, the pending and future calls in the other workers
+    raise `StopIteration`, which `tf.py_func` turns into an `OutOfRangeError`, so the training
+    loops end as if the training data ran out. If the worker failed, they raise `RuntimeError`
+    instead.
+
+    Args:
+        num_workers: The number of worker processes, including the chief.
+    """
+
+    _RUNNING, _FINISHED, _FAILED = 0, 1, 2
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.rank = 0
+        self._context = multiprocessing.get_context('spawn')
+        self._barrier = self._context.Barrier(num_workers)
+        self._state = self._context.Value('i', self._RUNNING)
+        self._inputs = self._output = None
+        self._views = None
+
+    def allocate(self, size):
+        """Allocate the shared memory for vectors of up to `size` elements."""
+        self._inputs = self._context.RawArray('f', self.num_workers * size)
+        self._output = self._context.RawArray('f', size)
+        self._views = None
+
+    @property
+    def running(self):
+        return self._state.value == self._RUNNING
+
+    def all_reduce_mean(self, vector):
+        """Return the mean of the vectors passed by all the workers."""
+        inputs, output = self._get_views()
+        inputs[self.rank, :len(vector)] = vector
+        self._wait()
+        start, end = self._get_slice(len(vector))
+        np.mean(inputs[:, start:end], axis=0, out=output[start:end])
+        self._wait()
+        return output[:len(vector)].copy()
+
+    def broadcast(self, vector):
+        """Return the vector passed by the chief (ignoring the ones passed by the others)."""
+        _, output = self._get_views()
+        if self.rank == 0:
+            output[:len(vector)] = vector
+        self._wait()
+        result = output[:len(vector)].copy()
+        self._wait()
+        return result
+
+    def stop(self, failed=False):
+        """Make the other workers stop training (if no worker has done so before)."""
+        with self._state.get_lock():
+            if self._state.value == self._RUNNING:
+                self._state.value = self._FAILED if failed else self._FINISHED
+        self._barrier.abort()
+
+    def _wait(self):
+        try:
+            self._barrier.wait()
+        except threading.BrokenBarrierError:
+            if self._state.value == self._FINISHED:
+                raise StopIteration('Training stopped by another worker') from None
+            raise RuntimeError('Training failed in another worker') from None
+
+    def _get_slice(self, size):
+        slice_size = -(-size // self.num_workers)
+        start = min(self.rank * slice_size, size)
+        return start, min(start + slice_size, size)
+
+    def _get_views(self):
+        if self._views is None:
+            if self._output is None:
+                raise RuntimeError('GradientAverager not allocated')
+            self._views = (np.frombuffer(self._inputs, dtype=np.float32).reshape(
+                               self.num_workers, -1),
+                           np.frombuffer(self._output, dtype=np.float32))
+        return self._views
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_context'], state['_views']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._context = multiprocessing.get_context('spawn')
+        self._views = None
+
+
+def broadcast_variables(gradient_averager, session, variables):
+    """Set the values of the variables in all the workers to their values in the chief."""
+    values = session.run(variables)
+    vector = gradient_averager.broadcast(
+        np.concatenate([np.ravel(value) for value in values]).astype(np.float32))
+    if gradient_averager.rank == 0:
+        return
+    offset = 0
+    for variable, value in zip(variables, values):
+        variable.load(vector[offset:offset + value.size].reshape(value.shape), session)
+        offset += value.size
+
+
+def start_workers(gradient_averager, target, args=()):
+    """Start a process for each of the workers other than the chief.
+
+    Each process calls `target(*args, gradient_averager)`, with the rank of the averager set to
+    the rank of the worker. A thread in the chief watches the processes and stops the training if
+    one of them exits before the training is done. The processes are not daemonic (so that they
+    can start processes of their own, e.g. using `groove2groove.parallel.interleave_parallel`),
+    hence they should always be waited for using `join_workers`.
+
+    Returns:
+        A list of the processes.
+    """
+    processes = []
+    for rank in range(1, gradient_averager.num_workers):
+        gradient_averager.rank = rank
+        processes.append(gradient_averager._context.Process(
+            target=target, args=(*args, gradient_averager), name=f'worker-{rank}'))
+        processes[-1].start()
+    gradient_averager.rank = 0
+
+    def watch():
+        while gradient_averager.running:
+            for process in processes:
+                if process.exitcode is not None:
+                    _LOGGER.error(f'{process.name} exited with code {process.exitcode}')
+                    gradient_averager.stop(failed=True)
+                    return
+            time.sleep(1.)
+
+    threading.Thread(target=watch, daemon=True).start()
+    return processes
+
+
+def join_workers(processes, timeout=60.):
+    """Wait for the worker processes to exit, terminating them after `timeout` seconds."""
+    deadline = time.time() + timeout
+    for process in processes:
+        process.join(max(deadline - time.time(), 0.))
+        if process.is_alive():
+            _LOGGER.warning(f'Terminating {process.name}')
+            process.terminate()
+            process.join()
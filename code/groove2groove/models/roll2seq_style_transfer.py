@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 import argparse
+import csv
+import functools
 import logging
+import multiprocessing
 import os
+import sys
 
 import coloredlogs
 import numpy as np
@@ -9,56 +13,87 @@ import tensorflow as tf
 import tqdm
 from confugue import Configuration, configurable
 from museflow.components import EmbeddingLayer, RNNDecoder, RNNLayer
-from museflow.model_utils import (DatasetManager, create_train_op, make_simple_dataset,
-                                  prepare_train_and_val_data, set_random_seed)
+from museflow.model_utils import DatasetManager, make_simple_dataset, set_random_seed
 from museflow.nn.rnn import InputWrapper
-from museflow.note_sequence_utils import filter_sequence, set_note_fields
+from museflow.note_sequence_utils import set_note_fields
 from museflow.trainer import BasicTrainer
 from note_seq.protobuf import music_pb2
 
-from groove2groove.io import EvalPipeline, MidiPipeline, TrainLoader
-from groove2groove.models.common import CNN
+from groove2groove.cache import SequenceCache
+from groove2groove.encodings import encode_batch, pad_batch, pad_token_batch
+from groove2groove.io import (ConcatPipeline, EvalPipeline, MidiPipeline, TrainLoader,
+                              load_midi_pipeline, save_midi_pipeline)
+from groove2groove.models.common import (CNN, create_train_op, densify_roll, make_batched_dataset,
+                                         prepare_train_and_val_data, sparsify_roll)
+from groove2groove.models.data_parallel import (GradientAverager, broadcast_variables, join_workers,
+                                                start_workers)
+from groove2groove.models.trainer import Trainer
+from groove2groove.note_array import NoteArray
+from groove2groove.note_sequence_utils import get_program_filters, partition_sequence
+from groove2groove.parallel import interleave_parallel
+from groove2groove.shards import ShardLoader, ShardWriter
 
 _LOGGER = logging.getLogger(__name__)
 
 
+class RunCancelledError(Exception):
+    """Raised when a run is cancelled through its `cancel_fn`."""
+
+
 @configurable
 class Model:
+    """The style transfer model.
+
+    The content encoder, the style encoder and the decoder are built as separate subgraphs.
+    The training version of the decoder is only built in train mode and the inference versions
+    (`'sample'` and `'greedy'`) only when first requested (or upfront if listed in
+    `decoder_modes`), so that a process only pays for the modes it actually uses. Outside of train
+    mode, some of the decoder variables are only created by an inference decoder, so at least one
+    of them (`'greedy'` if `decoder_modes` is empty) is always built upfront, before the variables
+    are saved or loaded.
+
+    If `sparse_content_rows` is given, the content input is expected in the sparse format produced
+    by `sparsify_roll` and is converted to dense piano rolls with this number of rows in the graph.
 
-    def __init__(self, dataset_manager, train_mode, vocabulary, sampling_seed=None):
+    If `gradient_averager` is given, the gradients are averaged over the data-parallel workers in
+    each training step (see `groove2groove.models.data_parallel`).
+    """
+
+    def __init__(self, dataset_manager, train_mode, vocabulary, sampling_seed=None,
+                 decoder_modes=(), sparse_content_rows=None, gradient_averager=None):
         self._train_mode = train_mode
+        self._gradient_averager = gradient_averager
         self._is_training = tf.placeholder_with_default(False, [], name='is_training')
+        self._sampling_seed = sampling_seed
 
         self.dataset_manager = dataset_manager
 
         inputs, style_inputs, decoder_inputs, decoder_targets = self.dataset_manager.get_next()
-
-        cnn = self._cfg['encoder_cnn'].configure(CNN,
-                                                 training=self._is_training,
-                                                 name='encoder_cnn')
-        rnn = self._cfg['encoder_rnn'].configure(RNNLayer,
-                                                 training=self._is_training,
-                                                 name='encoder_rnn')
-        encoder_states, _ = rnn(cnn(inputs))
-
-        embeddings = self._cfg['embedding_layer'].configure(EmbeddingLayer,
-                                                            input_size=len(vocabulary),
-                                                            name='embedding_layer')
-
-        style_cnn = self._cfg['style_encoder_cnn'].configure(CNN,
-                                                             training=self._is_training,
-                                                             name='style_encoder_cnn')
-        style_rnn = self._cfg['style_encoder_rnn'].configure(RNNLayer,
-                                                             training=self._is_training,
-                                                             name='style_encoder_rnn')
-        style_projection = self._cfg['style_projection'].maybe_configure(tf.layers.Dense,
-                                                                         name='style_projection')
-        _, style_final_state = style_rnn(style_cnn(embeddings.embed(style_inputs)))
-        self.style_vector = (style_projection(style_final_state) if style_projection
-                             else style_final_state)
-        style_dropout = self._cfg['style_dropout'].maybe_configure(tf.layers.Dropout)
-        if style_dropout:
-            self.style_vector = style_dropout(self.style_vector, training=self._is_training)
+        self.batch_stats = _make_batch_stats(inputs, style_inputs, decoder_targets,
+                                             pad_id=vocabulary.pad_id)
+        if sparse_content_rows:
+            inputs = densify_roll(inputs, sparse_content_rows)
+
+        self._encoder_cnn = self._cfg['encoder_cnn'].configure(CNN,
+                                                               training=self._is_training,
+                                                               name='encoder_cnn')
+        self._encoder_rnn = self._cfg['encoder_rnn'].configure(RNNLayer,
+                                                               training=self._is_training,
+                                                               name='encoder_rnn')
+        self.encoder_states = self.encode_content(inputs)
+
+        self._embeddings = self._cfg['embedding_layer'].configure(EmbeddingLayer,
+                                                                  input_size=len(vocabulary),
+                                                                  name='embedding_layer')
+
+        self._style_encoder_cnn = self._cfg['style_encoder_cnn'].configure(
+            CNN, training=self._is_training, name='style_encoder_cnn')
+        self._style_encoder_rnn = self._cfg['style_encoder_rnn'].configure(
+            RNNLayer, training=self._is_training, name='style_encoder_rnn')
+        self._style_projection = self._cfg['style_projection'].maybe_configure(
+            tf.layers.Dense, name='style_projection')
+        self._style_dropout = self._cfg['style_dropout'].maybe_configure(tf.layers.Dropout)
+        self.style_vector = self.encode_style(style_inputs)
 
         def cell_wrap_fn(cell):
             """Wrap the RNN cell in order to pass the style embedding as input."""
@@ -66,11 +101,12 @@ class Model:
             return cell
 
         with tf.variable_scope('attention'):
-            attention = self._cfg['attention_mechanism'].maybe_configure(memory=encoder_states)
+            attention = self._cfg['attention_mechanism'].maybe_configure(
+                memory=self.encoder_states)
 
         self.decoder = self._cfg['decoder'].configure(RNNDecoder,
                                                       vocabulary=vocabulary,
-                                                      embedding_layer=embeddings,
+                                                      embedding_layer=self._embeddings,
                                                       attention_mechanism=attention,
                                                       pre_attention=True,
                                                       training=self._is_training,
@@ -82,25 +118,97 @@ class Model:
             _, self.loss = self.decoder.decode_train(decoder_inputs, decoder_targets)
             self.training_ops = self._make_train_ops()
 
-        # Build the sampling and greedy version of the decoder
-        batch_size = tf.shape(inputs)[0]
+        # The inference versions of the decoder are built on demand
+        self._batch_size = tf.shape(inputs)[0]
         self.softmax_temperature = tf.placeholder(tf.float32, [], name='softmax_temperature')
-        self.sample_outputs, self.sample_final_state = self.decoder.decode(
-            mode='sample',
-            softmax_temperature=self.softmax_temperature,
-            batch_size=batch_size,
-            random_seed=sampling_seed)
-        self.greedy_outputs, self.greedy_final_state = self.decoder.decode(
-            mode='greedy',
-            batch_size=batch_size)
+        self._decoder_outputs = {}
+        if not train_mode and not decoder_modes:
+            decoder_modes = ('greedy',)
+        for mode in decoder_modes:
+            self.decode(mode)
+        self._num_variables = len(tf.global_variables())
 
         self._inputs = {
             'content_input': inputs, 'style_input': style_inputs,
             'style_embedding': self.style_vector, 'softmax_temperature': self.softmax_temperature,
         }
 
+    def encode_content(self, inputs):
+        """Build the content encoder on top of the given content input.
+
+        Returns:
+            The encoder states, a tensor of shape `[batch_size, time, num_units]`.
+        """
+        encoder_states, _ = self._encoder_rnn(self._encoder_cnn(inputs))
+        return encoder_states
+
+    def encode_style(self, style_inputs):
+        """Build the style encoder on top of the given style input (a batch of token IDs).
+
+        Returns:
+            The style embedding, a tensor of shape `[batch_size, embedding_size]`.
+        """
+        _, style_final_state = self._style_encoder_rnn(
+            self._style_encoder_cnn(self._embeddings.embed(style_inputs)))
+        style_vector = (self._style_projection(style_final_state) if self._style_projection
+                        else style_final_state)
+        if self._style_dropout:
+            style_vector = self._style_dropout(style_vector, training=self._is_training)
+        return style_vector
+
+    def decode(self, mode):
+        """Return the outputs and final state of the decoder in the given inference mode.
+
+        The decoder is built the first time a given mode is requested. All the variables are
+        created in the constructor, so this can be done after the variables have been loaded; if
+        the decoder did create new variables, a `RuntimeError` is raised, since they would never
+        be loaded.
+
+        Args:
+            mode: Either `'sample'` or `'greedy'`.
+        Returns:
+            A tuple `(outputs, final_state)`.
+        """
+        if mode not in self._decoder_outputs:
+            if mode == 'sample':
+                self._decoder_outputs[mode] = self.decoder.decode(
+                    mode='sample',
+                    softmax_temperature=self.softmax_temperature,
+                    batch_size=self._batch_size,
+                    random_seed=self._sampling_seed)
+            elif mode == 'greedy':
+                self._decoder_outputs[mode] = self.decoder.decode(
+                    mode='greedy',
+                    batch_size=self._batch_size)
+            else:
+                raise ValueError(f"mode '{mode}' not recognized")
+            if (hasattr(self, '_num_variables') and
+                    len(tf.global_variables()) != self._num_variables):
+                raise RuntimeError(f"Building the '{mode}' decoder created new variables; it "
+                                   'should be listed in decoder_modes')
+        return self._decoder_outputs[mode]
+
+    @property
+    def sample_outputs(self):
+        return self.decode('sample')[0]
+
+    @property
+    def sample_final_state(self):
+        return self.decode('sample')[1]
+
+    @property
+    def greedy_outputs(self):
+        return self.decode('greedy')[0]
+
+    @property
+    def greedy_final_state(self):
+        return self.decode('greedy')[1]
+
     def _make_train_ops(self):
-        train_op = self._cfg['training'].configure(create_train_op, loss=self.loss)
+        train_op = self._cfg['training'].configure(
+            create_train_op, loss=self.loss,
+            all_reduce_fn=(self._gradient_averager.all_reduce_mean
+                           if self._gradient_averager else None))
         init_op = tf.global_variables_initializer()
 
         tf.summary.scalar('train/loss', self.loss)
@@ -112,30 +220,76 @@ class Model:
                                         summary_op=train_summary_op,
                                         training_placeholder=self._is_training)
 
-    def run(self, session, dataset, sample=False, softmax_temperature=1., options=None):
-        _, output_ids_tensor = self.sample_outputs if sample else self.greedy_outputs
-
-        return self.dataset_manager.run_over_dataset(
-            session, output_ids_tensor, dataset,
-            feed_dict={self.softmax_temperature: softmax_temperature},
-            concat_batches=True,
-            options=options)
+    def run(self, session, dataset, sample=False, softmax_temperature=1., options=None,
+            cancel_fn=None):
+        """Run the decoder over a dataset and return the output IDs.
+
+        If `cancel_fn` is given, it is called before each batch, and a `RunCancelledError` is
+        raised as soon as it returns `True`.
+        """
+        outputs, _ = self.decode('sample' if sample else 'greedy')
+        _, output_ids_tensor = outputs
+        feed_dict = {self.softmax_temperature: softmax_temperature}
+
+        if cancel_fn is None:
+            return self.dataset_manager.run_over_dataset(
+                session, output_ids_tensor, dataset,
+                feed_dict=feed_dict,
+                concat_batches=True,
+                options=options)
+
+        if cancel_fn():
+            raise RunCancelledError()
+
+        self.dataset_manager.add_dataset('__run', dataset)
+        self.dataset_manager.initialize_dataset(session, '__run')
+        try:
+            results = []
+            while True:
+                try:
+                    results.extend(self.dataset_manager.run(
+                        session, output_ids_tensor, '__run', feed_dict=dict(feed_dict),
+                        options=options))
+                except tf.errors.OutOfRangeError:
+                    break
+                if cancel_fn():
+                    raise RunCancelledError()
+        finally:
+            self.dataset_manager.remove_dataset('__run')
+
+        return results or None
 
 
 @configurable
 class Experiment:
 
-    def __init__(self, logdir, train_mode, sampling_seed=None):
+    def __init__(self, logdir, train_mode, sampling_seed=None, decoder_modes=(),
+                 validation_only=False, gradient_averager=None, num_threads=None):
         random_seed = self._cfg.get('random_seed', None)
         set_random_seed(random_seed)
         self.logdir = logdir
+        self._gradient_averager = gradient_averager
+        self._num_threads = num_threads
 
         self.input_encoding = self._cfg['input_encoding'].configure()
         self.output_encoding = self._cfg['output_encoding'].configure()
 
+        # Style sequences are often reused (e.g. the same style for many inputs), so they can be
+        # cached together with their filtered and encoded versions
+        self._style_cache = None
+        if self._cfg.get('style_cache_bytes'):
+            self._style_cache = SequenceCache(self._cfg.get('style_cache_bytes'),
+                                              name='Style cache')
+
         num_rows = getattr(self.input_encoding, 'num_rows', None)
         self.input_shapes = (([num_rows, None] if num_rows else [None]), [None], [None], [None])
         self.input_types = (tf.float32 if num_rows else tf.int32, tf.int32, tf.int32, tf.int32)
+        # Piano rolls are mostly zeros, so they can be passed through the input pipeline in
+        # a sparse format and only converted to dense arrays in the graph
+        self._sparse_content_input = bool(num_rows) and self._cfg.get('sparse_content_input',
+                                                                      False)
+        if self._sparse_content_input:
+            self.input_shapes = ([None, 3], *self.input_shapes[1:])
         self.dataset_manager = DatasetManager(
             output_types=self.input_types,
             output_shapes=tuple([None, *shape] for shape in self.input_shapes))
@@ -144,31 +298,115 @@ class Experiment:
                                                   dataset_manager=self.dataset_manager,
                                                   train_mode=train_mode,
                                                   vocabulary=self.output_encoding.vocabulary,
-                                                  sampling_seed=sampling_seed)
+                                                  sampling_seed=sampling_seed,
+                                                  decoder_modes=decoder_modes,
+                                                  sparse_content_rows=(
+                                                      num_rows if self._sparse_content_input
+                                                      else None),
+                                                  gradient_averager=gradient_averager)
 
         self._load_checkpoint = self._cfg.get('load_checkpoint', None)
         if self._load_checkpoint and self.model.training_ops is not None:
             self.model.training_ops.init_op = ()
 
-        self.trainer = self._cfg['trainer'].configure(BasicTrainer,
-                                                      session=tf.Session(),
+        session_config = None
+        if num_threads:
+            session_config = tf.ConfigProto(intra_op_parallelism_threads=num_threads,
+                                            inter_op_parallelism_threads=num_threads)
+        self.trainer = self._cfg['trainer'].configure(Trainer,
+                                                      session=tf.Session(config=session_config),
                                                       dataset_manager=self.dataset_manager,
                                                       training_ops=self.model.training_ops,
                                                       logdir=logdir,
-                                                      write_summaries=train_mode)
-
-        if train_mode:
+                                                      write_summaries=train_mode,
+                                                      batch_stats=(self.model.batch_stats
+                                                                   if train_mode else None),
+                                                      validator_command=(
+                                                          self._get_validator_command()
+                                                          if train_mode and not validation_only
+                                                          else None),
+                                                      is_chief=(gradient_averager is None or
+                                                                gradient_averager.rank == 0))
+
+        # The validation process (see the validate command) builds the training graph, so that
+        # the checkpoints it saves are the same as the ones saved during training, but only needs
+        # the validation data
+        if train_mode and not validation_only:
             # Configure the dataset manager with the training and validation data.
-            train_loader = self._cfg['train_data'].configure(TrainLoader, random_seed=random_seed)
-            val_loader = self._cfg['val_data'].configure(TrainLoader, random_seed=random_seed,
-                                                         reseed=True)
             self._cfg['data_prep'].configure(
                 prepare_train_and_val_data,
                 dataset_manager=self.dataset_manager,
-                train_generator=self._load_data(train_loader, training=True),
-                val_generator=self._load_data(val_loader),
+                train_generator=self._make_data_generator('train'),
+                val_generator=self._make_data_generator('val'),
                 output_types=self.input_types,
-                output_shapes=self.input_shapes)
+                output_shapes=self.input_shapes,
+                length_fn=lambda src, style, tgt_in, tgt_out: [tf.shape(tgt_in)[0],
+                                                               tf.shape(style)[0]])
+
+    def __getstate__(self):
+        # Only the state needed for loading the data is pickled (to be sent to the data workers,
+        # see `_make_data_generator`), not the model and the TensorFlow session
+        state = dict(self.__dict__)
+        for name in ['dataset_manager', 'model', 'trainer', '_gradient_averager']:
+            state.pop(name, None)
+        return state
+
+    def _get_validator_command(self):
+        """Return the command to run the validate command for this model in a new process."""
+        return [sys.executable, '-m', 'groove2groove.models.roll2seq_style_transfer',
+                '--logdir', self.logdir, 'validate', '--watch']
+
+    def _make_loader(self, name):
+        random_seed = self._cfg.get('random_seed', None)
+        if name == 'train':
+            # The filters are used to skip examples if the loader has a statistics index
+            return self._cfg['train_data'].configure(
+                TrainLoader, random_seed=random_seed,
+                note_filters=list(self._cfg.get('style_note_filters', {}).values()) or None,
+                max_target_notes=self._cfg.get('max_target_length', None),
+                cache=self._style_cache)
+        return self._cfg[f'{name}_data'].configure(TrainLoader, random_seed=random_seed,
+                                                   reseed=True, cache=self._style_cache)
+
+    def _make_data_generator(self, name):
+        """Return a generator function yielding the encoded training or validation examples.
+
+        If `train_shards` (resp. `val_shards`) is configured, the examples are read from the
+        shards written by the `preencode` command instead of being loaded and encoded on the fly.
+        """
+        random_seed = self._cfg.get('random_seed', None)
+        # In data-parallel training, each worker gets a different part of the training data
+        num_replicas, replica = 1, 0
+        if name == 'train' and self._gradient_averager is not None:
+            num_replicas = self._gradient_averager.num_workers
+            replica = self._gradient_averager.rank
+
+        if f'{name}_shards' in self._cfg:
+            if name == 'train':
+                loader = self._cfg['train_shards'].configure(ShardLoader, random_seed=random_seed)
+                if num_replicas > 1:
+                    loader = loader.shard(num_replicas, replica)
+            else:
+                loader = self._cfg[f'{name}_shards'].configure(ShardLoader, shuffle=False,
+                                                               random_seed=random_seed,
+                                                               reseed=True)
+            return loader.load
+
+        loader = self._make_loader(name)
+        num_workers = self._cfg.get('num_data_workers', 1)
+        if name == 'train' and num_workers > 1:
+            def generator():
+                # Each worker process loads and encodes a different part of the data
+                return interleave_parallel([
+                    functools.partial(_load_train_data, self,
+                                      loader.shard(num_replicas * num_workers,
+                                                   replica + num_replicas * i))
+                    for i in range(num_workers)])
+            return generator
+
+        if num_replicas > 1:
+            loader = loader.shard(num_replicas, replica)
+        return self._load_data(loader, training=(name == 'train'))
 
     def train(self, args):
         del args
@@ -176,8 +414,51 @@ class Experiment:
             self.trainer.load_variables(
                 checkpoint_file=os.path.join(self.logdir, self._load_checkpoint))
 
-        _LOGGER.info('Starting training.')
-        self.trainer.train()
+        if self._gradient_averager is None:
+            _LOGGER.info('Starting training.')
+            self.trainer.train()
+            return
+
+        averager = self._gradient_averager
+        session = self.trainer.session
+        with session.graph.as_default():
+            variables = tf.trainable_variables()
+        workers = []
+        if averager.rank == 0:
+            averager.allocate(sum(variable.shape.num_elements() for variable in variables))
+            workers = start_workers(averager, _train_worker, args=(self.logdir, self._num_threads))
+        try:
+            if not self._load_checkpoint:
+                session.run(self.model.training_ops.init_op)
+                self.model.training_ops.init_op = ()
+            broadcast_variables(averager, session, variables)
+
+            _LOGGER.info(f'Starting training in worker {averager.rank + 1}/{averager.num_workers}.')
+            self.trainer.train()
+        except BaseException:
+            averager.stop(failed=True)
+            raise
+        finally:
+            averager.stop()
+            join_workers(workers)
+
+    def validate(self, args):
+        val_dataset = make_simple_dataset(self._make_data_generator('val'),
+                                          output_types=self.input_types,
+                                          output_shapes=self.input_shapes,
+                                          batch_size=self._cfg['data_prep'].get('val_batch_size'),
+                                          name='val')
+        if args.max_batches:
+            val_dataset = val_dataset.take(args.max_batches)
+        self.dataset_manager.add_dataset('val', val_dataset)
+
+        if args.watch:
+            self.trainer.watch_validation(poll_interval=args.poll_interval)
+            return
+
+        self.trainer.load_variables(checkpoint_name='latest', checkpoint_file=args.checkpoint)
+        loss = self.trainer.validate(write_summaries=True)
+        _LOGGER.info(f'step: {self.trainer.step}, val_loss: {loss}')
 
     def run_midi(self, args):
         pipeline = MidiPipeline(source_path=args.source_file, style_path=args.style_file,
@@ -185,9 +466,76 @@ class Experiment:
         sequences = self._run_cli(args, pipeline)
         pipeline.save(sequences, args.output_file)
 
+    def run_midi_batch(self, args):
+        with open(args.manifest, 'r') as f:
+            manifest = [row for row in csv.reader(f, delimiter='\t') if row]
+        for row in manifest:
+            if len(row) != 3:
+                raise ValueError(f'Expected 3 columns in manifest, got {len(row)}: {row}')
+
+        self.trainer.load_variables(checkpoint_name='latest', checkpoint_file=args.checkpoint)
+
+        # A song that fails to load or save is skipped, so that the rest are still processed
+        failed_rows = []
+
+        # Use 'spawn' so that the workers do not inherit the TensorFlow runtime.
+        with multiprocessing.get_context('spawn').Pool(args.num_workers) as pool:
+            save_results = []
+            for start in range(0, len(manifest), args.songs_per_run):
+                chunk = manifest[start:start + args.songs_per_run]
+                _LOGGER.info(f'Processing songs {start + 1}-{start + len(chunk)} '
+                             f'of {len(manifest)}')
+
+                # Parse the MIDI files in parallel, then run the model on the segments of all
+                # songs in the chunk at once.
+                load_results = pool.starmap(
+                    load_midi_pipeline,
+                    [(source_path, style_path, args.bars_per_segment, True)
+                     for source_path, style_path, _ in chunk])
+                pipelines, rows = [], []
+                for row, (sub_pipeline, error) in zip(chunk, load_results):
+                    if error is not None:
+                        _LOGGER.error(f'Failed to load {row[0]} or {row[1]}:\n{error}')
+                        failed_rows.append(row)
+                        continue
+                    pipelines.append(sub_pipeline)
+                    rows.append(row)
+                if not pipelines:
+                    continue
+
+                pipeline = ConcatPipeline(pipelines)
+                sequences = self.run(pipeline, batch_size=args.batch_size, filters=args.filters,
+                                     sample=args.sample,
+                                     softmax_temperature=args.softmax_temperature)
+
+                # Save asynchronously while the next chunk is being processed.
+                save_results.append((rows, pool.starmap_async(
+                    save_midi_pipeline,
+                    [(sub_pipeline, sub_sequences, output_path)
+                     for sub_pipeline, sub_sequences, (_, _, output_path)
+                     in zip(pipelines, pipeline.split(sequences), rows)])))
+
+            for rows, result in save_results:
+                for row, error in zip(rows, result.get()):
+                    if error is not None:
+                        _LOGGER.error(f'Failed to save {row[2]}:\n{error}')
+                        failed_rows.append(row)
+
+        if failed_rows:
+            _LOGGER.error(f'{len(failed_rows)} of {len(manifest)} songs failed')
+
+    def preencode(self, args):
+        metadata_list = []
+        generator = self._load_data(self._make_loader(args.data), training=(args.data == 'train'),
+                                    metadata_list=metadata_list)
+        with ShardWriter(args.output_dir, shard_size=args.shard_size) as writer:
+            for example in generator():
+                writer.add(example, filter_name=metadata_list.pop()['filter_name'])
+        _LOGGER.info(f'Wrote {writer.num_examples} examples to {args.output_dir}')
+
     def run_test(self, args):
         pipeline = EvalPipeline(source_db_path=args.source_db, style_db_path=args.style_db,
-                                key_pairs_path=args.key_pairs)
+                                key_pairs_path=args.key_pairs, cache=self._style_cache)
         sequences = self._run_cli(args, pipeline)
         pipeline.save(sequences, args.output_db)
 
@@ -197,19 +545,29 @@ class Experiment:
                         sample=args.sample, softmax_temperature=args.softmax_temperature)
 
     def run(self, pipeline, batch_size=None, filters='program', sample=False,
-            softmax_temperature=1., normalize_velocity=False, options=None):
+            softmax_temperature=1., normalize_velocity=False, options=None, cancel_fn=None):
+        """Run the model on the inputs from the given pipeline.
+
+        If `cancel_fn` is given, it is called between input segments and between batches, and as
+        soon as it returns `True`, no more segments are loaded and a `RunCancelledError` is raised.
+        """
         metadata_list = []  # gather metadata about each item of the dataset
         apply_filters = '__program__' if filters == 'program' else True
-        dataset = make_simple_dataset(
-            self._load_data(tqdm.tqdm(pipeline), apply_filters=apply_filters,
+        loader = tqdm.tqdm(pipeline)
+        if cancel_fn is not None:
+            loader = _iter_until_cancelled(loader, cancel_fn)
+        # The examples are encoded and padded batch by batch, outside of TensorFlow
+        dataset = make_batched_dataset(
+            self._load_data(loader, apply_filters=apply_filters,
                             normalize_velocity=normalize_velocity,
-                            metadata_list=metadata_list),
+                            metadata_list=metadata_list,
+                            batch_size=batch_size or self._cfg['data_prep'].get('val_batch_size')),
             output_types=self.input_types,
-            output_shapes=self.input_shapes,
-            batch_size=batch_size or self._cfg['data_prep'].get('val_batch_size'))
+            output_shapes=self.input_shapes)
         output_ids = self.model.run(
-            self.trainer.session, dataset, sample, softmax_temperature, options=options) or []
-        sequences = [self.output_encoding.decode(ids) for ids in output_ids]
+            self.trainer.session, dataset, sample, softmax_temperature, options=options,
+            cancel_fn=cancel_fn) or []
+        sequences = self._decode_outputs(output_ids)
         merged_sequences = []
         instrument_id = 0
         for seq, meta in zip(sequences, metadata_list):
@@ -236,14 +594,31 @@ class Experiment:
             instrument_info.instrument = instrument_id
             instrument_info.name = meta['filter_name']
 
+        # Inputs at the end which produced no outputs (e.g. because the style input was empty)
+        # still need an (empty) output so that the outputs stay aligned with the inputs.
+        num_inputs = len(getattr(pipeline, 'key_pairs', None) or [])
+        while len(merged_sequences) < num_inputs:
+            merged_sequences.append(music_pb2.NoteSequence())
+
         return merged_sequences
 
+    def _decode_outputs(self, output_ids):
+        """Decode the output IDs returned by `Model.run` into `NoteSequence`s."""
+        if hasattr(self.output_encoding, 'decode_batch'):
+            return self.output_encoding.decode_batch(output_ids)
+        return [self.output_encoding.decode(ids) for ids in output_ids]
+
     def _load_data(self, loader, training=False, encode=True, apply_filters=True,
-                   metadata_list=None, normalize_velocity=False):
+                   metadata_list=None, normalize_velocity=False, batch_size=None):
+        """Return a generator function yielding the examples from the given loader.
+
+        If `batch_size` is given (and `encode` is `True`), the generator yields whole batches of
+        padded arrays (made by `encode_batch`) instead of individual examples.
+        """
         max_target_len = self._cfg.get('max_target_length', np.inf)
         if apply_filters is False:
             filter_kwargs_dict = {'__all__': {}}
-            filter_names = '__all__'
+            filter_names = ['__all__']
         elif apply_filters == '__program__':
             filter_kwargs_dict = None
         else:
@@ -257,36 +632,37 @@ class Experiment:
             i = 0
             long_skip_count = 0
             empty_count = 0
+            batch = []
             for input_index, (src_seq, style_seq_all, tgt_seq_all) in enumerate(loader):
+                # The sequence returned by the loader, used to look up cached values
+                style_seq_loaded = style_seq_all
                 if normalize_velocity:
                     src_seq, style_seq_all, tgt_seq_all = (
                         self._normalize_velocity(seq)
                         for seq in (src_seq, style_seq_all, tgt_seq_all))
 
+                # Split the style and the target into one sequence per filter
                 if apply_filters == '__program__':
                     # Create a filter for each program
-                    programs = sorted(set((n.program, n.is_drum) for n in style_seq_all.notes))
-                    filters = [
-                        (f'program{p}' + ('d' if d else ''),
-                         dict(programs=[p], drums=d))
-                        for p, d in programs
-                    ]
+                    style_seqs = self._get_cached_style_value(
+                        style_seq_loaded, ('partitioned', '__program__', normalize_velocity),
+                        lambda: partition_sequence(style_seq_all))
+                    filters = (get_program_filters(style_seq_all) if tgt_seq_all is not None
+                               else None)
                 else:
-                    filters = [(name, filter_kwargs_dict[name]) for name in filter_names]
-
-                for filter_name, filter_kwargs in filters:
-                    tgt_seq = None
-                    if tgt_seq_all is not None:
-                        tgt_seq = music_pb2.NoteSequence()
-                        tgt_seq.CopyFrom(tgt_seq_all)
-                        filter_sequence(tgt_seq, **filter_kwargs)
-                        if training and tgt_seq is not None and len(tgt_seq.notes) > max_target_len:
-                            long_skip_count += 1
-                            continue
-
-                    style_seq = music_pb2.NoteSequence()
-                    style_seq.CopyFrom(style_seq_all)
-                    filter_sequence(style_seq, **filter_kwargs)
+                    filters = {name: filter_kwargs_dict[name] for name in filter_names}
+                    style_seqs = self._get_cached_style_value(
+                        style_seq_loaded, ('partitioned', tuple(filters), normalize_velocity),
+                        lambda: partition_sequence(style_seq_all, filters))
+                tgt_seqs = {}
+                if tgt_seq_all is not None:
+                    tgt_seqs = partition_sequence(tgt_seq_all, filters)
+
+                for filter_name, style_seq in style_seqs.items():
+                    tgt_seq = tgt_seqs.get(filter_name)
+                    if training and tgt_seq is not None and len(tgt_seq.notes) > max_target_len:
+                        long_skip_count += 1
+                        continue
 
                     if training and (not src_seq.notes or not style_seq.notes):
                         empty_count += 1
@@ -308,23 +684,61 @@ class Experiment:
                             }
                         metadata_list.append(metadata_entry)
 
-                    if encode:
+                    if encode and batch_size:
+                        style_encoded = self._get_cached_style_value(
+                            style_seq_loaded, ('encoded', filter_name, normalize_velocity),
+                            lambda: self.output_encoding.encode(style_seq))
+                        batch.append((src_seq, style_encoded, tgt_seq))
+                        if len(batch) == batch_size:
+                            yield self._encode_batch(batch)
+                            batch = []
+                    elif encode:
                         src_encoded = self.input_encoding.encode(src_seq)
+                        if self._sparse_content_input:
+                            src_encoded = sparsify_roll(src_encoded)
                         tgt_encoded = self.output_encoding.encode(
                             tgt_seq, add_start=True, add_end=True) if tgt_seq is not None else []
-                        style_encoded = self.output_encoding.encode(style_seq)
+                        style_encoded = self._get_cached_style_value(
+                            style_seq_loaded, ('encoded', filter_name, normalize_velocity),
+                            lambda: self.output_encoding.encode(style_seq))
                         yield src_encoded, style_encoded, tgt_encoded[:-1], tgt_encoded[1:]
                     else:
                         yield src_seq, style_seq, tgt_seq
 
                     i += 1
 
+            if batch:
+                yield self._encode_batch(batch)
+
             if training:
                 _LOGGER.info(f'Done loading data: {i} examples; '
                              f'skipped: {long_skip_count} too long, {empty_count} empty')
 
         return generator
 
+    def _encode_batch(self, examples):
+        """Encode a list of `(src_seq, style_encoded, tgt_seq)` tuples into a batch."""
+        src_seqs, style_encoded, tgt_seqs = zip(*examples)
+        src, _ = encode_batch(self.input_encoding, src_seqs)
+        if self._sparse_content_input:
+            src, _ = pad_batch([sparsify_roll(roll) for roll in src], axis=0)
+        pad_id = self.output_encoding.vocabulary.pad_id
+        style, _ = pad_token_batch(style_encoded, pad_id=pad_id)
+
+        # The decoder inputs are the targets without the end token, the decoder targets are
+        # the targets without the start token
+        tgt, tgt_lengths = encode_batch(self.output_encoding, tgt_seqs,
+                                        add_start=True, add_end=True)
+        tgt_in = np.where(np.arange(tgt.shape[1] - 1) < tgt_lengths[:, np.newaxis] - 1,
+                          tgt[:, :-1], pad_id)
+        return src, style, tgt_in, tgt[:, 1:]
+
+    def _get_cached_style_value(self, style_seq, name, compute_fn):
+        """Return a value derived from a style sequence, using the style cache if enabled."""
+        if self._style_cache is None or not isinstance(style_seq, music_pb2.NoteSequence):
+            return compute_fn()
+        return self._style_cache.get_derived(style_seq, name, compute_fn)
+
     def _normalize_velocity(self, seq):
         if seq is None:
             return None
@@ -337,26 +751,95 @@ class Experiment:
 
         target_mean = self._cfg['normalize_velocity'].get('mean')
         target_std = np.sqrt(self._cfg['normalize_velocity'].get('variance'))
-        velocities = np.fromiter((n.velocity for n in seq.notes if n.velocity), dtype=np.float32)
-        mean = np.mean(velocities)
-        std = np.std(velocities)
-
-        for note in seq.notes:
-            velocity = (note.velocity - mean) / (std + 1e-5) * target_std + target_mean
-            velocity = np.rint(velocity).astype(np.int32)
-            note.velocity = np.clip(velocity, 1, 127)
+        notes = NoteArray.from_sequence(seq).normalize_velocity(target_mean, target_std)
+        notes.write_fields(seq, ['velocity'])
 
         return seq
 
 
+def _make_batch_stats(inputs, style_inputs, decoder_targets, pad_id):
+    """Create tensors describing a batch, used by the trainer for profiling.
+
+    The tensors are only computed when fetched, so they cost nothing otherwise.
+    """
+    with tf.name_scope('batch_stats'):
+        # The time when the batch was obtained from the input pipeline
+        with tf.control_dependencies([inputs, style_inputs, decoder_targets]):
+            input_timestamp = tf.timestamp()
+
+        def count_tokens(ids):
+            return tf.count_nonzero(tf.not_equal(ids, pad_id), dtype=tf.int32)
+
+        return {
+            'input_timestamp': input_timestamp,
+            'batch_size': tf.shape(decoder_targets)[0],
+            'target_tokens': count_tokens(decoder_targets),
+            'target_padded_tokens': tf.size(decoder_targets),
+            'style_tokens': count_tokens(style_inputs),
+            'style_padded_tokens': tf.size(style_inputs),
+        }
+
+
+def _train_worker(logdir, num_threads, gradient_averager):
+    """Run a data-parallel training worker other than the chief (see `Experiment.train`)."""
+    with open(os.path.join(logdir, 'model.yaml'), 'rb') as f:
+        config = Configuration.from_yaml(f)
+    experiment = config.configure(Experiment, logdir=logdir, train_mode=True,
+                                  gradient_averager=gradient_averager, num_threads=num_threads)
+    experiment.train(None)
+
+
+def _load_train_data(experiment, loader):
+    """Load and encode the training examples from the given loader (run by the data workers)."""
+    return experiment._load_data(loader, training=True)()  # pylint: disable=protected-access
+
+
+def _iter_until_cancelled(iterable, cancel_fn):
+    """Iterate over the items of `iterable` until `cancel_fn` returns `True`."""
+    for item in iterable:
+        if cancel_fn():
+            return
+        yield item
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--logdir', type=str, required=True, help='model directory')
-    parser.set_defaults(train_mode=False, sampling_seed=None)
+    parser.set_defaults(train_mode=False, validation_only=False, num_replicas=1, sampling_seed=None,
+                        sample=None)
     subparsers = parser.add_subparsers(title='action')
 
     subparser = subparsers.add_parser('train')
     subparser.set_defaults(func=Experiment.train, train_mode=True)
+    subparser.add_argument('--profile', action='store_true',
+                           help='profile the training steps (unless configured in the '
+                           'profiling section of the trainer configuration)')
+    subparser.add_argument('--num-workers', default=1, type=int, dest='num_replicas',
+                           help='the number of data-parallel training processes; the gradients '
+                           'are averaged over them, so the effective batch size is multiplied')
+    subparser.add_argument('--threads-per-worker', default=None, type=int,
+                           help='the number of TensorFlow threads per training process (default: '
+                           'the number of CPUs divided by the number of workers)')
+
+    subparser = subparsers.add_parser('validate')
+    subparser.set_defaults(func=Experiment.validate, train_mode=True, validation_only=True)
+    subparser.add_argument('--checkpoint', default=None, type=str)
+    subparser.add_argument('--watch', action='store_true',
+                           help='validate the checkpoints submitted by a training process with '
+                           'async_validation until the training finishes (instead of validating '
+                           'the latest checkpoint)')
+    subparser.add_argument('--max-batches', default=None, type=int,
+                           help='the maximum number of validation batches to use')
+    subparser.add_argument('--poll-interval', default=10., type=float,
+                           help='how often to look for new checkpoints, in seconds')
+
+    subparser = subparsers.add_parser('preencode')
+    subparser.set_defaults(func=Experiment.preencode)
+    subparser.add_argument('output_dir', metavar='OUTPUTDIR')
+    subparser.add_argument('--data', choices=['train', 'val'], default='train',
+                           help='which data to encode (train_data or val_data)')
+    subparser.add_argument('--shard-size', default=10000, type=int,
+                           help='the number of examples per shard')
 
     subparser = subparsers.add_parser('run-midi')
     subparser.set_defaults(func=Experiment.run_midi)
@@ -373,6 +856,26 @@ def main():
                            'during training; program: filter by MIDI program')
     subparser.add_argument('-b', '--bars-per-segment', default=8, type=int)
 
+    subparser = subparsers.add_parser('run-midi-batch')
+    subparser.set_defaults(func=Experiment.run_midi_batch)
+    subparser.add_argument('manifest', metavar='MANIFEST',
+                           help='a TSV file containing on each line a source MIDI file path, '
+                           'a style MIDI file path and an output MIDI file path')
+    subparser.add_argument('--checkpoint', default=None, type=str)
+    subparser.add_argument('--batch-size', default=None, type=int)
+    subparser.add_argument('--sample', action='store_true')
+    subparser.add_argument('--softmax-temperature', default=1., type=float)
+    subparser.add_argument('--seed', type=int, dest='sampling_seed')
+    subparser.add_argument('--filters', choices=['training', 'program'], default='program',
+                           help='how to filter the input; training: use the same filters as '
+                           'during training; program: filter by MIDI program')
+    subparser.add_argument('-b', '--bars-per-segment', default=8, type=int)
+    subparser.add_argument('--num-workers', default=None, type=int,
+                           help='the number of processes for reading and writing MIDI files '
+                           '(default: the number of CPUs)')
+    subparser.add_argument('--songs-per-run', default=256, type=int,
+                           help='the number of songs whose segments are batched together')
+
     subparser = subparsers.add_parser('run-test')
     subparser.set_defaults(func=Experiment.run_test)
     subparser.add_argument('source_db', metavar='INPUTDB')
@@ -393,11 +896,25 @@ def main():
     config_file = os.path.join(args.logdir, 'model.yaml')
     with open(config_file, 'rb') as f:
         config = Configuration.from_yaml(f)
+    if getattr(args, 'profile', False) and 'profiling' not in config['trainer']:
+        config['trainer']['profiling'] = {}
     _LOGGER.debug(config)
 
+    gradient_averager, num_threads = None, None
+    if args.train_mode and not args.validation_only and args.num_replicas > 1:
+        gradient_averager = GradientAverager(args.num_replicas)
+        num_threads = (args.threads_per_worker or
+                       max(multiprocessing.cpu_count() // args.num_replicas, 1))
+
+    # Build upfront only the decoder needed by the command (if any)
+    decoder_modes = () if args.sample is None else ('sample' if args.sample else 'greedy',)
     experiment = config.configure(Experiment,
                                   logdir=args.logdir, train_mode=args.train_mode,
-                                  sampling_seed=args.sampling_seed)
+                                  sampling_seed=args.sampling_seed,
+                                  decoder_modes=decoder_modes,
+                                  validation_only=args.validation_only,
+                                  gradient_averager=gradient_averager,
+                                  num_threads=num_threads)
     args.func(experiment, args)
 
 
@@ -0,0 +1,436 @@
+"""A trainer with optional profiling and asynchronous validation.
+
+`Trainer` extends `museflow.trainer.BasicTrainer`, see its docstring for the configuration.
+"""
+import glob
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+
+import numpy as np
+import tensorflow as tf
+from confugue import configurable
+from museflow.trainer import DEFAULT, BasicTrainer, training_validation_loop
+from tensorflow.python.client import timeline
+
+_LOGGER = logging.getLogger(__name__)
+
+
+@configurable
+class Trainer(BasicTrainer):
+    """`BasicTrainer` with optional profiling of the training steps and asynchronous validation.
+
+    Profiling is enabled by adding a `profiling` section (possibly empty) to the configuration
+    of the trainer, holding the arguments of `StepProfiler`, e.g.:
+
+        trainer:
+          profiling:
+            trace_start: 1000
+            trace_steps: 5
+
+    Similarly, an `async_validation` section (holding the arguments of `AsyncValidation`) makes
+    the validation run in a separate process, so that the training does not pause for it.
+
+    Args:
+        batch_stats: A dictionary of tensors describing the current batch (see `StepProfiler`).
+            Required for profiling.
+        validator_command: The command to start a validation process running `watch_validation`
+            (see `AsyncValidation`). Required for asynchronous validation.
+        is_chief: If `False`, the trainer is one of the data-parallel workers other than the
+            chief (see `groove2groove.models.data_parallel`), so it only runs the training steps,
+            without validation, summaries or profiling.
+    """
+
+    def __init__(self, dataset_manager, logdir, logging_period, validation_period=None,
+                 training_ops=None, session=None, write_summaries=True,
+                 train_dataset_name='train', val_dataset_name='val', batch_stats=None,
+                 validator_command=None, is_chief=True):
+        if not is_chief:
+            validation_period = None
+            write_summaries = False
+            batch_stats = validator_command = None
+
+        super().__init__(dataset_manager=dataset_manager,
+                         logdir=logdir,
+                         logging_period=logging_period,
+                         validation_period=validation_period,
+                         training_ops=training_ops,
+                         session=session,
+                         write_summaries=write_summaries,
+                         train_dataset_name=train_dataset_name,
+                         val_dataset_name=val_dataset_name)
+
+        self._is_chief = is_chief
+
+        self._profiler = None
+        if batch_stats is not None:
+            self._profiler = self._cfg['profiling'].maybe_configure(
+                StepProfiler, logdir=logdir, batch_stats=batch_stats)
+        if self._profiler is not None:
+            self._profiling_session = _ProfilingSession(self.session)
+
+        self._async_validation = None
+        if validator_command is not None:
+            self._async_validation = self._cfg['async_validation'].maybe_configure(
+                AsyncValidation, logdir=logdir, command=validator_command)
+
+    def train(self, dataset_name=None):
+        try:
+            result = super().train(dataset_name=dataset_name)
+        except BaseException:
+            if self._async_validation is not None:
+                self._async_validation.stop()
+            raise
+        if self._async_validation is not None:
+            self._async_validation.finish()
+        return result
+
+    def iter_train(self, dataset_name=None, period=DEFAULT):
+        if self._is_chief:
+            return super().iter_train(dataset_name=dataset_name, period=period)
+
+        # Like BasicTrainer.iter_train, but without validation (and hence without checkpoints)
+        def training_step_fn():
+            loss, _ = self.training_step(dataset_name=dataset_name or self._train_dataset_name)
+            return self._step, loss
+
+        return training_validation_loop(training_step_fn=training_step_fn,
+                                        init_fn=lambda: self.session.run(self._ops.init_op),
+                                        yield_period=None if period == DEFAULT else period,
+                                        initial_step=self._step)
+
+    def validate(self, write_summaries=False):
+        if self._async_validation is None:
+            return super().validate(write_summaries=write_summaries)
+
+        # The training loop has just saved the latest checkpoint; hand it over to the validation
+        # process instead. The loss is unknown, so the best checkpoint is saved by that process.
+        self._async_validation.submit(
+            tf.train.latest_checkpoint(self._logdir, 'latest_checkpoint'), self._step)
+        return np.nan
+
+    def watch_validation(self, poll_interval=10.):
+        """Validate the checkpoints submitted by a training process until it finishes.
+
+        This is what the process started by `AsyncValidation` runs. Only the most recent of the
+        pending checkpoints is validated, the others are skipped. The validation loss is written
+        as a summary at the step of the checkpoint, and if it is the lowest so far, the variables
+        are saved as the `'best'` checkpoint (like `BasicTrainer` does).
+
+        Args:
+            poll_interval: How often to look for new checkpoints, in seconds.
+        """
+        validation_dir = os.path.join(self._logdir, AsyncValidation.DIRNAME)
+        best_path = os.path.join(validation_dir, 'best.json')
+        best_loss = np.inf
+        if os.path.exists(best_path):
+            with open(best_path) as f:
+                best_loss = json.load(f)['loss']
+
+        parent_pid = os.getppid()
+        while True:
+            checkpoints = _list_checkpoints(validation_dir)
+            if not checkpoints:
+                if os.path.exists(os.path.join(validation_dir, AsyncValidation.DONE_FILENAME)):
+                    break
+                if os.getppid() != parent_pid:
+                    _LOGGER.warning('The training process has exited, stopping validation')
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            for path in checkpoints[:-1]:
+                _LOGGER.info(f'Skipping {path}')
+                _remove_checkpoint(path)
+            path = checkpoints[-1]
+
+            self.load_variables(checkpoint_file=path)
+            loss = self.validate(write_summaries=True)
+            if self._writer:
+                self._writer.flush()
+            _LOGGER.info(f'step: {self._step}, val_loss: {loss}')
+            if loss < best_loss:
+                best_loss = loss
+                self.save_variables('best')
+                with open(best_path, 'w') as f:
+                    json.dump({'step': int(self._step), 'loss': float(loss)}, f)
+            _remove_checkpoint(path)
+
+    def training_step(self, dataset_name, feed_dict=None, write_summaries=True, log=True):
+        if self._profiler is None:
+            return super().training_step(dataset_name, feed_dict=feed_dict,
+                                         write_summaries=write_summaries, log=log)
+
+        if feed_dict is None:
+            feed_dict = {}
+
+        options, self._profiling_session.run_metadata = self._profiler.get_run_options(
+            self._step + 1)
+        start_time = time.time()
+        _, train_summary, train_loss, batch_stats = self._dataset_manager.run(
+            self._profiling_session,
+            (self._ops.train_op, self._ops.summary_op, self._ops.loss,
+             self._profiler.batch_stats),
+            dataset_name, feed_dict={self._ops.training_placeholder: True, **feed_dict},
+            options=options)
+        end_time = time.time()
+
+        self._step = self.session.run(self._global_step_tensor)
+        self._profiler.record(self._step, start_time, end_time, batch_stats,
+                              self._profiling_session.run_metadata)
+
+        if self._step % self._logging_period == 0:
+            if write_summaries and train_summary and self._writer:
+                self._writer.add_summary(train_summary, self._step)
+            summary = self._profiler.summarize()
+            if write_summaries:
+                for name, value in summary.items():
+                    self.write_scalar_summary(f'profile/{name}', value)
+            if log:
+                _LOGGER.info(f'step: {self._step}, loss: {train_loss}, ' +
+                             ', '.join(f'{name}: {value:.4g}' for name, value in summary.items()))
+
+        return train_loss, train_summary
+
+
+@configurable
+class AsyncValidation:
+    """Runs the validation in a separate process while the training goes on.
+
+    Each checkpoint to validate is hard-linked (or copied) to the `validation` subdirectory of the
+    log directory, where the validation process (started on the first call of `submit` and again
+    if it exits) picks it up and deletes it once done (see `Trainer.watch_validation`). Since the
+    training does not wait for the validation, a slow validation process only skips some of the
+    checkpoints. The validation summaries are written to the same log directory.
+
+    The validation process runs with a lower priority (a higher `nice` value) and by default only
+    sees the CPU, so that it does not compete with the training for the GPU memory. Its output
+    goes to `validation/log.txt`.
+
+    Args:
+        logdir: The log directory.
+        command: The command to start the validation process. It should accept the
+            `--poll-interval` and `--max-batches` options.
+        nice: The increment of the niceness of the validation process.
+        max_batches: The maximum number of validation batches to use. If given, the validation
+            loss is computed on a subsample of the validation set (always the same one).
+        visible_devices: The value of `CUDA_VISIBLE_DEVICES` for the validation process, or `None`
+            to use the same devices as the training.
+        poll_interval: How often the validation process looks for new checkpoints, in seconds.
+    """
+
+    DIRNAME = 'validation'
+    DONE_FILENAME = 'done'
+
+    def __init__(self, logdir, command, nice=10, max_batches=None, visible_devices='',
+                 poll_interval=10.):
+        self._command = [*command, '--poll-interval', str(poll_interval)]
+        if max_batches:
+            self._command.extend(['--max-batches', str(max_batches)])
+        self._nice = nice
+        self._visible_devices = visible_devices
+
+        self._dir = os.path.join(logdir, self.DIRNAME)
+        os.makedirs(self._dir, exist_ok=True)
+        if os.path.exists(os.path.join(self._dir, self.DONE_FILENAME)):
+            os.remove(os.path.join(self._dir, self.DONE_FILENAME))
+        self._process = None
+        self._log_file = None
+
+    def submit(self, checkpoint_path, step):
+        """Make a checkpoint available to the validation process."""
+        prefix = os.path.join(self._dir, f'ckpt-{step}')
+        # The index file goes last, since the validation process looks for it
+        for path in sorted(glob.glob(checkpoint_path + '.*'), key=lambda p: p.endswith('.index')):
+            target_path = prefix + path[len(checkpoint_path):]
+            try:
+                os.link(path, target_path)
+            except OSError:
+                shutil.copyfile(path, target_path)
+        self._ensure_running()
+
+    def finish(self):
+        """Wait until the validation process is done with all the submitted checkpoints."""
+        with open(os.path.join(self._dir, self.DONE_FILENAME), 'w'):
+            pass
+        if self._process is None:
+            return
+        self._ensure_running()
+        _LOGGER.info('Waiting for the validation process to finish')
+        self._process.wait()
+        self._close_log()
+
+    def stop(self):
+        """Terminate the validation process."""
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+            self._process.wait()
+        self._close_log()
+
+    def _ensure_running(self):
+        if self._process is not None:
+            if self._process.poll() is None:
+                return
+            _LOGGER.warning(f'The validation process exited with code {self._process.returncode}, '
+                            'restarting it')
+
+        env = dict(os.environ)
+        if self._visible_devices is not None:
+            env['CUDA_VISIBLE_DEVICES'] = self._visible_devices
+        if self._log_file is None:
+            self._log_file = open(os.path.join(self._dir, 'log.txt'), 'a')
+        self._process = subprocess.Popen(
+            self._command, env=env, stdout=self._log_file, stderr=subprocess.STDOUT,
+            preexec_fn=(lambda: os.nice(self._nice)) if self._nice else None)
+        _LOGGER.info(f'Started the validation process (PID {self._process.pid})')
+
+    def _close_log(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
+
+
+@configurable
+class StepProfiler:
+    """Records where the time goes in each training step.
+
+    For each step, a line with the following values is appended to `profile/steps.jsonl` in the
+    log directory:
+
+    - `step_seconds`: the duration of the training session run,
+    - `input_wait_seconds`: the part of it spent waiting for the batch from the input pipeline
+      (until `batch_stats['input_timestamp']` was computed),
+    - `host_seconds`: the time spent outside the session runs since the previous step (e.g. on
+      logging, summaries or validation),
+    - the batch size and the numbers of target and style tokens, with and without padding.
+
+    Averages over the steps since the last call of `summarize` (examples and tokens per second,
+    the fraction of time spent waiting for input and the padding ratios) are returned by
+    `summarize`.
+
+    If `trace_start` is given, a timeline of each of the steps `trace_start`, ...,
+    `trace_start + trace_steps - 1` is written to `profile/timeline-<step>.json` in the Chrome
+    trace format (to be opened in `chrome://tracing`). If `trace_period` is given, the same
+    number of steps is traced again every `trace_period` steps.
+
+    Args:
+        logdir: The log directory.
+        batch_stats: A dictionary of tensors with the keys `'input_timestamp'` (the time when the
+            batch was obtained from the input pipeline, as returned by `tf.timestamp`),
+            `'batch_size'`, `'target_tokens'`, `'target_padded_tokens'`, `'style_tokens'` and
+            `'style_padded_tokens'`.
+        trace_start: The first step to trace.
+        trace_steps: The number of consecutive steps to trace.
+        trace_period: How often to repeat the tracing.
+    """
+
+    def __init__(self, logdir, batch_stats, trace_start=None, trace_steps=1, trace_period=None):
+        self.batch_stats = batch_stats
+        self._trace_start = trace_start
+        self._trace_steps = trace_steps
+        self._trace_period = trace_period
+
+        self._dir = os.path.join(logdir, 'profile')
+        os.makedirs(self._dir, exist_ok=True)
+        self._records = []
+        self._last_end_time = None
+
+    def get_run_options(self, step):
+        """Return the `RunOptions` and `RunMetadata` to use for the given step (or `None`s)."""
+        if not self._is_traced(step):
+            return None, None
+        return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+
+    def record(self, step, start_time, end_time, batch_stats, run_metadata=None):
+        """Record the statistics of a step and write its timeline if it was traced.
+
+        Args:
+            step: The step number.
+            start_time: The time when the session run started, as returned by `time.time`.
+            end_time: The time when the session run ended.
+            batch_stats: The values of the `batch_stats` tensors.
+            run_metadata: The `RunMetadata` of the session run.
+        """
+        record = {
+            'step': int(step),
+            'step_seconds': end_time - start_time,
+            'input_wait_seconds': float(np.clip(batch_stats['input_timestamp'] - start_time,
+                                                0., end_time - start_time)),
+            'host_seconds': (start_time - self._last_end_time
+                             if self._last_end_time is not None else None),
+            **{name: int(value) for name, value in batch_stats.items()
+               if name != 'input_timestamp'},
+        }
+        self._records.append(record)
+        self._last_end_time = end_time
+
+        if run_metadata is not None and run_metadata.step_stats.dev_stats:
+            path = os.path.join(self._dir, f'timeline-{step}.json')
+            with open(path, 'w') as f:
+                f.write(timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format())
+            _LOGGER.info(f'Timeline of step {step} written to {path}')
+
+    def summarize(self):
+        """Write the recorded steps to the log and return a dictionary of averages over them."""
+        if not self._records:
+            return {}
+        with open(os.path.join(self._dir, 'steps.jsonl'), 'a') as f:
+            for record in self._records:
+                print(json.dumps(record), file=f)
+
+        def total(name):
+            return sum(record[name] for record in self._records)
+
+        step_seconds = total('step_seconds')
+        host_seconds = sum(record['host_seconds'] or 0. for record in self._records)
+        summary = {
+            'input_wait_fraction': total('input_wait_seconds') / step_seconds,
+            'host_fraction': host_seconds / (step_seconds + host_seconds),
+            'examples_per_second': total('batch_size') / step_seconds,
+            'target_tokens_per_second': total('target_tokens') / step_seconds,
+            'target_padding_ratio': 1. - total('target_tokens') / max(
+                total('target_padded_tokens'), 1),
+            'style_padding_ratio': 1. - total('style_tokens') / max(
+                total('style_padded_tokens'), 1),
+        }
+        self._records = []
+        return summary
+
+    def _is_traced(self, step):
+        if self._trace_start is None or step < self._trace_start:
+            return False
+        offset = step - self._trace_start
+        if self._trace_period:
+            offset %= self._trace_period
+        return offset < self._trace_steps
+
+
+class _ProfilingSession:
+    """A wrapper of a `tf.Session` passing `run_metadata` to `run`.
+
+    The same wrapper is used for all profiled steps, so that the `DatasetManager` does not need to
+    fetch the dataset handles again on every step.
+    """
+
+    def __init__(self, session):
+        self._session = session
+        self.run_metadata = None
+
+    def run(self, fetches, feed_dict=None, options=None):
+        return self._session.run(fetches, feed_dict, options=options,
+                                 run_metadata=self.run_metadata)
+
+
+def _list_checkpoints(directory):
+    """Return the prefixes of the checkpoints in a directory, ordered by the step."""
+    paths = [path[:-len('.index')]
+             for path in glob.glob(os.path.join(directory, 'ckpt-*.index'))]
+    return sorted(paths, key=lambda path: int(path.rsplit('-', 1)[1]))
+
+
+def _remove_checkpoint(prefix):
+    for path in glob.glob(prefix + '.*'):
+        os.remove(path)
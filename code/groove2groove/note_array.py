@@ -0,0 +1,169 @@
+"""A columnar representation of the notes of a `NoteSequence`.
+
+Looping over the notes of a `NoteSequence` in Python is slow, especially when a NumPy function is
+called for each of them. A `NoteArray` holds the notes in a NumPy structured array (one record per
+note, in the same order as in the sequence), so that operations on all notes can be vectorized.
+"""
+import numpy as np
+from note_seq.protobuf import music_pb2
+
+NOTE_DTYPE = np.dtype([
+    ('pitch', np.int16),
+    ('velocity', np.int16),
+    ('start_time', np.float64),
+    ('end_time', np.float64),
+    ('program', np.int16),
+    ('is_drum', np.bool_),
+    ('instrument', np.int32),
+])
+FIELDS = NOTE_DTYPE.names
+
+
+class NoteArray:
+    """An array of notes.
+
+    The fields of the notes can be accessed as arrays through attributes with the same names as
+    the fields of `NoteSequence.Note` (e.g. `notes.pitch`). Indexing a `NoteArray` (with a slice,
+    a boolean mask or an array of indices) returns another `NoteArray`.
+
+    Args:
+        notes: A structured array with dtype `NOTE_DTYPE`.
+    """
+
+    def __init__(self, notes=None):
+        self.notes = notes if notes is not None else np.zeros(0, dtype=NOTE_DTYPE)
+
+    @classmethod
+    def from_sequence(cls, sequence):
+        """Create a `NoteArray` from the notes of a `NoteSequence`."""
+        return cls(np.fromiter(
+            ((n.pitch, n.velocity, n.start_time, n.end_time, n.program, n.is_drum, n.instrument)
+             for n in sequence.notes),
+            dtype=NOTE_DTYPE, count=len(sequence.notes)))
+
+    def to_sequence(self, sequence=None):
+        """Create a `NoteSequence` with these notes.
+
+        Args:
+            sequence: If given, the result will be a copy of this sequence, with the notes replaced
+                by the ones from this array.
+        """
+        result = music_pb2.NoteSequence()
+        if sequence is not None:
+            result.CopyFrom(sequence)
+            del result.notes[:]
+
+        # Fields which are zero for all notes are the same as unset, so they can be skipped
+        fields = [field for field in FIELDS if np.any(self.notes[field])]
+        add_note = result.notes.add
+        for values in self.notes[fields].tolist():
+            add_note(**dict(zip(fields, values)))
+        return result
+
+    def write_fields(self, sequence, fields):
+        """Write the given fields of the notes to the corresponding notes of a sequence.
+
+        This assumes that the notes of the sequence correspond to the notes in this array (e.g.
+        because the array was created from it).
+        """
+        if len(sequence.notes) != len(self):
+            raise ValueError(f'Expected a sequence with {len(self)} notes, '
+                             f'got {len(sequence.notes)}')
+        for field in fields:
+            for note, value in zip(sequence.notes, self.notes[field].tolist()):
+                setattr(note, field, value)
+
+    def __len__(self):
+        return len(self.notes)
+
+    def __getitem__(self, index):
+        return NoteArray(np.atleast_1d(self.notes[index]))
+
+    def __getattr__(self, name):
+        if name in FIELDS:
+            return self.notes[name]
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def filter(self, instrument_ids=None, programs=None, drums=None):
+        """Return the notes matching the given criteria.
+
+        The arguments have the same meaning as in `museflow.note_sequence_utils.filter_sequence`.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if instrument_ids is not None:
+            mask &= np.isin(self.notes['instrument'], list(instrument_ids))
+        if programs is not None:
+            mask &= np.isin(self.notes['program'], list(programs))
+        if drums is not None:
+            mask &= (self.notes['is_drum'] == drums)
+        return NoteArray(self.notes[mask])
+
+    def normalize_tempo(self, tempos, total_time, new_tempo=60):
+        """Warp the note times to a constant tempo.
+
+        The result matches the notes of `museflow.note_sequence_utils.normalize_tempo`: notes whose
+        duration becomes zero are removed.
+
+        Args:
+            tempos: The tempos of the sequence (a list of `NoteSequence.Tempo`).
+            total_time: The total time of the sequence.
+            new_tempo: The new tempo.
+        """
+        if np.isclose(total_time, 0.):
+            return NoteArray(self.notes.copy())
+
+        tempo_change_times, tempi = zip(*sorted(
+            (tempo.time, tempo.qpm) for tempo in tempos if tempo.time < total_time))
+        original_times = np.array([*tempo_change_times, total_time])
+        # Accumulate the durations in the same order as museflow to get exactly the same times
+        new_times = np.cumsum(np.concatenate([
+            original_times[:1], np.diff(original_times) * np.array(tempi) / new_tempo]))
+
+        notes = self.notes.copy()
+        notes['start_time'] = np.interp(notes['start_time'], original_times, new_times)
+        notes['end_time'] = np.interp(notes['end_time'], original_times, new_times)
+        return NoteArray(notes[notes['start_time'] != notes['end_time']])
+
+    def normalize_velocity(self, target_mean, target_std):
+        """Standardize the velocities to the given mean and standard deviation.
+
+        The mean and the standard deviation of the velocities are computed from the non-zero
+        velocities. The results are rounded and clipped to the range [1, 127].
+        """
+        notes = self.notes.copy()
+        nonzero = notes['velocity'][notes['velocity'] != 0].astype(np.float32)
+        if len(nonzero) == 0:
+            return NoteArray(notes)
+
+        mean, std = np.mean(nonzero), np.std(nonzero)
+        velocities = ((notes['velocity'] - np.float64(mean)) / (np.float64(std) + 1e-5)
+                      * target_std + target_mean)
+        notes['velocity'] = np.clip(np.rint(velocities), 1, 127)
+        return NoteArray(notes)
+
+    def split(self, split_times):
+        """Split the notes into segments at the given times.
+
+        Like `note_seq.sequences_lib.split_note_sequence`, each note is assigned to the segment
+        containing its onset and truncated at the end of the segment, and the times are made
+        relative to the start of the segment.
+
+        Args:
+            split_times: A sorted list of times. Notes before the first time are discarded.
+
+        Returns:
+            A list of `NoteArray`s with one segment per interval between consecutive split times,
+            plus the final segment after the last split time.
+        """
+        split_times = np.asarray(split_times, dtype=np.float64)
+        segment_ids = np.searchsorted(split_times, self.notes['start_time'], side='right') - 1
+
+        segments = []
+        for i, start in enumerate(split_times):
+            notes = self.notes[segment_ids == i]
+            if i + 1 < len(split_times):
+                notes['end_time'] = np.minimum(notes['end_time'], split_times[i + 1])
+            notes['start_time'] -= start
+            notes['end_time'] -= start
+            segments.append(NoteArray(notes))
+        return segments
@@ -0,0 +1,144 @@
+"""Utilities for working with `NoteSequence`s."""
+import re
+
+from note_seq.protobuf import music_pb2
+
+_EVENT_FIELDS = ['instrument_infos', 'notes', 'pitch_bends', 'control_changes']
+
+
+def get_program_filters(sequence):
+    """Return a dictionary with a note filter for each `(program, is_drum)` pair in a sequence.
+
+    The filters are sorted by program and named as by `get_program_filter_name`.
+    """
+    programs = sorted(set((note.program, note.is_drum) for note in sequence.notes))
+    return {get_program_filter_name(p, d): dict(programs=[p], drums=d) for p, d in programs}
+
+
+def get_program_filter_name(program, is_drum):
+    return f'program{program}' + ('d' if is_drum else '')
+
+
+def partition_sequence(sequence, note_filters=None):
+    """Apply a number of note filters to a sequence in a single pass.
+
+    The result is the same as calling `filter_sequence(sequence, **kwargs, copy=True)` for every
+    filter, but the sequence is not copied for each filter and each event is only examined once
+    per distinct combination of instrument, program and drum flag.
+
+    Args:
+        sequence: The `NoteSequence` to partition. It is not modified.
+        note_filters: A dictionary mapping filter names to `filter_sequence` keyword arguments.
+            If `None`, the sequence is split by program, with the same result as using the
+            filters returned by `get_program_filters`.
+
+    Returns:
+        A dictionary mapping the filter names to the filtered sequences, in the same order as
+        `note_filters`.
+    """
+    if note_filters is None:
+        return _partition_by_program(sequence)
+
+    filters = [_NoteFilter(sequence, **kwargs) for kwargs in note_filters.values()]
+    header = _copy_header(sequence)
+    outputs = []
+    for note_filter in filters:
+        output = music_pb2.NoteSequence()
+        output.CopyFrom(header)
+        output.instrument_infos.extend(info for info in sequence.instrument_infos
+                                       if info.instrument not in note_filter.deleted_ids)
+        outputs.append(output)
+
+    for field_name in _EVENT_FIELDS[1:]:
+        events = getattr(sequence, field_name)
+        if not events:
+            continue
+
+        # Find the matching filters for each combination of instrument, program and drum flag
+        matches = {}
+        event_lists = [[] for _ in filters]
+        for event in events:
+            group = (event.instrument, event.program, event.is_drum)
+            group_matches = matches.get(group)
+            if group_matches is None:
+                group_matches = matches[group] = [
+                    event_list for note_filter, event_list in zip(filters, event_lists)
+                    if note_filter.matches(*group)]
+            for event_list in group_matches:
+                event_list.append(event)
+
+        for output, event_list in zip(outputs, event_lists):
+            getattr(output, field_name).extend(event_list)
+
+    return dict(zip(note_filters.keys(), outputs))
+
+
+def _partition_by_program(sequence):
+    event_lists = {}
+    for note in sequence.notes:
+        key = (note.program, note.is_drum)
+        if key not in event_lists:
+            event_lists[key] = {field_name: [] for field_name in _EVENT_FIELDS[1:]}
+        event_lists[key]['notes'].append(note)
+    for field_name in _EVENT_FIELDS[2:]:
+        for event in getattr(sequence, field_name):
+            key = (event.program, event.is_drum)
+            if key in event_lists:
+                event_lists[key][field_name].append(event)
+
+    header = _copy_header(sequence)
+    outputs = {}
+    for (program, is_drum), group_event_lists in sorted(event_lists.items()):
+        output = music_pb2.NoteSequence()
+        output.CopyFrom(header)
+        output.instrument_infos.extend(sequence.instrument_infos)
+        for field_name, events in group_event_lists.items():
+            getattr(output, field_name).extend(events)
+        outputs[get_program_filter_name(program, is_drum)] = output
+    return outputs
+
+
+def _copy_header(sequence):
+    """Return a copy of a sequence without its instrument infos and events."""
+    header = music_pb2.NoteSequence()
+    for field, value in sequence.ListFields():
+        if field.name in _EVENT_FIELDS:
+            continue
+        if field.label == field.LABEL_REPEATED:
+            getattr(header, field.name).extend(value)
+        elif field.message_type is not None:
+            getattr(header, field.name).CopyFrom(value)
+        else:
+            setattr(header, field.name, value)
+    return header
+
+
+class _NoteFilter:
+    """A note filter with the same semantics as `museflow.note_sequence_utils.filter_sequence`."""
+
+    def __init__(self, sequence, instrument_re=None, instrument_ids=None, programs=None,
+                 drums=None):
+        if isinstance(instrument_re, str):
+            instrument_re = re.compile(instrument_re)
+
+        self.deleted_ids = set()
+        if instrument_re is not None:
+            self.deleted_ids.update(i.instrument for i in sequence.instrument_infos
+                                    if not instrument_re.search(i.name))
+        if instrument_ids is not None:
+            self.deleted_ids.update(i.instrument for i in sequence.instrument_infos
+                                    if i.instrument not in instrument_ids)
+        self._instrument_ids = instrument_ids
+        self._programs = programs
+        self._drums = drums
+
+    def matches(self, instrument, program, is_drum):
+        if instrument in self.deleted_ids:
+            return False
+        if self._instrument_ids is not None and instrument not in self._instrument_ids:
+            return False
+        if self._programs is not None and program not in self._programs:
+            return False
+        if self._drums is not None and is_drum != self._drums:
+            return False
+        return True
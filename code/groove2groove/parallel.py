@@ -0,0 +1,85 @@
+"""Running data generators in parallel worker processes."""
+import logging
+import multiprocessing
+import queue as queue_module
+import traceback
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def interleave_parallel(generator_fns, queue_size=16, chunk_size=64, poll_interval=5.):
+    """Run each of the given generator functions in a separate process and interleave the results.
+
+    The workers are started using the `'spawn'` method, so that they do not inherit any threads
+    or locks of this process (e.g. of a running TensorFlow session), which could make them hang.
+    Hence `generator_fns` need to be picklable, e.g. `functools.partial` objects wrapping
+    module-level functions (and so do the items they yield).
+
+    Each worker sends its items in chunks of `chunk_size` and the chunks are consumed in
+    round-robin order, so the output is deterministic as long as each generator is.
+
+    Args:
+        generator_fns: A list of functions, each returning an iterable.
+        queue_size: The maximum number of chunks waiting to be consumed, per worker.
+        chunk_size: The number of items per chunk.
+        poll_interval: How often to check (in seconds) whether a worker that is not sending
+            anything is still alive. If a worker dies (e.g. is killed for using too much memory),
+            a `RuntimeError` is raised.
+
+    Yields:
+        The items produced by the workers.
+    """
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(queue_size) for _ in generator_fns]
+    processes = [context.Process(target=_run_worker, args=(fn, queue, chunk_size), daemon=True)
+                 for fn, queue in zip(generator_fns, queues)]
+    for process in processes:
+        process.start()
+
+    try:
+        active = list(range(len(processes)))
+        while active:
+            for i in list(active):
+                message, payload = _get_message(queues[i], processes[i], i, poll_interval)
+                if message == 'items':
+                    yield from payload
+                elif message == 'done':
+                    active.remove(i)
+                elif message == 'error':
+                    raise RuntimeError(f'Data worker {i} failed:\n{payload}')
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def _get_message(queue, process, index, poll_interval):
+    """Get the next message from a worker, raising an error if the worker died."""
+    while process.is_alive():
+        try:
+            return queue.get(timeout=poll_interval)
+        except queue_module.Empty:
+            pass
+
+    # The worker may have sent its last messages just before exiting
+    try:
+        return queue.get(timeout=poll_interval)
+    except queue_module.Empty:
+        pass
+    raise RuntimeError(f'Data worker {index} died with exit code {process.exitcode}')
+
+
+def _run_worker(generator_fn, queue, chunk_size):
+    try:
+        chunk = []
+        for item in generator_fn():
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                queue.put(('items', chunk))
+                chunk = []
+        if chunk:
+            queue.put(('items', chunk))
+        queue.put(('done', None))
+    except Exception:  # pylint: disable=broad-except
+        queue.put(('error', traceback.format_exc()))
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""Convert a gzipped JSON metadata file to a memory-mapped metadata index.
+
+The index directory can be used in place of the JSON file by `TrainLoader`, `generate_triplets.py`
+and `style_profiles.py`.
+"""
+import argparse
+import logging
+
+import coloredlogs
+
+from groove2groove.metadata_index import MetadataIndex
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('metadata_path', metavar='METADATA-FILE',
+                        help='the metadata file (.json.gz)')
+    parser.add_argument('output_dir', metavar='OUTPUT-DIR',
+                        help='the directory to write the index to')
+    parser.add_argument('--style-key', type=str, default='style',
+                        help='the metadata field to use as the style')
+    args = parser.parse_args()
+
+    index = MetadataIndex.open(args.metadata_path, style_key=args.style_key)
+    index.save(args.output_dir)
+    _LOGGER.info(f'Wrote an index of {len(index)} keys and {len(index.styles)} styles '
+                 f'to {args.output_dir}')
+
+
+if __name__ == '__main__':
+    coloredlogs.install(level='INFO', logger=logging.root, isatty=True)
+    main()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""Build an index of per-key statistics (note counts, duration, token length) of an LMDB database.
+
+The index can be passed to `TrainLoader` or `EvalPipeline` to skip examples that would be
+discarded anyway without reading them from the database.
+"""
+import argparse
+
+from confugue import Configuration
+
+from groove2groove.stats_index import build_stats_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('db_path', metavar='DB',
+                        help='the database path')
+    parser.add_argument('output_path', metavar='OUTPUT-FILE',
+                        help='the output path (an .npz file)')
+    parser.add_argument('--config', metavar='YAML-FILE', default=None,
+                        help='a model configuration file; if given, the token length of each '
+                             'filtered sequence will be computed using the output encoding and '
+                             'the style note filters from this file')
+    args = parser.parse_args()
+
+    encoding, note_filters = None, None
+    if args.config:
+        with open(args.config, 'rb') as f:
+            config = Configuration.from_yaml(f)
+        encoding = config['output_encoding'].configure()
+        note_filters = config.get('style_note_filters')
+
+    build_stats_index(args.db_path, args.output_path, encoding=encoding, note_filters=note_filters)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,11 +10,14 @@ import json
 import os
 import sys
 
+import numpy as np
 import pretty_midi
 from museflow import note_sequence_utils
 from note_seq import midi_io
 from note_seq.protobuf import music_pb2
 
+from groove2groove.note_array import NoteArray
+
 try:
     from tensorflow.io import TFRecordWriter
 except ImportError:
@@ -39,16 +42,30 @@ def merge_equivalent_instruments(sequence, by_name=True, by_program=True):
         program = (event.program,) if by_program else ()
         return name + program + (event.is_drum,)
 
-    # Find the lowest instrument ID for each equivalence class.
+    # Find the lowest instrument ID for each equivalence class. For the notes, process each
+    # distinct (instrument, program, is_drum) combination only once.
+    notes = NoteArray.from_sequence(sequence)
+    note_groups, note_group_ids = np.unique(notes.notes[['instrument', 'program', 'is_drum']],
+                                            return_inverse=True)
+    note_group_keys = [get_key(music_pb2.NoteSequence.Note(instrument=instrument, program=program,
+                                                           is_drum=is_drum))
+                       for instrument, program, is_drum in note_groups.tolist()]
     key_to_id = {}
-    for collection in [sequence.notes, sequence.pitch_bends, sequence.control_changes]:
+    for key, (instrument, _, _) in zip(note_group_keys, note_groups.tolist()):
+        if key not in key_to_id or key_to_id[key] > instrument:
+            key_to_id[key] = instrument
+    for collection in [sequence.pitch_bends, sequence.control_changes]:
         for event in collection:
             key = get_key(event)
             if key not in key_to_id or key_to_id[key] > event.instrument:
                 key_to_id[key] = event.instrument
 
     # Assign the new (disambiguated) instrument IDs.
-    for collection in [sequence.notes, sequence.pitch_bends, sequence.control_changes]:
+    new_note_group_instruments = np.array([key_to_id[key] for key in note_group_keys],
+                                          dtype=np.int32)
+    notes.notes['instrument'] = new_note_group_instruments[note_group_ids.reshape(-1)]
+    notes.write_fields(sequence, ['instrument'])
+    for collection in [sequence.pitch_bends, sequence.control_changes]:
         for event in collection:
             event.instrument = key_to_id[get_key(event)]
 
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Convert an LMDB database of note sequences between the protobuf and the compact format.
+
+The compact format (see `groove2groove.compact_notes`) is faster to read, but drops the parts of
+the sequences not used by the models (e.g. control changes and pitch bends). Both formats are
+understood by the data loaders.
+"""
+import argparse
+import contextlib
+import logging
+
+import coloredlogs
+import lmdb
+
+from groove2groove.compact_notes import load_sequence, to_compact
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('src_db_path', metavar='INPUT-DB',
+                        help='the input database path')
+    parser.add_argument('tgt_db_path', metavar='OUTPUT-DB',
+                        help='the output database path')
+    parser.add_argument('--format', choices=['compact', 'protobuf'], default='compact',
+                        help='the format of the output database (default: compact)')
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as ctx:
+        src_db = ctx.enter_context(
+            lmdb.open(args.src_db_path, subdir=False, readonly=True, lock=False))
+        tgt_db = ctx.enter_context(
+            lmdb.open(args.tgt_db_path, subdir=False, readonly=False, lock=False,
+                      map_size=2 * src_db.info()['map_size']))
+        src_txn = ctx.enter_context(src_db.begin(buffers=True))
+        tgt_txn = ctx.enter_context(tgt_db.begin(buffers=True, write=True))
+
+        total = 0
+        dropped_count = 0
+        for key, val in src_txn.cursor():
+            sequence = load_sequence(val)
+            if args.format == 'compact':
+                val, dropped = to_compact(sequence)
+                dropped_count += dropped
+            else:
+                val = sequence.SerializeToString()
+            if not tgt_txn.put(bytes(key), val, overwrite=False):
+                raise RuntimeError('Duplicate key')
+            total += 1
+
+    _LOGGER.info(f'Wrote {total} sequences to {args.tgt_db_path}')
+    if dropped_count:
+        _LOGGER.warning(f'{dropped_count} sequences had content which is not stored in the '
+                        'compact format (control changes, pitch bends or text annotations)')
+
+
+if __name__ == '__main__':
+    coloredlogs.install(level='INFO', logger=logging.root, isatty=True)
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Compare the number of tokens per segment produced by the output encodings of several models.
+
+Each sequence in the database is split using the style note filters of each model configuration
+(as in training) and every non-empty part is encoded using the output encoding of that model.
+The statistics of the token lengths are printed for each model, together with the mean length
+relative to the first model.
+"""
+import argparse
+import logging
+import os
+
+import coloredlogs
+import lmdb
+import numpy as np
+from confugue import Configuration
+
+from groove2groove.compact_notes import load_sequence
+from groove2groove.note_sequence_utils import partition_sequence
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('db_path', metavar='DB',
+                        help='the database path')
+    parser.add_argument('configs', metavar='YAML-FILE', nargs='+',
+                        help='model configuration files')
+    parser.add_argument('--max-sequences', type=int, default=None,
+                        help='the maximum number of sequences to read from the database')
+    args = parser.parse_args()
+
+    models = []
+    for path in args.configs:
+        with open(path, 'rb') as f:
+            config = Configuration.from_yaml(f)
+        models.append((os.path.basename(os.path.dirname(os.path.abspath(path))),
+                       config['output_encoding'].configure(),
+                       config.get('style_note_filters', None) or {'__all__': {}}))
+
+    lengths = [[] for _ in models]
+    num_sequences = 0
+    with lmdb.open(args.db_path, subdir=False, readonly=True, lock=False) as db:
+        with db.begin(buffers=True) as txn:
+            for _, val in txn.cursor():
+                if args.max_sequences is not None and num_sequences >= args.max_sequences:
+                    break
+                num_sequences += 1
+                sequence = load_sequence(val)
+                for model_lengths, (_, encoding, note_filters) in zip(lengths, models):
+                    for part in partition_sequence(sequence, note_filters).values():
+                        if part.notes:
+                            model_lengths.append(len(encoding.encode(part)))
+    _LOGGER.info(f'Read {num_sequences} sequences')
+
+    print(f'{"model":<24} {"vocab":>6} {"segments":>9} {"mean":>8} {"median":>7} {"p95":>7} '
+          f'{"max":>7} {"rel. mean":>10}')
+    base_mean = np.mean(lengths[0]) if lengths[0] else np.nan
+    for (name, encoding, _), model_lengths in zip(models, lengths):
+        num_segments = len(model_lengths)
+        model_lengths = np.array(model_lengths or [np.nan], dtype=np.float64)
+        print(f'{name:<24} {len(encoding.vocabulary):>6d} {num_segments:>9d} '
+              f'{np.mean(model_lengths):>8.1f} {np.median(model_lengths):>7.0f} '
+              f'{np.percentile(model_lengths, 95):>7.0f} {np.max(model_lengths):>7.0f} '
+              f'{np.mean(model_lengths) / base_mean:>10.3f}')
+
+
+if __name__ == '__main__':
+    coloredlogs.install(level='INFO', logger=logging.root, isatty=True)
+    main()
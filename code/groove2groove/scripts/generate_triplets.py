@@ -1,10 +1,8 @@
 #!/usr/bin/env python
 import argparse
-import gzip
-import json
 import random
 
-from groove2groove.io import _build_segment_index, _build_style_index
+from groove2groove.metadata_index import MetadataIndex
 
 
 def main():
@@ -14,23 +12,25 @@ def main():
     parser.add_argument('--seed', type=int, default=42)
     args = parser.parse_args()
 
-    with gzip.open(args.metadata_path, 'rt') as f:
-        metadata = json.load(f)
+    metadata = MetadataIndex.open(args.metadata_path)
 
-    style_index = _build_style_index(metadata)
-    segment_index = _build_segment_index(metadata)
+    # The lists of target rows are shuffled in place and shared by all keys in the same segment
+    segment_rows = {}
 
     random.seed(args.seed)
-    for src_key in sorted(metadata.keys()):
+    for src_row in range(len(metadata)):  # Rows are sorted by key
+        src_key = metadata.get_key(src_row)
         count = 0
 
-        tgt_keys = segment_index[src_key]
-        random.shuffle(tgt_keys)
-        for tgt_key in tgt_keys:
-            if metadata[src_key]['style'] == metadata[tgt_key]['style']:
+        tgt_rows = metadata.get_segment_rows(src_row)
+        tgt_rows = segment_rows.setdefault(int(tgt_rows[0]), list(tgt_rows))
+        random.shuffle(tgt_rows)
+        for tgt_row in tgt_rows:
+            if metadata.get_style_id(src_row) == metadata.get_style_id(tgt_row):
                 continue
+            tgt_key = metadata.get_key(tgt_row)
 
-            style_keys = list(style_index[tgt_key])
+            style_keys = metadata.get_keys(metadata.get_style_rows(tgt_row))
             random.shuffle(style_keys)
             for style_key in style_keys:
                 if count >= args.max_per_src:
@@ -4,7 +4,8 @@ import argparse
 import contextlib
 
 import lmdb
-from note_seq.protobuf import music_pb2
+
+from groove2groove.compact_notes import load_note_array
 
 
 def main():
@@ -23,8 +24,7 @@ def main():
 
         for key, val in txn.cursor():
             if args.skip_empty_sequences:
-                seq = music_pb2.NoteSequence.FromString(val)
-                if not seq.notes:
+                if not len(load_note_array(val)):
                     continue
 
             print(bytes(key).decode())
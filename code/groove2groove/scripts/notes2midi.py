@@ -11,7 +11,8 @@ import os
 import coloredlogs
 import lmdb
 from note_seq import midi_io, sequences_lib
-from note_seq.protobuf import music_pb2
+
+from groove2groove.compact_notes import load_sequence
 
 
 def main():
@@ -50,7 +51,7 @@ def main():
         with db.begin(buffers=True) as txn:
             for key, val in txn.cursor():
                 key = bytes(key).decode()
-                sequence = music_pb2.NoteSequence.FromString(val)
+                sequence = load_sequence(val)
 
                 if not sequence.tempos:
                     sequence.tempos.add().qpm = 60.
@@ -0,0 +1,218 @@
+"""Reading and writing shards of pre-encoded training examples.
+
+Each shard is an uncompressed `.npz` file holding a batch of examples as they are produced by
+`Experiment._load_data` (i.e. the encoded source, the encoded style, and the decoder inputs and
+targets). Token IDs are stored as `int16` and concatenated, with an offset array marking the
+boundaries between examples. Piano rolls are stored as bit-packed masks of their non-zero
+entries, followed by the non-zero values themselves unless all of them are equal to 1.
+"""
+import copy
+import glob
+import logging
+import os
+import random
+
+import numpy as np
+
+from groove2groove.io import Loader
+
+_LOGGER = logging.getLogger(__name__)
+
+_MAX_ID = np.iinfo(np.int16).max
+
+
+class ShardWriter:
+    """Writes encoded examples into shards.
+
+    The shards are numbered from zero, so to avoid mixing them with the shards of a previous run,
+    the output directory must not contain any shards yet.
+
+    Args:
+        output_dir: The directory to write the shards to.
+        shard_size: The number of examples per shard.
+    """
+
+    def __init__(self, output_dir, shard_size=10000):
+        self._output_dir = output_dir
+        self._shard_size = shard_size
+
+        self._examples = []
+        self._filter_names = []
+        self._num_shards = 0
+        self.num_examples = 0
+
+    def __enter__(self):
+        os.makedirs(self._output_dir, exist_ok=True)
+        if glob.glob(os.path.join(self._output_dir, 'shard-*.npz')):
+            raise FileExistsError(f'{self._output_dir} already contains shards')
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, example, filter_name):
+        """Add an example in the format produced by `Experiment._load_data`."""
+        src_encoded, style_encoded, tgt_inputs, tgt_outputs = example
+        # The decoder inputs and targets are the same sequence, shifted by one token
+        if tgt_outputs:
+            tgt_encoded = [*tgt_inputs, tgt_outputs[-1]]
+        else:
+            tgt_encoded = list(tgt_inputs)
+
+        self._examples.append((src_encoded, style_encoded, tgt_encoded, filter_name))
+        self.num_examples += 1
+        if len(self._examples) >= self._shard_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered examples to a new shard."""
+        if not self._examples:
+            return
+
+        src_list, style_list, tgt_list, filter_names = zip(*self._examples)
+        arrays = {}
+        for name in filter_names:
+            if name not in self._filter_names:
+                self._filter_names.append(name)
+        arrays['filter_names'] = np.array(self._filter_names)
+        arrays['filter_ids'] = np.array([self._filter_names.index(name) for name in filter_names],
+                                        dtype=np.int16)
+        arrays['style_ids'], arrays['style_offsets'] = _concat_ids(style_list)
+        arrays['target_ids'], arrays['target_offsets'] = _concat_ids(tgt_list)
+        if isinstance(src_list[0], np.ndarray) and src_list[0].ndim == 2:
+            arrays.update(_pack_rolls(src_list))
+        else:
+            arrays['source_ids'], arrays['source_offsets'] = _concat_ids(src_list)
+
+        path = os.path.join(self._output_dir, f'shard-{self._num_shards:05d}.npz')
+        np.savez(path, **arrays)
+        _LOGGER.info(f'Wrote {len(self._examples)} examples to {path}')
+
+        self._num_shards += 1
+        self._examples.clear()
+
+
+class ShardLoader(Loader):
+    """Loads encoded examples from shards written by `ShardWriter`.
+
+    Yields tuples `(source, style, decoder_inputs, decoder_targets)` in the same format as
+    `Experiment._load_data`, so the loader can replace it as a training data generator.
+
+    Args:
+        path: The directory containing the shards.
+        filters: A list of filter names to load examples for, or `None` to load all examples.
+        shuffle: Whether to shuffle the order of the shards and of the examples within each shard.
+        random_seed: Random seed.
+        reseed: Whether the random generator should be reset every time the loader is used.
+    """
+
+    def __init__(self, path, filters=None, shuffle=True, random_seed=None, reseed=False):
+        self._paths = sorted(glob.glob(os.path.join(path, 'shard-*.npz')))
+        if not self._paths:
+            raise ValueError(f'No shards found in {path}')
+        self._filters = filters
+
+        self._shuffle = shuffle
+        if random_seed is None:
+            random_seed = random.random()
+        self._random = random.Random(random_seed)
+        self._random_seed = random_seed
+        self._reseed = reseed
+
+    def shard(self, num_shards, index):
+        """Return a loader for a part of the shards (e.g. to use in a worker process).
+
+        The parts are disjoint and together cover all the shards. Each of them has its own random
+        generator, seeded deterministically from the seed of this loader.
+        """
+        if not 0 <= index < num_shards:
+            raise ValueError(f'Invalid shard index {index} for {num_shards} shards')
+        if len(self._paths) < num_shards:
+            raise ValueError(f'Cannot split {len(self._paths)} shards into {num_shards} parts')
+        loader = copy.copy(self)
+        loader._paths = self._paths[index::num_shards]
+        loader._random_seed = f'{self._random_seed}/{index}/{num_shards}'
+        loader._random = random.Random(loader._random_seed)
+        return loader
+
+    def load(self):
+        if self._reseed:
+            self._random.seed(self._random_seed)
+
+        paths = list(self._paths)
+        if self._shuffle:
+            self._random.shuffle(paths)
+
+        for path in paths:
+            with np.load(path) as shard:
+                shard = dict(shard.items())
+
+            filter_names = list(shard['filter_names'])
+            indices = list(range(len(shard['filter_ids'])))
+            if self._filters is not None:
+                allowed_ids = [i for i, name in enumerate(filter_names) if name in self._filters]
+                indices = [i for i in indices if shard['filter_ids'][i] in allowed_ids]
+            if self._shuffle:
+                self._random.shuffle(indices)
+
+            for i in indices:
+                if 'roll_bits' in shard:
+                    src_encoded = _unpack_roll(shard, i)
+                else:
+                    src_encoded = _get_ids(shard, 'source', i)
+                style_encoded = _get_ids(shard, 'style', i)
+                tgt_encoded = _get_ids(shard, 'target', i)
+                yield src_encoded, style_encoded, tgt_encoded[:-1], tgt_encoded[1:]
+
+
+def _concat_ids(id_lists):
+    lengths = [len(ids) for ids in id_lists]
+    offsets = np.zeros(len(id_lists) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    ids = np.fromiter((i for ids in id_lists for i in ids), dtype=np.int32, count=offsets[-1])
+    if ids.size and (ids.max() > _MAX_ID or ids.min() < 0):
+        raise ValueError('Token IDs do not fit in int16')
+    return ids.astype(np.int16), offsets
+
+
+def _get_ids(shard, name, i):
+    offsets = shard[name + '_offsets']
+    return shard[name + '_ids'][offsets[i]:offsets[i + 1]].astype(np.int32)
+
+
+def _pack_rolls(rolls):
+    masks = [roll != 0 for roll in rolls]
+    values = np.concatenate([roll[mask] for roll, mask in zip(rolls, masks)])
+    bits = [np.packbits(mask) for mask in masks]
+
+    bit_offsets = np.zeros(len(rolls) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in bits], out=bit_offsets[1:])
+    value_offsets = np.zeros(len(rolls) + 1, dtype=np.int64)
+    np.cumsum([np.count_nonzero(mask) for mask in masks], out=value_offsets[1:])
+
+    arrays = {
+        'roll_shapes': np.array([roll.shape for roll in rolls], dtype=np.int32),
+        'roll_dtype': np.array(rolls[0].dtype.str),
+        'roll_bits': np.concatenate(bits),
+        'roll_bit_offsets': bit_offsets,
+        'roll_value_offsets': value_offsets,
+    }
+    if not np.all(values == 1):
+        arrays['roll_values'] = values
+    return arrays
+
+
+def _unpack_roll(shard, i):
+    num_rows, num_steps = shard['roll_shapes'][i]
+    bits = shard['roll_bits'][shard['roll_bit_offsets'][i]:shard['roll_bit_offsets'][i + 1]]
+    mask = np.unpackbits(bits)[:num_rows * num_steps].reshape(num_rows, num_steps).astype(bool)
+
+    roll = np.zeros((num_rows, num_steps), dtype=np.dtype(str(shard['roll_dtype'])))
+    if 'roll_values' in shard:
+        offsets = shard['roll_value_offsets']
+        roll[mask] = shard['roll_values'][offsets[i]:offsets[i + 1]]
+    else:
+        roll[mask] = 1
+    return roll
@@ -0,0 +1,161 @@
+"""A compact index of per-key statistics of a database of `NoteSequence`s.
+
+The index makes it possible to decide whether an example is worth loading (e.g. whether it has any
+notes matching a given filter, or whether it is too long) without reading and parsing it.
+
+For every key, the index stores the number of notes in each group of notes sharing the same
+instrument name, program and drum flag, the duration of the sequence and (optionally) its length
+in tokens after encoding each of a set of filtered versions of it.
+"""
+import contextlib
+import re
+
+import lmdb
+import numpy as np
+from museflow.note_sequence_utils import filter_sequence
+
+from groove2groove.compact_notes import load_sequence
+
+
+class SequenceStatsIndex:
+    """A per-key statistics index, as written by `build_stats_index`.
+
+    Args:
+        path: Path to the index file.
+    """
+
+    def __init__(self, path):
+        with np.load(path) as data:
+            self._data = dict(data.items())
+
+        self._keys = self._data['keys']
+        self._offsets = self._data['group_offsets']
+        self._group_names = self._data['group_names']
+        self._group_programs = self._data['group_programs']
+        self._group_is_drum = self._data['group_is_drum']
+        self._group_counts = self._data['group_counts']
+        self.instrument_names = list(self._data['instrument_names'])
+        self.filter_names = list(self._data['filter_names'])
+
+        self._name_masks = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return self._get_row(key) is not None
+
+    def num_notes(self, key, instrument_re=None, programs=None, drums=None, **kwargs):
+        """Return the number of notes of the given sequence matching the given filter.
+
+        The arguments are the same as for `museflow.note_sequence_utils.filter_sequence`.
+
+        Returns:
+            The number of notes, or `None` if the key is not in the index or the filter cannot be
+            evaluated using the index (which is the case if `instrument_ids` is given).
+        """
+        row = self._get_row(key)
+        if row is None or kwargs.get('instrument_ids') is not None:
+            return None
+
+        start, end = self._offsets[row], self._offsets[row + 1]
+        mask = np.ones(end - start, dtype=bool)
+        if instrument_re is not None:
+            # Notes whose instrument has no name are never removed by filter_sequence
+            name_ids = self._group_names[start:end]
+            mask &= (name_ids < 0) | self._get_name_mask(instrument_re)[name_ids]
+        if programs is not None:
+            mask &= np.isin(self._group_programs[start:end], programs)
+        if drums is not None:
+            mask &= (self._group_is_drum[start:end] == drums)
+        return int(self._group_counts[start:end][mask].sum())
+
+    def duration(self, key):
+        row = self._get_row(key)
+        return None if row is None else float(self._data['durations'][row])
+
+    def token_length(self, key, filter_name):
+        """Return the length of the encoded sequence after applying the given filter.
+
+        Returns `None` if the key is not in the index or if the token lengths were not computed for
+        the given filter.
+        """
+        row = self._get_row(key)
+        if row is None or filter_name not in self.filter_names:
+            return None
+        return int(self._data['token_lengths'][row, self.filter_names.index(filter_name)])
+
+    def _get_row(self, key):
+        key = key.encode()
+        row = np.searchsorted(self._keys, key)
+        if row < len(self._keys) and self._keys[row] == key:
+            return row
+        return None
+
+    def _get_name_mask(self, instrument_re):
+        if instrument_re not in self._name_masks:
+            regex = re.compile(instrument_re) if isinstance(instrument_re, str) else instrument_re
+            self._name_masks[instrument_re] = np.array(
+                [bool(regex.search(name)) for name in self.instrument_names] + [False],
+                dtype=bool)
+        return self._name_masks[instrument_re]
+
+
+def build_stats_index(db_path, output_path, encoding=None, note_filters=None):
+    """Compute the statistics of all sequences in a database and save them as an index.
+
+    Args:
+        db_path: Path to the LMDB database of `NoteSequence`s.
+        output_path: The path of the index file to write (an `.npz` file).
+        encoding: An encoding with an `encode` method, used to compute the token lengths (without
+            start and end tokens). If `None`, no token lengths are computed.
+        note_filters: A dictionary mapping filter names to `filter_sequence` keyword arguments.
+            A token length is computed for each filter. If not given, the token length of the
+            whole sequence is computed under the name `'__all__'`.
+    """
+    if note_filters is None:
+        note_filters = {'__all__': {}}
+    filter_names = sorted(note_filters.keys()) if encoding else []
+
+    keys, durations, token_lengths = [], [], []
+    group_offsets = [0]
+    groups = []
+    name_ids = {}
+
+    with contextlib.ExitStack() as ctx:
+        db = ctx.enter_context(lmdb.open(db_path, subdir=False, readonly=True, lock=False))
+        txn = ctx.enter_context(db.begin(buffers=True))
+
+        for key, val in txn.cursor():
+            sequence = load_sequence(val)
+            keys.append(bytes(key))
+            durations.append(sequence.total_time)
+
+            names = {info.instrument: info.name for info in sequence.instrument_infos}
+            counts = {}
+            for note in sequence.notes:
+                name = names.get(note.instrument)
+                group = (name_ids.setdefault(name, len(name_ids)) if name is not None else -1,
+                         note.program, note.is_drum)
+                counts[group] = counts.get(group, 0) + 1
+            groups.extend((*group, count) for group, count in sorted(counts.items()))
+            group_offsets.append(len(groups))
+
+            if encoding:
+                token_lengths.append([
+                    len(encoding.encode(filter_sequence(sequence, **note_filters[name], copy=True)))
+                    for name in filter_names])
+
+    groups = np.array(groups, dtype=np.int32).reshape(-1, 4)
+    np.savez(
+        output_path,
+        keys=np.array(keys, dtype=bytes),
+        durations=np.array(durations, dtype=np.float32),
+        instrument_names=np.array(sorted(name_ids, key=name_ids.get), dtype=str),
+        group_offsets=np.array(group_offsets, dtype=np.int64),
+        group_names=groups[:, 0].astype(np.int16),
+        group_programs=groups[:, 1].astype(np.int16),
+        group_is_drum=groups[:, 2].astype(bool),
+        group_counts=groups[:, 3],
+        filter_names=np.array(filter_names, dtype=str),
+        token_lengths=np.array(token_lengths, dtype=np.int32).reshape(len(keys), len(filter_names)))